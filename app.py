@@ -1,54 +1,109 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, Response, current_app
+from markupsafe import Markup, escape
 import storage
-import subprocess
-from datetime import datetime
+import runner
+import logstore
+import limits
+import dag
+import catchup
+import logsearch
+import metrics
 import os
 import scheduler
+import signal
 import sys
 import threading
-import signal
 import io
+import codecs
+from datetime import datetime, timedelta
 import csv  # Used only for optional import/export, not for main storage
+# Jobs stored by older versions call app.run_task_job
+from scheduler import run_task_job
 
-# Only import rumps if on macOS
-try:
-    import rumps
-    MACOS = True
-except ImportError:
-    MACOS = False
-
-app = Flask(__name__)
-app.secret_key = 'replace-this-with-a-unique-secret-key'
-
-LOGS_DIR = 'logs'
-if not os.path.exists(LOGS_DIR):
-    os.makedirs(LOGS_DIR)
-
-def parse_log_entries(log_content):
-    entries = []
-    for entry in log_content.split('--- '):
-        entry = entry.strip()
-        if not entry:
-            continue
-        header_end = entry.find('\n')
-        if header_end == -1:
-            continue
-        header = entry[:header_end].strip()
-        body = entry[header_end+1:].strip()
-        if ' run at ' in header:
-            _type, _time = header.split(' run at ', 1)
-            entries.append({'type': _type.strip(), 'time': _time.strip(), 'body': body})
-    return sorted(entries, key=lambda e: e['time'], reverse=True)
-
-@app.route('/')
+LOGS_DIR = logstore.LOGS_DIR
+
+# Routes are collected here and registered on the Flask app by create_app(), so importing
+# this module builds no app and touches no files
+_routes = []
+
+def route(rule, **options):
+    def register(view):
+        _routes.append((rule, view, options))
+        return view
+    return register
+
+# Application factory. It only builds the web UI: `python app.py` also starts the scheduler and
+# run engine in the same process (see run_flask), while `flask --app app run` or a WSGI server
+# serves the UI alone and needs `python worker.py` running next to it to schedule tasks
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = 'replace-this-with-a-unique-secret-key'
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    return app
+
+@route('/')
 def dashboard():
-    tasks = storage.load_tasks()
+    # The task table is filled in page by page from /api/tasks
     error = request.args.get('error')
-    return render_template('dashboard.html', tasks=tasks, error=error)
+    return render_template('dashboard.html', error=error, page_size=TASK_PAGE_SIZE)
+
+# Task list API for the dashboard:
+#   /api/tasks?page=1&per_page=50&sort=order|name|schedule|status|last_run&dir=asc|desc
+#             &name=<substring>&status=enabled|disabled&schedule=<substring>
+# The ETag is the tasks table version, so polling an unchanged list is answered with a 304
+# from one meta lookup, and pages already built for the current version are served from memory.
+TASK_PAGE_SIZE = 50
+MAX_TASK_PAGE_SIZE = 500
+TASK_PAGE_CACHE_SIZE = 128
+_task_page_cache = {}  # version -> {query: response body}; only the current version is kept
 
-@app.route('/tasks', methods=['GET', 'POST'])
+@route('/api/tasks')
+def api_tasks():
+    version = storage.tasks_version()
+    etag = f'tasks-{version}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', TASK_PAGE_SIZE, type=int), 1), MAX_TASK_PAGE_SIZE)
+    sort = request.args.get('sort', 'order')
+    if sort not in storage.TASK_SORT_FIELDS:
+        sort = 'order'
+    descending = request.args.get('dir') == 'desc'
+    name = request.args.get('name', '').strip()
+    status = request.args.get('status') if request.args.get('status') in ('enabled', 'disabled') else None
+    schedule = request.args.get('schedule', '').strip()
+    pages = _task_page_cache.get(version)
+    if pages is None:
+        _task_page_cache.clear()
+        pages = _task_page_cache[version] = {}
+    key = (page, per_page, sort, descending, name, status, schedule)
+    body = pages.get(key)
+    if body is None:
+        tasks, total = storage.query_tasks(name, status, schedule, sort, descending,
+                                           per_page, (page - 1) * per_page)
+        body = current_app.json.dumps({
+            'tasks': tasks,
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'pages': max((total + per_page - 1) // per_page, 1),
+            'version': version,
+        })
+        if len(pages) >= TASK_PAGE_CACHE_SIZE:
+            pages.clear()
+        pages[key] = body
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Let the browser keep the page but always revalidate it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@route('/tasks', methods=['GET', 'POST'])
 def manage_tasks():
-    tasks = storage.load_tasks()
     edit_name = request.args.get('edit')
     delete_name = request.args.get('delete')
     task = None
@@ -69,23 +124,33 @@ def manage_tasks():
             'command': form['command'],
             'schedule': form['schedule'],
             'status': form['status'],
-            'last_run': ''
+            'last_run': '',
+            'command_mode': 'exec' if form.get('command_mode') == 'exec' else 'shell',
         }
+        depends_on = form.get('depends_on', '')
+        try:
+            new_task.update(limits.parse(form))
+            new_task['catch_up'] = catchup.clean_policy(form.get('catch_up'))
+            new_task['log_keep_segments'] = logstore.parse_keep_segments(form.get('log_keep_segments'))
+            dependencies = dag.parse_dependencies(depends_on)
+            dag.check_dependencies(new_task['name'], dependencies, edit_name)
+        except ValueError as e:
+            error = str(e)
+            flash(error, 'danger')
+            # Re-show what was typed
+            new_task.update({field: form.get(field) for field in storage.LIMIT_FIELDS + ['catch_up', 'log_keep_segments']})
+            return render_template('task_form.html', task=new_task, error=error, depends_on=depends_on)
         if edit_name:
             if edit_name != new_task['name']:
                 # Renaming: check if new name exists
-                if any(t['name'] == new_task['name'] for t in tasks):
+                if storage.task_exists(new_task['name']):
                     error = f"Task name '{new_task['name']}' already exists."
                     flash(error, 'danger')
-                    return render_template('task_form.html', task=new_task, error=error)
+                    return render_template('task_form.html', task=new_task, error=error, depends_on=depends_on)
                 # Rename in DB
                 storage.rename_task(edit_name, new_task['name'])
                 # Rename log file if exists
-                import os
-                old_log = os.path.join('logs', f"{edit_name}.log")
-                new_log = os.path.join('logs', f"{new_task['name']}.log")
-                if os.path.exists(old_log):
-                    os.rename(old_log, new_log)
+                logstore.rename_log(edit_name, new_task['name'])
                 # Remove old schedule, add new
                 scheduler.remove_task_schedule(edit_name)
                 storage.edit_task(new_task['name'], new_task)
@@ -93,117 +158,320 @@ def manage_tasks():
             else:
                 storage.edit_task(edit_name, new_task)
                 scheduler.add_or_update_task_schedule(new_task)
+            storage.set_dependencies({new_task['name']: dependencies})
             flash(f"Task '{edit_name}' updated.", 'success')
         else:
             try:
                 storage.add_task(new_task)
+                storage.set_dependencies({new_task['name']: dependencies})
                 scheduler.add_or_update_task_schedule(new_task)
                 flash(f"Task '{new_task['name']}' added.", 'success')
             except ValueError as e:
                 error = str(e)
                 flash(error, 'danger')
-                return render_template('task_form.html', task=new_task, error=error)
+                return render_template('task_form.html', task=new_task, error=error, depends_on=depends_on)
         return redirect(url_for('dashboard'))
 
     # Pre-fill form for editing
+    depends_on = ''
     if edit_name:
-        for t in tasks:
-            if t['name'] == edit_name:
-                task = t
-                break
-    return render_template('task_form.html', task=task, error=error)
+        task = storage.get_task(edit_name)
+        depends_on = dag.format_dependencies(storage.get_dependencies(edit_name))
+    return render_template('task_form.html', task=task, error=error, depends_on=depends_on)
 
-@app.route('/tasks/reorder', methods=['POST'])
+@route('/tasks/reorder', methods=['POST'])
 def reorder_tasks():
     data = request.get_json()
     task_names = data.get('task_names', [])
-    if not isinstance(task_names, list):
+    # Position of the first task in the full order (the dashboard reorders one page at a time)
+    offset = data.get('offset', 0)
+    if not isinstance(task_names, list) or not isinstance(offset, int) or offset < 0:
         return jsonify({'success': False, 'error': 'Invalid data'}), 400
-    storage.set_task_order(task_names)
+    storage.set_task_order(task_names, offset)
     return jsonify({'success': True})
 
-@app.route('/tasks/delete/<task_name>', methods=['POST'])
+@route('/tasks/delete/<task_name>', methods=['POST'])
 def delete_task(task_name):
     storage.delete_task(task_name)
     scheduler.remove_task_schedule(task_name)
     flash(f"Task '{task_name}' deleted.", 'success')
     return redirect(url_for('dashboard'))
 
-@app.route('/run/<task_name>', methods=['POST'])
+def wants_json():
+    return request.is_json or request.accept_mimetypes.best == 'application/json'
+
+@route('/run/<task_name>', methods=['POST'])
 def run_task(task_name):
-    tasks = storage.load_tasks()
-    task = next((t for t in tasks if t['name'] == task_name), None)
+    task = storage.get_task(task_name)
     if not task:
+        if wants_json():
+            return jsonify({'success': False, 'error': 'Task not found'}), 404
         return redirect(url_for('dashboard'))
-    # Run the command
-    try:
-        result = subprocess.run(task['command'], shell=True, capture_output=True, text=True, timeout=3600)
-        output = result.stdout
-        error = result.stderr
-        returncode = result.returncode
-    except Exception as e:
-        output = ''
-        error = str(e)
-        returncode = -1
-    # Log the result
-    log_path = os.path.join(LOGS_DIR, f"{task_name}.log")
-    with open(log_path, 'a') as f:
-        f.write(f"\n--- One-off run at {datetime.now().isoformat()} ---\n")
-        f.write(f"Command: {task['command']}\n")
-        f.write(f"Return code: {returncode}\n")
-        if output:
-            f.write(f"Output:\n{output}\n")
-        if error:
-            f.write(f"Error:\n{error}\n")
-    # Update last_run in the database
-    task['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    storage.edit_task(task_name, task)
+    # Hand the run (and any DAG run of the tasks downstream of it) to the background run engine
+    run_id = dag.submit(task_name, 'One-off')
+    if wants_json():
+        if run_id is None:
+            return jsonify({'success': False, 'error': 'Too many runs already queued'}), 429
+        return jsonify({'success': True, 'run_id': run_id}), 202
+    if run_id is None:
+        flash(f"Task '{task_name}' already has a run waiting.", 'danger')
+    else:
+        flash(f"Task '{task_name}' queued (run {run_id}).", 'success')
     return redirect(url_for('dashboard'))
 
-@app.route('/logs/<task_name>')
+@route('/runs')
+def list_runs():
+    return jsonify(runner.list_runs(request.args.get('task')))
+
+@route('/runs/<run_id>')
+def run_status(run_id):
+    run = runner.get_run(run_id)
+    if not run:
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run)
+
+# DAG runs (see dag.py), newest first; JSON for API clients
+@route('/dags')
+def list_dag_runs():
+    dag_runs = dag.list_dag_runs()
+    if wants_json():
+        return jsonify(dag_runs)
+    return render_template('dag_runs.html', dag_runs=dag_runs)
+
+@route('/dags/<dag_run_id>')
+def dag_run_status(dag_run_id):
+    dag_run = dag.get_dag_run(dag_run_id)
+    if wants_json():
+        if not dag_run:
+            return jsonify({'error': 'DAG run not found'}), 404
+        return jsonify(dag_run)
+    if not dag_run:
+        flash('DAG run not found (only recent DAG runs are kept).', 'danger')
+        return redirect(url_for('list_dag_runs'))
+    return render_template('dag_run.html', dag_run=dag_run)
+
+# Prometheus text format, see metrics.py
+@route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Log page: newest runs first, LOG_PAGE_SIZE runs per page, read from the runs table
+LOG_PAGE_SIZE = 20
+
+@route('/logs/<task_name>')
 def view_logs(task_name):
-    log_path = os.path.join(LOGS_DIR, f"{task_name}.log")
-    if os.path.exists(log_path):
-        with open(log_path) as f:
-            log_content = f.read()
-        log_entries = parse_log_entries(log_content)
+    page = max(request.args.get('page', 1, type=int), 1)
+    total = storage.count_runs(task_name)
+    pages = max((total + LOG_PAGE_SIZE - 1) // LOG_PAGE_SIZE, 1)
+    log_entries = []
+    for run in storage.load_runs(task_name, LOG_PAGE_SIZE, (page - 1) * LOG_PAGE_SIZE):
+        log_entries.append({
+            'type': run['trigger_type'],
+            'time': run['started_at'],
+            'returncode': run['returncode'],
+            'duration': run['duration'],
+            'kill_reason': run['kill_reason'],
+            'cpu': None if run['cpu_user'] is None else run['cpu_user'] + run['cpu_system'],
+            'max_rss_kb': run['max_rss_kb'],
+            'running': run['finished_at'] is None and run['returncode'] is None,
+            'body': logstore.read_output(run['output_path'], run['output_offset'], run['output_length']),
+        })
+    return render_template('logs.html', task_name=task_name, log_entries=log_entries,
+                           running=runner.is_running(task_name), page=page, pages=pages)
+
+# Full-text search over the output of all runs (see logsearch.py):
+# ?q=words&task=name&since=2025-01-02&until=2025-01-03T12:00&returncode=1|failed&page=2
+SEARCH_PAGE_SIZE = 50
+
+# ISO date or date and time (local) -> the form started_at is stored in; a bare 'until'
+# date includes that whole day
+def search_time(value, end=False):
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"'{value}' is not a date like 2025-01-02 or 2025-01-02T09:00.")
+    if end and len(value) == len('2025-01-02'):
+        moment += timedelta(days=1)
+    return moment.isoformat()
+
+def search_returncode(value):
+    if not value or value == 'failed':
+        return value or None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Return code must be a number or 'failed'.")
+
+# Snippet text with the matched terms in <mark>, everything else escaped
+def highlight(snippet):
+    text = str(escape(snippet or ''))
+    return Markup(text.replace(storage.MATCH_START, '<mark>').replace(storage.MATCH_END, '</mark>'))
+
+@route('/search')
+def search_logs():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, total, error = [], 0, None
+    if query:
+        try:
+            results, total = logsearch.search(
+                query, request.args.get('task') or None, search_time(request.args.get('since')),
+                search_time(request.args.get('until'), end=True), search_returncode(request.args.get('returncode')),
+                SEARCH_PAGE_SIZE, (page - 1) * SEARCH_PAGE_SIZE)
+        except ValueError as e:
+            error = str(e)
+    if wants_json():
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify({'total': total, 'runs': [
+            dict({field: run[field] for field in ('id', 'task_name', 'trigger_type', 'started_at', 'finished_at',
+                                                  'returncode', 'duration', 'kill_reason')},
+                 snippet=str(highlight(run['snippet'])))
+            for run in results]})
+    for run in results:
+        run['snippet'] = highlight(run['snippet'])
+    pages = max((total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE, 1)
+    return render_template('search.html', query=query, results=results, total=total, page=page, pages=pages,
+                           error=error, available=storage.search_available())
+
+# Server-Sent Events stream of a task log as it is written.
+# Starts TAIL_BACKLOG bytes before the current end (or at ?offset= / Last-Event-ID when reconnecting)
+# and ends with an 'end' event once the task has no run in progress.
+TAIL_BACKLOG = 4096
+
+@route('/logs/<task_name>/tail')
+def tail_logs(task_name):
+    offset = request.headers.get('Last-Event-ID') or request.args.get('offset')
+    if offset is not None and offset.isdigit():
+        offset = int(offset)
     else:
-        log_entries = []
-    return render_template('logs.html', task_name=task_name, log_entries=log_entries)
+        offset = max(0, logstore.log_size(task_name) - TAIL_BACKLOG)
+
+    def events():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        after_cr = False
+        for end, chunk in logstore.follow(task_name, offset, lambda: runner.is_running(task_name)):
+            text = decoder.decode(chunk)
+            # SSE ends a line at \r too, so \r\n and bare \r (progress bars) become \n;
+            # a \r\n split between two chunks is still one line end
+            if after_cr and text.startswith('\n'):
+                text = text[1:]
+                after_cr = False
+            if text:
+                after_cr = text.endswith('\r')
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+                data = ''.join(f"data: {line}\n" for line in text.split('\n'))
+                yield f"id: {end}\n{data}\n"
+        yield "event: end\ndata: \n\n"
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/toggle/<task_name>', methods=['POST'])
+@route('/toggle/<task_name>', methods=['POST'])
 def toggle_task(task_name):
-    tasks = storage.load_tasks()
-    task = next((t for t in tasks if t['name'] == task_name), None)
+    task = storage.get_task(task_name)
     if not task:
         flash('Task not found.', 'danger')
         return redirect(url_for('dashboard'))
-    # Toggle status
+    # Toggle status; only the status column is written
     task['status'] = 'disabled' if task['status'] == 'enabled' else 'enabled'
-    storage.edit_task(task_name, task)
+    storage.set_tasks_status([task_name], task['status'])
     scheduler.add_or_update_task_schedule(task)
     flash(f"Task '{task_name}' {'enabled' if task['status'] == 'enabled' else 'disabled'}.", 'info')
     return redirect(url_for('dashboard'))
 
-@app.route('/scheduled')
+# Upcoming fire times from scheduler.timeline (no job is unpickled), soonest task first,
+# and optionally everything that fires in a range: ?from=2025-01-02T09:00&to=2025-01-02T10:00&bucket=5
+# (times are local; bucket is in minutes, or seconds as '30s'), with when the runs would start
+# under the start rate limit (runner.START_RATE). /api/schedule answers the same query as JSON.
+SCHEDULE_VIEW_LIMIT = 500
+MAX_SCHEDULE_RANGE = timedelta(days=7)
+MAX_SCHEDULE_BUCKETS = 2000
+
+def schedule_range():
+    start, end = request.args.get('from'), request.args.get('to')
+    if not start or not end:
+        return None
+    try:
+        start = datetime.fromisoformat(start).astimezone()
+        end = datetime.fromisoformat(end).astimezone()
+    except ValueError:
+        raise ValueError('Times must look like 2025-01-02T09:00.')
+    if end <= start:
+        raise ValueError("'to' must be after 'from'.")
+    if end - start > MAX_SCHEDULE_RANGE:
+        raise ValueError(f'Ranges are limited to {MAX_SCHEDULE_RANGE.days} days.')
+    bucket = request.args.get('bucket', '5').strip()
+    try:
+        bucket = timedelta(seconds=int(bucket[:-1])) if bucket.endswith('s') else timedelta(minutes=int(bucket))
+    except ValueError:
+        raise ValueError("Bucket must be minutes (5) or seconds (30s).")
+    if bucket < timedelta(seconds=1):
+        raise ValueError('Buckets must be at least a second.')
+    if (end - start) / bucket > MAX_SCHEDULE_BUCKETS:
+        raise ValueError(f'That range needs more than {MAX_SCHEDULE_BUCKETS} buckets; pick bigger ones.')
+    return scheduler.timeline.between(start, end, bucket=bucket, rate=runner.START_RATE, burst=runner.START_BURST)
+
+@route('/scheduled')
 def scheduled_jobs():
-    jobs = scheduler.scheduler.get_jobs()
-    return render_template('scheduled.html', jobs=jobs)
+    upcoming = scheduler.timeline.upcoming()
+    error = None
+    try:
+        fires = schedule_range()
+    except ValueError as e:
+        fires, error = None, str(e)
+    return render_template('scheduled.html', upcoming=upcoming[:SCHEDULE_VIEW_LIMIT], total=len(upcoming),
+                           fires=fires, error=error, start_rate=runner.START_RATE, start_burst=runner.START_BURST,
+                           spread_window=scheduler.SPREAD_WINDOW, catch_up=catchup.report())
+
+@route('/api/schedule')
+def api_schedule():
+    try:
+        fires = schedule_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if fires is None:
+        return jsonify([{'task': row['task'], 'trigger': row['trigger'],
+                         'next_fire_times': [t.isoformat() for t in row['next_fire_times']]}
+                        for row in scheduler.timeline.upcoming()])
+    return jsonify({
+        'total': fires['total'],
+        'fires': [{'time': t.isoformat(), 'task': name} for t, name in fires['fires']],
+        'per_task': fires['per_task'],
+        'peak_fires_per_second': fires['peak_fires'],
+        'peak_starts_per_second': fires['peak_starts'],
+        'max_start_delay': fires['max_delay'],
+        'buckets': [{'start': t.isoformat(), 'count': count, 'starts': starts} for t, count, starts in fires['buckets']],
+    })
 
-@app.route('/scheduled/disable_all', methods=['POST'])
+# What happened to fires missed while botBrigade was down or asleep, since startup (see catchup.py)
+@route('/api/catch_up')
+def api_catch_up():
+    return jsonify(catchup.report())
+
+@route('/scheduled/disable_all', methods=['POST'])
 def scheduled_disable_all():
-    scheduler.scheduler.remove_all_jobs()
+    # Disable the tasks too, so a worker in another process (and the next start) agrees
+    storage.set_tasks_status([task['name'] for task in storage.load_tasks() if task['status'] == 'enabled'],
+                             'disabled')
+    scheduler.remove_all_task_schedules()
     flash('All scheduled tasks have been disabled.', 'info')
     return redirect(url_for('scheduled_jobs'))
 
-@app.route('/export_jobs')
+@route('/export_jobs')
 def export_jobs():
     tasks = storage.load_tasks()
+    dependencies = {}
+    for name, upstream, condition in storage.load_dependencies():
+        dependencies.setdefault(name, []).append((upstream, condition))
     output = io.StringIO()
     # Export tasks to CSV (optional feature, not main storage)
-    writer = csv.DictWriter(output, fieldnames=storage.FIELDNAMES)
+    writer = csv.DictWriter(output, fieldnames=storage.TASK_COLUMNS + ['depends_on'])
     writer.writeheader()
     for task in tasks:
+        task['depends_on'] = dag.format_dependencies(dependencies.get(task['name'], ()))
         writer.writerow(task)
     output.seek(0)
     return send_file(
@@ -213,7 +481,13 @@ def export_jobs():
         download_name='jobs_export.csv'  # CSV export is optional
     )
 
-@app.route('/import_jobs', methods=['POST'])
+def parse_command_mode(value):
+    value = (value or '').strip() or 'shell'
+    if value not in storage.COMMAND_MODES:
+        raise ValueError(f"command_mode must be 'shell' or 'exec', not '{value}'.")
+    return value
+
+@route('/import_jobs', methods=['POST'])
 def import_jobs():
     # Import tasks from CSV (optional feature, not main storage)
     if 'csv_file' not in request.files:
@@ -224,27 +498,53 @@ def import_jobs():
         flash('No selected file.', 'danger')
         return redirect(url_for('dashboard'))
     try:
-        stream = io.StringIO(file.stream.read().decode('utf-8'))
+        # Parse the upload as a stream and write it in one transaction
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
         reader = csv.DictReader(stream)  # CSV import is optional
-        count = 0
-        for row in reader:
-            # Only use known fields
-            task = {k: row.get(k, '') for k in storage.FIELDNAMES}
-            if not task['name']:
-                continue
-            try:
-                storage.add_task(task)
-                count += 1
-            except ValueError:
-                # If task exists, update it
-                storage.edit_task(task['name'], task)
-                count += 1
+        # Limits are only imported (and overwritten) when the file has their columns
+        limit_fields = [field for field in storage.LIMIT_FIELDS if field in (reader.fieldnames or ())]
+        has_mode = 'command_mode' in (reader.fieldnames or ())
+        has_catch_up = 'catch_up' in (reader.fieldnames or ())
+        has_log_keep = 'log_keep_segments' in (reader.fieldnames or ())
+        # So are dependencies, which are checked once every task is in
+        has_dependencies = 'depends_on' in (reader.fieldnames or ())
+        dependencies = {}
+
+        def rows():
+            for row in reader:
+                # Only use known fields
+                task = {k: row.get(k) or '' for k in storage.FIELDNAMES}
+                if task['name']:
+                    if limit_fields:
+                        parsed = limits.parse(row)
+                        task.update({field: parsed[field] for field in limit_fields})
+                    if has_mode:
+                        task['command_mode'] = parse_command_mode(row.get('command_mode'))
+                    if has_catch_up:
+                        task['catch_up'] = catchup.clean_policy(row.get('catch_up'))
+                    if has_log_keep:
+                        task['log_keep_segments'] = logstore.parse_keep_segments(row.get('log_keep_segments'))
+                    if has_dependencies:
+                        dependencies[task['name']] = dag.parse_dependencies(row.get('depends_on'))
+                    yield task
+
+        columns = (storage.FIELDNAMES + (['command_mode'] if has_mode else []) + (['catch_up'] if has_catch_up else [])
+                   + (['log_keep_segments'] if has_log_keep else []) + limit_fields)
+        count = storage.upsert_tasks(rows(), columns)
+        # Register schedules for everything that was imported
+        scheduler.reconcile()
         flash(f'Imported {count} tasks from CSV (optional feature).', 'success')
+        if dependencies:
+            try:
+                dag.check_graph(dependencies)
+                storage.set_dependencies(dependencies)
+            except ValueError as e:
+                flash(f'Task dependencies were not imported: {e}', 'danger')
     except Exception as e:
         flash(f'Failed to import tasks: {e}', 'danger')
     return redirect(url_for('dashboard'))
 
-@app.route('/bulk_action', methods=['POST'])
+@route('/bulk_action', methods=['POST'])
 def bulk_action():
     action = request.form.get('action')
     selected = request.form.getlist('selected_tasks')
@@ -262,118 +562,96 @@ def bulk_action():
             return redirect(url_for('dashboard'))
         return redirect(url_for('view_logs', task_name=selected[0]))
     elif action == 'run':
-        count = 0
+        run_ids = {}
+        tasks = storage.get_tasks(selected)
         for name in selected:
-            tasks = storage.load_tasks()
-            task = next((t for t in tasks if t['name'] == name), None)
-            if not task:
+            if name not in tasks:
                 continue
-            try:
-                result = subprocess.run(task['command'], shell=True, capture_output=True, text=True, timeout=3600)
-                output = result.stdout
-                error = result.stderr
-                returncode = result.returncode
-            except Exception as e:
-                output = ''
-                error = str(e)
-                returncode = -1
-            log_path = os.path.join(LOGS_DIR, f"{name}.log")
-            with open(log_path, 'a') as f:
-                f.write(f"\n--- One-off run at {datetime.now().isoformat()} ---\n")
-                f.write(f"Command: {task['command']}\n")
-                f.write(f"Return code: {returncode}\n")
-                if output:
-                    f.write(f"Output:\n{output}\n")
-                if error:
-                    f.write(f"Error:\n{error}\n")
-            task['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            storage.edit_task(name, task)
-            count += 1
-        flash(f'Ran {count} selected tasks.', 'success')
+            run_id = dag.submit(name, 'One-off')
+            if run_id:
+                run_ids[name] = run_id
+        if wants_json():
+            return jsonify({'success': True, 'run_ids': run_ids}), 202
+        flash(f'Queued {len(run_ids)} selected tasks.', 'success')
         return redirect(url_for('dashboard'))
     elif action == 'delete':
-        count = 0
-        for name in selected:
-            storage.delete_task(name)
-            scheduler.remove_task_schedule(name)
-            count += 1
-        flash(f'Deleted {count} selected tasks.', 'success')
+        storage.delete_tasks(selected)
+        scheduler.remove_task_schedules(selected)
+        flash(f'Deleted {len(selected)} selected tasks.', 'success')
         return redirect(url_for('dashboard'))
     elif action == 'toggle':
-        count = 0
-        for name in selected:
-            tasks = storage.load_tasks()
-            task = next((t for t in tasks if t['name'] == name), None)
-            if not task:
-                continue
-            task['status'] = 'disabled' if task['status'] == 'enabled' else 'enabled'
-            storage.edit_task(name, task)
-            scheduler.add_or_update_task_schedule(task)
-            count += 1
-        flash(f'Toggled enabled/disabled for {count} selected tasks.', 'success')
+        storage.toggle_tasks(selected)
+        tasks = storage.get_tasks(selected)
+        scheduler.update_task_schedules(tasks.values())
+        flash(f'Toggled enabled/disabled for {len(tasks)} selected tasks.', 'success')
         return redirect(url_for('dashboard'))
     else:
         flash('Unknown action.', 'danger')
         return redirect(url_for('dashboard'))
 
-# Function for APScheduler to call
-# This is separate from the Flask route and does not return a response
-def run_task_job(task_name):
-    tasks = storage.load_tasks()
-    task = next((t for t in tasks if t['name'] == task_name), None)
-    if not task:
-        return
-    try:
-        result = subprocess.run(task['command'], shell=True, capture_output=True, text=True, timeout=3600)
-        output = result.stdout
-        error = result.stderr
-        returncode = result.returncode
-    except Exception as e:
-        output = ''
-        error = str(e)
-        returncode = -1
-    log_path = os.path.join(LOGS_DIR, f"{task_name}.log")
-    with open(log_path, 'a') as f:
-        f.write(f"\n--- Scheduled run at {datetime.now().isoformat()} ---\n")
-        f.write(f"Command: {task['command']}\n")
-        f.write(f"Return code: {returncode}\n")
-        if output:
-            f.write(f"Output:\n{output}\n")
-        if error:
-            f.write(f"Error:\n{error}\n")
-    # Update last_run in the database
-    task['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    storage.edit_task(task_name, task)
-
 # --- Flask background thread logic ---
 flask_thread = None
 
+# Start the scheduler and run engine (see worker.py), then serve the web UI until stopped.
+# SIGTERM stops it like Ctrl+C, so worker.stop() still writes the run status that is buffered
+# (see runstatus.py); on the menu bar's thread, quit_app() does that instead.
 def run_flask():
-    scheduler.start()
-    app.run(debug=False, use_reloader=False)
+    import worker
+    worker.start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        create_app().run(debug=False, use_reloader=False)
+    finally:
+        worker.stop()
+
+# Stop the worker running next to the menu bar, then exit without waiting for Flask's thread
+def stop_and_exit():
+    import worker
+    worker.stop()
+    os._exit(0)
+
+# --- Menu bar integration (macOS, with the optional rumps package) ---
+def run_menu_bar():
+    import rumps
+
+    class BotBrigadeMenuBar(rumps.App):
+        def __init__(self):
+            super().__init__("🤖", icon=None, quit_button=None)
+            self.menu = ["Open botBrigade", "Quit"]
 
-# --- Menu bar integration ---
-class BotBrigadeMenuBar(rumps.App):
-    def __init__(self):
-        super().__init__("🤖", icon=None, quit_button="Quit")
-        self.menu = ["Open botBrigade"]
+        @rumps.clicked("Open botBrigade")
+        def open_app(self, _):
+            import webbrowser
+            webbrowser.open("http://127.0.0.1:5000")
 
-    @rumps.clicked("Open botBrigade")
-    def open_app(self, _):
-        import webbrowser
-        webbrowser.open("http://127.0.0.1:5000")
+        @rumps.clicked("Quit")
+        def quit_app(self, _):
+            # Flask runs on a daemon thread, so run_flask's finally never runs
+            import worker
+            worker.stop()
+            rumps.quit_application()
+            os._exit(0)  # Force kill all threads and Flask
 
-    def quit_app(self, _):
-        rumps.quit_application()
-        os._exit(0)  # Force kill all threads and Flask
+        def run(self):
+            super().run()
 
-    def run(self):
-        super().run()
+    BotBrigadeMenuBar().run()
+
+def has_menu_bar():
+    if sys.platform != 'darwin':
+        return False
+    try:
+        import rumps
+    except ImportError:
+        return False
+    return True
 
 if __name__ == '__main__':
-    if MACOS:
+    if has_menu_bar():
         flask_thread = threading.Thread(target=run_flask, daemon=True)
         flask_thread.start()
-        BotBrigadeMenuBar().run()
+        signal.signal(signal.SIGTERM, lambda *_: stop_and_exit())
+        run_menu_bar()
     else:
-        run_flask() 
\ No newline at end of file
+        run_flask()
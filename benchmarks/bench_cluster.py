@@ -0,0 +1,76 @@
+# Cluster mode on one machine: several node processes share one tasks database, job store
+# and logs directory, and every job fires every `interval` seconds. Halfway through, one
+# node is killed with SIGKILL in the middle of its runs; its fires must be taken over.
+# Checks that every fire ran exactly once (plus one re-run per takeover).
+#
+#   python benchmarks/bench_cluster.py [--nodes 3] [--tasks 20] [--interval 2] [--seconds 20]
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import common
+
+WORKDIR = common.setup()
+import storage
+import scheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+NODE = '''
+import sys, time
+sys.path.insert(0, {repo!r})
+import scheduler, runner, cluster
+scheduler.start()
+time.sleep({seconds})
+scheduler.scheduler.shutdown(wait=False)
+runner.shutdown(wait=True)
+cluster.stop()
+cluster.maintain()
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=2)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--lease', type=float, default=3)
+    args = parser.parse_args()
+
+    # Seed the shared job store, then make the jobs fire faster than schedules allow
+    storage.upsert_tasks([dict(common.make_task(i), command=f'sleep {args.interval / 2}')
+                          for i in range(args.tasks)])
+    scheduler.scheduler.start(paused=True)
+    scheduler.reconcile()
+    for job in scheduler.scheduler.get_jobs():
+        scheduler.scheduler.reschedule_job(job.id, trigger=IntervalTrigger(seconds=args.interval))
+    scheduler.scheduler.shutdown()
+
+    env = dict(os.environ, BOTBRIGADE_CLUSTER='1', BOTBRIGADE_LEASE_SECONDS=str(args.lease),
+               BOTBRIGADE_MAX_WORKERS=str(args.tasks))
+    nodes = []
+    for i in range(args.nodes):
+        code = NODE.format(repo=common.REPO_DIR, seconds=args.seconds)
+        nodes.append(subprocess.Popen([sys.executable, '-c', code], cwd=WORKDIR,
+                                      env=dict(env, BOTBRIGADE_NODE_ID=f'node{i}')))
+    time.sleep(args.seconds / 2)
+    nodes[0].send_signal(signal.SIGKILL)
+    print(f"killed node0 after {args.seconds / 2}s")
+    for node in nodes[1:]:
+        node.wait()
+
+    conn = storage.get_connection()
+    runs = dict(conn.execute('SELECT trigger_type, COUNT(*) FROM runs GROUP BY trigger_type'))
+    leases, attempts, unfinished = conn.execute(
+        'SELECT COUNT(*), SUM(attempts), SUM(finished = 0) FROM leases').fetchone()
+    by_node = dict(conn.execute('SELECT node, COUNT(*) FROM leases GROUP BY node'))
+    print(f"fires claimed: {leases} {by_node}, unfinished: {unfinished}")
+    print(f"runs: {runs}")
+    scheduled, takeovers = runs.get('Scheduled', 0), runs.get('Takeover', 0)
+    ok = scheduled == leases and takeovers == attempts - leases
+    print(f"each fire ran once, plus {takeovers} takeover re-runs: {'OK' if ok else 'MISMATCH'}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# CSV import and bulk actions with many tasks: row-by-row writes versus the bulk mutation API.
+# Each side imports the same CSV into an empty database and registers the schedules.
+#
+#   python benchmarks/bench_import.py [--tasks 50000] [--toggle 5000]
+import argparse
+import csv
+import io
+import time
+import common
+
+common.setup()
+import storage
+import scheduler
+
+SCHEDULES = ['interval:5m', 'interval:2h', 'weekdays:09:00-17:00:30m', '2030-01-01 12:00']
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"  {label:36s} {time.perf_counter() - start:8.3f}s  {result if result is not None else ''}")
+
+def make_csv(n_tasks):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=storage.FIELDNAMES)
+    writer.writeheader()
+    for i in range(n_tasks):
+        writer.writerow(common.make_task(i, SCHEDULES[i % len(SCHEDULES)]))
+    return out.getvalue().encode('utf-8')
+
+def reset():
+    scheduler.remove_all_task_schedules()
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('DELETE FROM tasks')
+        conn.execute('DELETE FROM job_fingerprints')
+
+# What import_jobs did before: one transaction per row, then one job store write per task
+def legacy_import(data):
+    reader = csv.DictReader(io.StringIO(data.decode('utf-8')))
+    count = 0
+    for row in reader:
+        task = {k: row.get(k, '') for k in storage.FIELDNAMES}
+        if not task['name']:
+            continue
+        try:
+            storage.add_task(task)
+        except ValueError:
+            storage.edit_task(task['name'], task)
+        scheduler.add_or_update_task_schedule(task)
+        count += 1
+    return count
+
+# What import_jobs does now
+def bulk_import(data):
+    reader = csv.DictReader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', newline=''))
+    count = storage.upsert_tasks(task for task in reader if task['name'])
+    scheduler.reconcile()
+    return count
+
+def legacy_toggle(names):
+    for name in names:
+        task = storage.get_task(name)
+        task['status'] = 'disabled' if task['status'] == 'enabled' else 'enabled'
+        storage.edit_task(name, task)
+        scheduler.add_or_update_task_schedule(task)
+
+def bulk_toggle(names):
+    storage.toggle_tasks(names)
+    scheduler.update_task_schedules(storage.get_tasks(names).values())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=50000)
+    parser.add_argument('--toggle', type=int, default=5000)
+    args = parser.parse_args()
+
+    data = make_csv(args.tasks)
+    names = [common.make_task(i)['name'] for i in range(min(args.toggle, args.tasks))]
+    scheduler.scheduler.start(paused=True)
+    print(f"{args.tasks} tasks in a {len(data) // 1024} KiB CSV, toggling {len(names)}:")
+    timed('legacy row-by-row import', lambda: legacy_import(data))
+    timed('legacy toggle', lambda: legacy_toggle(names))
+    reset()
+    timed('bulk import', lambda: bulk_import(data))
+    timed('bulk toggle', lambda: bulk_toggle(names))
+    scheduler.scheduler.shutdown(wait=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Import time and startup of each entry point, in fresh processes, and checks that importing
+# stays free of side effects:
+#   import time   cumulative time of `import <module>` from python -X importtime (min of --repeat)
+#   heavy         which of Flask / SQLAlchemy / APScheduler the import pulled in
+#   files         files the import created in an empty working directory (should be none)
+#   startup       import plus start() of the headless worker and of the scheduler under the web
+#                 app, with --tasks tasks in the database
+# Exits non-zero if an import creates files, pulls in a package it must not (FORBIDDEN), or
+# takes longer than --max-ms, so it can guard against regressions.
+#
+#   python benchmarks/bench_import_time.py [--repeat 5] [--tasks 1000] [--max-ms 0]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import common
+
+MODULES = ['storage', 'runner', 'scheduler', 'worker', 'app']
+HEAVY = ['flask', 'sqlalchemy', 'apscheduler']
+# What each module must not import when it is imported
+FORBIDDEN = {
+    'storage': ['flask', 'sqlalchemy', 'apscheduler'],
+    'runner': ['flask', 'sqlalchemy', 'apscheduler'],
+    'scheduler': ['flask', 'sqlalchemy'],
+    'worker': ['flask', 'sqlalchemy'],
+    'app': ['sqlalchemy'],
+}
+
+def run_python(code, workdir, *flags):
+    env = dict(os.environ, PYTHONPATH=common.REPO_DIR, BOTBRIGADE_DB=os.path.join(workdir, 'tasks.db'))
+    return subprocess.run([sys.executable, *flags, '-c', code], cwd=workdir, env=env,
+                          capture_output=True, text=True, check=True)
+
+# (seconds, heavy packages imported, files created) for one fresh `import module`
+def import_once(module):
+    workdir = tempfile.mkdtemp(prefix='botbrigade-bench-')
+    code = f"import sys; import {module}; print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    result = run_python(code, workdir, '-X', 'importtime')
+    micros = None
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            micros = int(parts[1])
+    return micros / 1e6, result.stdout.split(), sorted(os.listdir(workdir))
+
+def startup_once(module, tasks):
+    workdir = tempfile.mkdtemp(prefix='botbrigade-bench-')
+    setup = ('import storage, common; '
+             f'storage.upsert_tasks(common.make_tasks({tasks}))')
+    env_path = os.pathsep.join([common.REPO_DIR, os.path.dirname(os.path.abspath(__file__))])
+    env = dict(os.environ, PYTHONPATH=env_path, BOTBRIGADE_DB=os.path.join(workdir, 'tasks.db'))
+    subprocess.run([sys.executable, '-c', setup], cwd=workdir, env=env, check=True)
+    if module == 'worker':
+        code = 'import worker; worker.start(); worker.stop()'
+    else:
+        code = 'import app, worker; app.create_app(); worker.start(); worker.stop()'
+    timed = f"import time; start = time.perf_counter(); {code}; print(time.perf_counter() - start)"
+    out = subprocess.run([sys.executable, '-c', timed], cwd=workdir, env=env, capture_output=True,
+                         text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--max-ms', type=float, default=0, help='fail if any import takes longer (0: no limit)')
+    args = parser.parse_args()
+
+    failures = []
+    print(f"  {'module':10s} {'import':>10s}  {'heavy imports':28s} files")
+    for module in MODULES:
+        runs = [import_once(module) for _ in range(args.repeat)]
+        seconds = min(run[0] for run in runs)
+        _, heavy, files = runs[-1]
+        print(f"  {module:10s} {seconds * 1000:7.1f} ms  {' '.join(heavy) or '-':28s} {' '.join(files) or '-'}")
+        if files:
+            failures.append(f"importing {module} created {', '.join(files)}")
+        for package in FORBIDDEN[module]:
+            if package in heavy:
+                failures.append(f"importing {module} imports {package}")
+        if args.max_ms and seconds * 1000 > args.max_ms:
+            failures.append(f"importing {module} took {seconds * 1000:.1f} ms (limit {args.max_ms:g} ms)")
+    print(f"startup with {args.tasks} tasks (import + start + stop):")
+    for module, label in (('worker', 'headless worker'), ('app', 'web app')):
+        timings = [startup_once(module, args.tasks) for _ in range(args.repeat)]
+        print(f"  {label:16s} {min(timings) * 1000:8.1f} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Single-task and bulk lookups: load_tasks() + linear scan versus the keyed storage API.
+#
+#   python benchmarks/bench_lookup.py [--tasks 10000] [--lookups 200] [--selected 50]
+import argparse
+import random
+import time
+import common
+
+common.setup()
+import storage
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--selected', type=int, default=50)
+    args = parser.parse_args()
+
+    conn = storage.get_connection()
+    with conn:
+        conn.executemany('INSERT INTO tasks (name, command, schedule, status, last_run) VALUES (?, ?, ?, ?, ?)',
+                         [tuple(common.make_task(i)[k] for k in storage.FIELDNAMES) for i in range(args.tasks)])
+    names = [common.make_task(i)['name'] for i in range(args.tasks)]
+    rng = random.Random(0)
+    targets = [rng.choice(names) for _ in range(args.lookups)]
+    selected = rng.sample(names, args.selected)
+
+    def scan_lookup():
+        for name in targets:
+            tasks = storage.load_tasks()
+            next((t for t in tasks if t['name'] == name), None)
+
+    def keyed_lookup():
+        for name in targets:
+            storage.get_task(name)
+
+    # What a bulk toggle over the selection paid per request before and after
+    def scan_bulk():
+        for name in selected:
+            tasks = storage.load_tasks()
+            next((t for t in tasks if t['name'] == name), None)
+
+    def keyed_bulk():
+        storage.get_tasks(selected)
+
+    print(f"{args.tasks} tasks")
+    scan = timed(scan_lookup, 1) / args.lookups
+    keyed = timed(keyed_lookup, 1) / args.lookups
+    print(f"single lookup   scan={scan * 1e3:9.3f} ms  keyed={keyed * 1e3:9.3f} ms  speedup={scan / keyed:8.1f}x")
+    scan = timed(scan_bulk, 1)
+    keyed = timed(keyed_bulk, 5)
+    print(f"bulk of {args.selected:<6d}  scan={scan * 1e3:9.3f} ms  keyed={keyed * 1e3:9.3f} ms  speedup={scan / keyed:8.1f}x")
+
+if __name__ == '__main__':
+    main()
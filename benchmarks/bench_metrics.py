@@ -0,0 +1,59 @@
+# Cost of metrics collection on the dispatch path.
+# Times the metrics calls made for one run on their own, then queues no-op runs
+# through runner.submit with metrics on and off.
+#
+#   python benchmarks/bench_metrics.py [--calls 100000] [--runs 2000] [--tasks 50]
+import argparse
+import time
+import common
+
+common.setup()
+import storage
+import runner
+import metrics
+
+def per_run_calls(n_calls, n_tasks):
+    start = time.perf_counter()
+    for i in range(n_calls):
+        name = f'task{i % n_tasks:06d}'
+        metrics.run_queued(name)
+        metrics.run_started(name)
+        metrics.run_start_lag(name, 'Scheduled', 0.002)
+        metrics.run_finished(name, 0.01, 0)
+    return (time.perf_counter() - start) / n_calls
+
+def dispatch(n_runs, n_tasks):
+    start = time.perf_counter()
+    submitted = []
+    while len(submitted) < n_runs:
+        run_id = runner.submit(f'task{len(submitted) % n_tasks:06d}', 'Scheduled')
+        if run_id is None:
+            # Queue for that task is full; let the workers catch up
+            time.sleep(0.001)
+            continue
+        submitted.append(run_id)
+    while any(runner.get_run(run_id)['finished_at'] is None for run_id in submitted[-n_tasks:]):
+        time.sleep(0.01)
+    return n_runs / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument('--tasks', type=int, default=50)
+    args = parser.parse_args()
+
+    storage.upsert_tasks([dict(common.make_task(i), command='true') for i in range(args.tasks)])
+    cost = per_run_calls(args.calls, args.tasks)
+    print(f"metrics calls per run: {cost * 1e6:.2f} us")
+    render_start = time.perf_counter()
+    size = len(metrics.render())
+    print(f"render /metrics for {args.tasks} tasks: {(time.perf_counter() - render_start) * 1e3:.2f} ms, {size} bytes")
+    for enabled in (False, True):
+        metrics.ENABLED = enabled
+        metrics.reset()
+        print(f"dispatch, metrics {'on ' if enabled else 'off'}: {dispatch(args.runs, args.tasks):8.1f} runs/s")
+    runner.shutdown()
+
+if __name__ == '__main__':
+    main()
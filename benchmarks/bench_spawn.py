@@ -0,0 +1,110 @@
+# Spawn latency and throughput for short commands, by the way they are started:
+#   legacy               subprocess.run(command, shell=True, capture_output=True), as runs used to
+#   shell / exec         supervisor.stream_command from this process, through /bin/sh or an argv list
+#   shell+limits         the same with a nice value, which needs a preexec_fn and so a full fork
+#   launcher shell/exec  started by the launcher process (launcher.py), with and without limits
+# This process first allocates --ballast-mb of memory, standing in for a long-running
+# botBrigade's resident size, which is what makes forking it expensive.
+# Latency is the median of --runs runs one after another; throughput runs --runs commands
+# with up to --concurrency at a time.
+#
+#   python benchmarks/bench_spawn.py [--runs 500] [--concurrency 32] [--ballast-mb 512] [--command true]
+import argparse
+import asyncio
+import os
+import shlex
+import statistics
+import subprocess
+import time
+import common
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=500)
+parser.add_argument('--concurrency', type=int, default=32)
+parser.add_argument('--ballast-mb', type=int, default=512)
+parser.add_argument('--command', default='true')
+args = parser.parse_args()
+
+common.setup()
+import launcher
+import supervisor
+
+LIMITS = {'nice': 0}
+
+def legacy_once():
+    subprocess.run(args.command, shell=True, capture_output=True, timeout=3600)
+
+async def supervised_once(log, shell, task):
+    command = args.command if shell else shlex.split(args.command)
+    result = await supervisor.stream_command(command, log, 3600, shell, task)
+    if result['returncode'] != 0:
+        raise RuntimeError(f"{args.command!r} failed: {result['error'] or result['returncode']}")
+
+def latency(run_once):
+    timings = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        run_once()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def throughput(submit_all):
+    start = time.perf_counter()
+    submit_all()
+    return args.runs / (time.perf_counter() - start)
+
+def bench_legacy():
+    from concurrent.futures import ThreadPoolExecutor
+
+    def submit_all():
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda _: legacy_once(), range(args.runs)))
+
+    return latency(legacy_once), throughput(submit_all)
+
+def bench_supervised(shell, task):
+    log = open(os.devnull, 'wb')
+
+    def run_once():
+        supervisor.submit(supervised_once(log, shell, task)).result()
+
+    async def run_all():
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def one():
+            async with slots:
+                await supervised_once(log, shell, task)
+
+        await asyncio.gather(*(one() for _ in range(args.runs)))
+
+    try:
+        return latency(run_once), throughput(lambda: supervisor.submit(run_all()).result())
+    finally:
+        log.close()
+
+def main():
+    ballast = b'x' * (args.ballast_mb * 1024 * 1024)  # touched, so it is really resident
+    print(f"{args.runs} x {args.command!r}, concurrency {args.concurrency}, {args.ballast_mb} MiB ballast")
+    print(f"  {'path':22s} {'median latency':>15s} {'throughput':>14s}")
+
+    def report(name, result):
+        seconds, per_second = result
+        print(f"  {name:22s} {seconds * 1000:12.2f} ms {per_second:10.1f} /s")
+
+    report('legacy subprocess.run', bench_legacy())
+    for name, shell, task in (('shell', True, None), ('exec', False, None), ('shell+limits', True, LIMITS),
+                              ('exec+limits', False, LIMITS)):
+        report(name, bench_supervised(shell, task))
+    if not launcher.SUPPORTED:
+        print("  (launcher not supported on this platform)")
+    else:
+        supervisor.start_launcher()
+        for name, shell, task in (('launcher shell', True, None), ('launcher exec', False, None),
+                                  ('launcher exec+limits', False, LIMITS)):
+            report(name, bench_supervised(shell, task))
+        supervisor.stop_launcher()
+    supervisor.shutdown()
+    del ballast
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Scheduler startup with many tasks: the old wipe-and-re-add versus reconcile().
+#
+#   python benchmarks/bench_startup.py [--tasks 10000] [--changed 100]
+import argparse
+import time
+import common
+
+common.setup()
+import storage
+import scheduler
+
+SCHEDULES = ['interval:5m', 'interval:2h', 'weekdays:09:00-17:00:30m', '2030-01-01 12:00']
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"  {label:36s} {time.perf_counter() - start:8.3f}s  {result if result else ''}")
+
+# What schedule_all_tasks did before reconciliation: wipe the store, re-add every job
+def legacy_schedule_all():
+    scheduler.scheduler.remove_all_jobs()
+    for task in storage.load_tasks():
+        if task['status'] == 'enabled':
+            trigger = scheduler.parse_schedule(task['schedule'])
+            if trigger:
+                scheduler._add_task_job(task, trigger)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--changed', type=int, default=100)
+    args = parser.parse_args()
+
+    conn = storage.get_connection()
+    with conn:
+        conn.executemany('INSERT INTO tasks (name, command, schedule, status, last_run) VALUES (?, ?, ?, ?, ?)',
+                         [tuple(common.make_task(i, SCHEDULES[i % len(SCHEDULES)])[k] for k in storage.FIELDNAMES)
+                          for i in range(args.tasks)])
+    scheduler.scheduler.start(paused=True)
+    print(f"{args.tasks} tasks:")
+    timed('legacy wipe and re-add', legacy_schedule_all)
+    scheduler.remove_all_task_schedules()
+    timed('reconcile, empty job store', scheduler.reconcile)
+    timed('reconcile, nothing changed', scheduler.reconcile)
+    with conn:
+        conn.executemany('UPDATE tasks SET schedule=? WHERE name=?',
+                         [('interval:10m', common.make_task(i)['name']) for i in range(args.changed)])
+    timed(f'reconcile, {args.changed} schedules changed', scheduler.reconcile)
+    scheduler.scheduler.shutdown(wait=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Storage throughput under concurrent readers and writers.
+# Compares the old access pattern (a new connection per call, rollback journal)
+# with storage.py's per-thread WAL connections, and with run bookkeeping written behind in
+# batches (runstatus.py) the way the run engine records last_run.
+#
+#   python benchmarks/bench_storage.py [--tasks 200] [--readers 4] [--writers 4] [--seconds 5]
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import common
+
+common.setup()
+import storage
+import runstatus
+
+# The storage functions as they were before connection pooling
+def legacy_load_tasks(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute('SELECT name, command, schedule, status, last_run FROM tasks ORDER BY "order" ASC, name ASC').fetchall()
+    conn.close()
+    return rows
+
+def legacy_edit_task(db_file, name, task):
+    conn = sqlite3.connect(db_file)
+    conn.execute('UPDATE tasks SET command=?, schedule=?, status=?, last_run=? WHERE name=?',
+                 (task['command'], task['schedule'], task['status'], task['last_run'], name))
+    conn.commit()
+    conn.close()
+
+def create_db(path, journal_mode, n_tasks):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode={journal_mode}')
+    conn.execute('''CREATE TABLE tasks (name TEXT PRIMARY KEY, command TEXT NOT NULL, schedule TEXT NOT NULL,
+                    status TEXT NOT NULL, last_run TEXT, "order" INTEGER DEFAULT 0)''')
+    conn.executemany('INSERT INTO tasks (name, command, schedule, status, last_run) VALUES (?, ?, ?, ?, ?)',
+                     [tuple(common.make_task(i)[k] for k in storage.FIELDNAMES) for i in range(n_tasks)])
+    conn.commit()
+    conn.close()
+
+def run(label, read, write, n_tasks, readers, writers, seconds):
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    lock = threading.Lock()
+
+    def worker(kind, idx):
+        done = locked = 0
+        i = idx
+        while not stop.is_set():
+            try:
+                if kind == 'reads':
+                    read()
+                else:
+                    task = common.make_task(i % n_tasks)
+                    task['last_run'] = str(time.time())
+                    write(task['name'], task)
+                    i += writers
+                done += 1
+            except sqlite3.OperationalError:
+                locked += 1
+        with lock:
+            counts[kind] += done
+            counts['locked'] += locked
+
+    threads = [threading.Thread(target=worker, args=('reads', i)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=('writes', i)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    print(f"{label:8s} reads/s={counts['reads'] / seconds:10.1f}  writes/s={counts['writes'] / seconds:10.1f}  "
+          f"locked errors={counts['locked']}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    print(f"{args.tasks} tasks, {args.readers} readers, {args.writers} writers, {args.seconds}s per mode")
+
+    legacy_db = os.path.abspath('legacy.db')
+    create_db(legacy_db, 'DELETE', args.tasks)
+    run('before', lambda: legacy_load_tasks(legacy_db),
+        lambda name, task: legacy_edit_task(legacy_db, name, task),
+        args.tasks, args.readers, args.writers, args.seconds)
+
+    pooled_db = os.path.abspath('pooled.db')
+    create_db(pooled_db, 'WAL', args.tasks)
+    storage.DB_FILE = pooled_db
+    run('after', storage.load_tasks, storage.edit_task,
+        args.tasks, args.readers, args.writers, args.seconds)
+    run('batched', storage.load_tasks, lambda name, task: runstatus.record(name, task['last_run'], 0, 0.1),
+        args.tasks, args.readers, args.writers, args.seconds)
+    runstatus.shutdown()
+
+if __name__ == '__main__':
+    main()
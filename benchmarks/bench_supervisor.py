@@ -0,0 +1,74 @@
+# Many long-running commands at once: the asyncio supervisor versus a thread per command.
+# Runs --runs tasks that each `sleep --sleep` through runner.submit with all of them allowed
+# to run at once, then the same commands through a thread pool of --legacy-workers threads
+# (APScheduler's default pool has 10) calling subprocess.run, as run_task_job used to.
+#
+#   python benchmarks/bench_supervisor.py [--runs 1000] [--sleep 1] [--legacy-workers 100]
+import argparse
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import common
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=1000)
+parser.add_argument('--sleep', type=float, default=1)
+parser.add_argument('--legacy-workers', type=int, default=100)
+args = parser.parse_args()
+
+common.setup()
+os.environ['BOTBRIGADE_MAX_WORKERS'] = str(args.runs)
+os.environ['BOTBRIGADE_RUN_HISTORY'] = str(args.runs)
+import storage
+import runner
+
+class PeakThreads:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(0.05):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def supervised(command):
+    storage.upsert_tasks([dict(common.make_task(i), command=command) for i in range(args.runs)])
+    start = time.perf_counter()
+    with PeakThreads() as threads:
+        run_ids = [runner.submit(common.make_task(i)['name']) for i in range(args.runs)]
+        for run_id in run_ids:
+            while runner.get_run(run_id)['finished_at'] is None:
+                time.sleep(0.01)
+    failed = sum(runner.get_run(run_id)['returncode'] != 0 for run_id in run_ids)
+    return time.perf_counter() - start, threads.peak, failed
+
+def legacy(command):
+    start = time.perf_counter()
+    with PeakThreads() as threads, ThreadPoolExecutor(max_workers=args.legacy_workers) as pool:
+        results = list(pool.map(lambda _: subprocess.run(command, shell=True, capture_output=True, timeout=3600),
+                                range(args.runs)))
+    failed = sum(result.returncode != 0 for result in results)
+    return time.perf_counter() - start, threads.peak, failed
+
+def main():
+    command = f'sleep {args.sleep}'
+    print(f"{args.runs} x '{command}'")
+    seconds, threads, failed = supervised(command)
+    print(f"  supervisor (one event loop)     {seconds:8.2f}s  peak threads {threads:5d}  failed {failed}")
+    seconds, threads, failed = legacy(command)
+    print(f"  {args.legacy_workers:4d} threads, subprocess.run  {seconds:8.2f}s  peak threads {threads:5d}  failed {failed}")
+    runner.shutdown()
+
+if __name__ == '__main__':
+    main()
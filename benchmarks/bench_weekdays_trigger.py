@@ -0,0 +1,180 @@
+# weekdays: schedules as one WeekdayWindowTrigger per task versus one CronTrigger per slot.
+#
+# First checks that the new trigger fires at exactly the same times as the old per-slot
+# expansion for a set of windows, and as a day-by-day listing of the slots for every window
+# (including ones that cross midnight, which the old expansion cut off at midnight, and ones
+# with a single slot). Then compares job store size, time to add the jobs and time for
+# get_jobs() (what startup and every schedule edit pay). Exits non-zero on any mismatch.
+#
+#   python benchmarks/bench_weekdays_trigger.py [--tasks 5] [--schedule weekdays:00:00-23:59:1m]
+import argparse
+import heapq
+import os
+import re
+import sys
+import time as timer
+from datetime import datetime, time, timedelta, timezone
+import common
+
+common.setup()
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.triggers.cron import CronTrigger
+from triggers import WeekdayWindowTrigger
+import scheduler
+
+EQUIVALENCE_SCHEDULES = [
+    'weekdays:09:00-17:00:30m',
+    'weekdays:00:00-23:59:1m',
+    'weekdays:09:35-18:25:7m',
+    'weekdays:08:00-20:00:3h',
+    'weekdays:12:00-12:00:5m',
+    'weekdays:06:15-22:10:45m',
+]
+# Windows crossing midnight, and windows with one slot a day; checked against slot_fire_times only
+WRAP_SCHEDULES = [
+    'weekdays:22:00-02:00:30m',
+    'weekdays:23:30-00:15:20m',
+    'weekdays:18:00-06:00:7m',
+    'weekdays:23:59-00:00:1m',
+    'weekdays:08:00-20:00:13h',
+    'weekdays:22:00-01:00:5h',
+]
+
+def parse(schedule_str):
+    start_str, end_str, interval_val, interval_unit = re.match(
+        r'weekdays:(\d{2}:\d{2})-(\d{2}:\d{2}):(\d+)([mh])', schedule_str).groups()
+    start_hour, start_minute = map(int, start_str.split(':'))
+    end_hour, end_minute = map(int, end_str.split(':'))
+    return start_hour, start_minute, end_hour, end_minute, int(interval_val), interval_unit
+
+# The per-slot expansion parse_schedule used before WeekdayWindowTrigger. The original loop
+# never ended for windows whose last step wraps past midnight; the `dt <= t` check stops it.
+def legacy_triggers(schedule_str, tz=None):
+    start_hour, start_minute, end_hour, end_minute, interval, interval_unit = parse(schedule_str)
+    t = time(start_hour, start_minute)
+    end_t = time(end_hour, end_minute)
+    times = []
+    while True:
+        times.append((t.hour, t.minute))
+        if interval_unit == 'm':
+            dt = (datetime.combine(datetime.today(), t) + timedelta(minutes=interval)).time()
+        else:
+            dt = (datetime.combine(datetime.today(), t) + timedelta(hours=interval)).time()
+        if (dt.hour, dt.minute) > (end_t.hour, end_t.minute) or dt <= t:
+            break
+        t = dt
+    return [CronTrigger(day_of_week='mon-fri', hour=hour, minute=minute, timezone=tz) for hour, minute in times]
+
+def window_trigger(schedule_str, tz=None):
+    start_hour, start_minute, end_hour, end_minute, interval, interval_unit = parse(schedule_str)
+    interval *= 60 if interval_unit == 'h' else 1
+    return WeekdayWindowTrigger(start_hour * 60 + start_minute, end_hour * 60 + end_minute, interval, timezone=tz)
+
+def fire_times(trigger, now, until):
+    times = []
+    previous = None
+    current = now
+    while True:
+        next_time = trigger.get_next_fire_time(previous, current)
+        if next_time is None or next_time > until:
+            return times
+        times.append(next_time)
+        previous = current = next_time
+
+def legacy_fire_times(triggers, now, until):
+    heap = []
+    for idx, trigger in enumerate(triggers):
+        next_time = trigger.get_next_fire_time(None, now)
+        if next_time is not None and next_time <= until:
+            heap.append((next_time, idx))
+    heapq.heapify(heap)
+    times = []
+    while heap:
+        fire_time, idx = heapq.heappop(heap)
+        times.append(fire_time)
+        next_time = triggers[idx].get_next_fire_time(fire_time, fire_time)
+        if next_time is not None and next_time <= until:
+            heapq.heappush(heap, (next_time, idx))
+    return times
+
+# What a weekdays: schedule means, listed day by day: each weekday's window from start, every
+# interval, up to and including end, which is on the next day when end is before start
+def slot_fire_times(schedule_str, now, until):
+    start_hour, start_minute, end_hour, end_minute, interval, interval_unit = parse(schedule_str)
+    interval *= 60 if interval_unit == 'h' else 1
+    start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+    if end < start:
+        end += 24 * 60
+    times = []
+    day = now.date() - timedelta(days=1)
+    while day <= until.date():
+        if day.weekday() < 5:
+            midnight = datetime.combine(day, time(), tzinfo=now.tzinfo)
+            times += [midnight + timedelta(minutes=slot) for slot in range(start, end + 1, interval)]
+        day += timedelta(days=1)
+    return [t for t in times if now <= t <= until]
+
+def check_equivalence(days):
+    ok = True
+    # Start mid-slot on a Thursday so the walk crosses a weekend, on a Saturday just after
+    # Friday's window and in the small hours of a Monday and a Saturday (inside windows that
+    # crossed midnight)
+    starts = [datetime(2025, 7, 24, 9, 47, 13, tzinfo=timezone.utc), datetime(2025, 7, 26, 0, 0, tzinfo=timezone.utc),
+              datetime(2025, 7, 28, 0, 5, tzinfo=timezone.utc), datetime(2025, 7, 26, 0, 10, 30, tzinfo=timezone.utc)]
+    for schedule_str in EQUIVALENCE_SCHEDULES + WRAP_SCHEDULES:
+        for now in starts:
+            until = now + timedelta(days=days)
+            new = fire_times(window_trigger(schedule_str, timezone.utc), now, until)
+            same = new == slot_fire_times(schedule_str, now, until) and len(new) > 0
+            if schedule_str in EQUIVALENCE_SCHEDULES:
+                same = same and new == legacy_fire_times(legacy_triggers(schedule_str, timezone.utc), now, until)
+            ok = ok and same
+            print(f"  {schedule_str:28s} from {now:%a %H:%M:%S}  fires={len(new):6d}  {'match' if same else 'MISMATCH'}")
+    # A zero interval has no slots and is rejected rather than scheduled
+    for schedule_str in ('weekdays:09:00-17:00:0m', 'weekdays:22:00-02:00:0h'):
+        rejected = scheduler.parse_schedule(schedule_str) is None
+        ok = ok and rejected
+        print(f"  {schedule_str:28s} {'rejected' if rejected else 'NOT REJECTED'}")
+    return ok
+
+def noop(task_name):
+    pass
+
+def measure_store(label, jobs_per_task, n_tasks, make_triggers):
+    path = os.path.abspath(f'jobs-{label}.sqlite')
+    sched = BackgroundScheduler(jobstores={'default': SQLAlchemyJobStore(url=f'sqlite:///{path}')})
+    sched.start(paused=True)
+    start = timer.perf_counter()
+    for i in range(n_tasks):
+        for idx, trigger in enumerate(make_triggers()):
+            job_id = f'task{i}' if jobs_per_task == 1 else f'task{i}_{idx}'
+            sched.add_job(noop, trigger=trigger, args=[f'task{i}'], id=job_id, replace_existing=True,
+                          misfire_grace_time=3600)
+    add_time = timer.perf_counter() - start
+    start = timer.perf_counter()
+    jobs = sched.get_jobs()
+    get_jobs_time = timer.perf_counter() - start
+    sched.shutdown(wait=False)
+    print(f"  {label:7s} jobs={len(jobs):7d}  store={os.path.getsize(path) / 1024:9.1f} KiB  "
+          f"add={add_time:8.3f}s  get_jobs()={get_jobs_time * 1e3:9.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=5)
+    parser.add_argument('--schedule', default='weekdays:00:00-23:59:1m')
+    parser.add_argument('--days', type=int, default=9)
+    args = parser.parse_args()
+
+    print(f"Fire time equivalence over {args.days} days:")
+    ok = check_equivalence(args.days)
+
+    slots = len(legacy_triggers(args.schedule))
+    print(f"Job store with {args.tasks} tasks of {args.schedule} ({slots} slots each):")
+    measure_store('legacy', slots, args.tasks, lambda: legacy_triggers(args.schedule))
+    measure_store('window', 1, args.tasks, lambda: [window_trigger(args.schedule)])
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
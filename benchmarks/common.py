@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run a benchmark in a throwaway directory so it never touches the real tasks.db, jobs.sqlite or logs/.
+# Must be called before importing any botBrigade module.
+def setup():
+    workdir = tempfile.mkdtemp(prefix='botbrigade-bench-')
+    os.environ['BOTBRIGADE_DB'] = os.path.join(workdir, 'tasks.db')
+    os.chdir(workdir)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    return workdir
+
+def make_task(i, schedule='interval:5m'):
+    return {
+        'name': f'task{i:06d}',
+        'command': f'echo {i}',
+        'schedule': schedule,
+        'status': 'enabled',
+        'last_run': '',
+    }
+
+# A realistic mix: short and long intervals, weekday windows and one-time runs
+MIXED_SCHEDULES = ['interval:5m', 'interval:2h', 'interval:1d', 'weekdays:09:00-17:00:30m',
+                   'weekdays:08:00-18:00:15m', '2030-01-01 12:00']
+
+def make_tasks(n, command=None):
+    tasks = []
+    for i in range(n):
+        task = make_task(i, MIXED_SCHEDULES[i % len(MIXED_SCHEDULES)])
+        if command:
+            task['command'] = command
+        if i % 10 == 9:
+            task['status'] = 'disabled'
+        tasks.append(task)
+    return tasks
+
+# Write a log in the format runs were logged in before the runs table: one
+# '--- <type> run at <time> ---' entry per run with output_bytes of output each
+def write_synthetic_log(path, runs, output_bytes=1024):
+    line = b'x' * 63 + b'\n'
+    output = line * max(output_bytes // len(line), 1)
+    started = datetime(2024, 1, 1)
+    with open(path, 'wb') as f:
+        for i in range(runs):
+            at = (started + timedelta(minutes=5 * i)).isoformat()
+            f.write(f"\n--- Scheduled run at {at} ---\nCommand: echo {i}\nOutput:\n".encode())
+            f.write(output)
+            f.write(f"Return code: {0 if i % 3 else 1}\n".encode())
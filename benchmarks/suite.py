@@ -0,0 +1,202 @@
+# Benchmark suite: times the hot paths against synthetic task sets of several sizes and
+# writes the results as JSON, so runs on different commits can be compared.
+#
+#   python benchmarks/suite.py [--sizes 1000,10000,100000] [--repeat 3] [--output results.json]
+#   python benchmarks/suite.py --compare before.json after.json [--threshold 1.2]
+#
+# Measured per task-set size:
+#   upsert_tasks        write the synthetic task set into an empty tasks table
+#   load_tasks          storage.load_tasks()
+#   dashboard           GET / (the page shell)
+#   task_api_page       GET /api/tasks, one sorted page, not cached
+#   task_api_304        GET /api/tasks revalidated with its ETag
+#   schedule_all_cold   scheduler.schedule_all_tasks() into an empty job store
+#   schedule_all_warm   scheduler.schedule_all_tasks() with nothing changed
+#   startup             a fresh process importing app and running scheduler.start()
+# Measured once:
+#   log_scan            scanning a synthetic legacy log into runs (the old log parser's job)
+#   log_page_first/last rendering the newest and oldest page of that log
+#   dispatch            no-op scheduled runs through app.run_task_job, runs/s
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+import common
+
+# Set by load(): the throwaway working directory and the botBrigade modules, which are only
+# imported once common.setup() has pointed them at it
+WORKDIR = None
+storage = logstore = scheduler = runner = app = None
+
+# Move into a throwaway directory and import botBrigade there. Called from main() once the
+# command line's paths have been resolved against the directory the suite was started in.
+def load():
+    global WORKDIR, storage, logstore, scheduler, runner, app
+    WORKDIR = common.setup()
+    import storage
+    import logstore
+    import scheduler
+    import runner
+    import app
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=common.REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run func `repeat` times (setup before each, untimed) and summarize the timings
+def measure(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'median': statistics.median(timings), 'repeat': repeat}
+
+def clear_tasks():
+    scheduler.remove_all_task_schedules()
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('DELETE FROM tasks')
+
+def startup_time():
+    code = ('import time; start = time.perf_counter(); import app, scheduler; scheduler.start(); '
+            'print(time.perf_counter() - start); scheduler.scheduler.shutdown(wait=False)')
+    env = dict(os.environ, PYTHONPATH=common.REPO_DIR)
+    out = subprocess.run([sys.executable, '-c', code], cwd=WORKDIR, env=env, capture_output=True,
+                         text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def bench_size(n, repeat, client):
+    tasks = common.make_tasks(n)
+    results = {}
+    results['upsert_tasks'] = measure(lambda: storage.upsert_tasks(tasks), repeat, setup=clear_tasks)
+    results['load_tasks'] = measure(storage.load_tasks, repeat)
+    results['dashboard'] = measure(lambda: client.get('/'), repeat)
+    page_url = f'/api/tasks?page={max(n // 100, 1)}&sort=name'
+    results['task_api_page'] = measure(lambda: client.get(page_url), repeat, setup=app._task_page_cache.clear)
+    etag = client.get(page_url).headers['ETag']
+    results['task_api_304'] = measure(lambda: client.get(page_url, headers={'If-None-Match': etag}), repeat)
+    results['schedule_all_cold'] = measure(scheduler.schedule_all_tasks, repeat,
+                                           setup=scheduler.remove_all_task_schedules)
+    results['schedule_all_warm'] = measure(scheduler.schedule_all_tasks, repeat)
+    timings = [startup_time() for _ in range(repeat)]
+    results['startup'] = {'min': min(timings), 'median': statistics.median(timings), 'repeat': repeat}
+    return results
+
+def bench_logs(log_runs, repeat, client):
+    task_name = 'logged'
+    storage.upsert_tasks([dict(common.make_task(0), name=task_name)])
+    os.makedirs(logstore.LOGS_DIR, exist_ok=True)
+    common.write_synthetic_log(logstore.log_path(task_name), log_runs)
+
+    def scan():
+        for _ in logstore._scan_legacy_log(logstore.log_file_name(task_name)):
+            pass
+
+    results = {'log_scan': measure(scan, repeat)}
+    storage.import_runs(logstore._scan_legacy_log(logstore.log_file_name(task_name)), 'bench_logs_imported')
+    pages = -(-storage.count_runs(task_name) // app.LOG_PAGE_SIZE)
+    results['log_page_first'] = measure(lambda: client.get(f'/logs/{task_name}'), repeat)
+    results['log_page_last'] = measure(lambda: client.get(f'/logs/{task_name}?page={pages}'), repeat)
+    return results
+
+def bench_dispatch(n_runs, n_tasks):
+    storage.upsert_tasks(common.make_tasks(n_tasks, command='true'))
+    names = [common.make_task(i)['name'] for i in range(n_tasks)]
+    start = time.perf_counter()
+    submitted = []
+    while len(submitted) < n_runs:
+        run_id = app.run_task_job(names[len(submitted) % n_tasks])
+        if run_id is None:
+            # That task's queue is full; let the workers catch up
+            time.sleep(0.001)
+            continue
+        submitted.append(run_id)
+    for run_id in submitted[-n_tasks:]:
+        while runner.get_run(run_id)['finished_at'] is None:
+            time.sleep(0.005)
+    seconds = time.perf_counter() - start
+    return {'dispatch': {'runs': n_runs, 'seconds': seconds, 'runs_per_second': n_runs / seconds}}
+
+def compare(before_file, after_file, threshold):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    regressions = 0
+    print(f"{'benchmark':36s} {'before':>10s} {'after':>10s} {'ratio':>7s}")
+    for group, results in after['results'].items():
+        for name, result in results.items():
+            old = before['results'].get(group, {}).get(name)
+            if not old:
+                continue
+            if 'runs_per_second' in result:
+                ratio = old['runs_per_second'] / result['runs_per_second']
+                values = (old['runs_per_second'], result['runs_per_second'])
+            else:
+                ratio = result['min'] / old['min']
+                values = (old['min'], result['min'])
+            flag = '  SLOWER' if ratio > threshold else ''
+            regressions += bool(flag)
+            print(f"{group + ' ' + name:36s} {values[0]:10.4f} {values[1]:10.4f} {ratio:7.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--log-runs', type=int, default=20000)
+    parser.add_argument('--dispatch-runs', type=int, default=2000)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+    if args.compare:
+        # Exit status 1 if anything got slower by more than threshold
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    # Relative to where the suite was started, not the throwaway directory it runs in
+    args.output = os.path.abspath(args.output)
+
+    load()
+    scheduler.scheduler.start(paused=True)
+    client = app.create_app().test_client()
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {},
+    }
+    for n in [int(size) for size in args.sizes.split(',')]:
+        print(f"{n} tasks ...", flush=True)
+        clear_tasks()
+        report['results'][f'{n}_tasks'] = bench_size(n, args.repeat, client)
+    clear_tasks()
+    print(f"log with {args.log_runs} runs ...", flush=True)
+    report['results']['logs'] = bench_logs(args.log_runs, args.repeat, client)
+    clear_tasks()
+    print(f"dispatch {args.dispatch_runs} runs ...", flush=True)
+    report['results']['dispatch'] = bench_dispatch(args.dispatch_runs, 50)
+    scheduler.scheduler.shutdown(wait=False)
+    runner.shutdown()
+
+    for group, results in report['results'].items():
+        for name, result in results.items():
+            value = f"{result['runs_per_second']:.1f} runs/s" if 'runs_per_second' in result else f"{result['min']:.4f}s"
+            print(f"  {group + ' ' + name:36s} {value}")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
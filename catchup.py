@@ -0,0 +1,216 @@
+import os
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from apscheduler.executors.base import MaxInstancesReachedError
+import storage
+import metrics
+from ratelimit import RateLimiter
+
+# Catch-up of missed fires
+# When botBrigade was stopped, asleep or stalled, its jobs come due with fires that are already
+# late. Instead of running them all at once (APScheduler's coalescing), each task's catch-up
+# policy decides what happens to its missed fires:
+#   skip       drop them; the task next runs on its schedule
+#   once       run once for all of them (the default), unless an on-time fire is running anyway
+#   replay:N   run the latest N of them
+# Catch-up runs are not started at once but put in a queue, highest priority (lowest nice)
+# and then oldest fire first, which drains at CATCH_UP_RATE runs per second. At most
+# CATCH_UP_MAX of them wait in the queue; missed fires beyond that are skipped.
+# Every decision is counted per task; report() is what happened since startup, and a summary
+# is logged each time the queue has drained.
+# CATCH_UP_DEFAULT: policy of tasks that don't set one
+# LATE_AFTER: seconds after its fire time a fire counts as missed
+# CATCH_UP_WINDOW: missed fires older than this many seconds are always skipped; a job due for
+#   longer is moved on to its first fire inside the window before its missed fires are listed
+#   (see fast_forward), so downtime costs at most a window's worth of fire times per job
+POLICIES = ('skip', 'once', 'replay')
+# Trigger type of catch-up runs (in the runs table, logs and start-lag metrics)
+TRIGGER = 'Catch-up'
+CATCH_UP_DEFAULT = os.environ.get('BOTBRIGADE_CATCH_UP', 'once')
+LATE_AFTER = float(os.environ.get('BOTBRIGADE_LATE_AFTER', '60'))
+CATCH_UP_WINDOW = float(os.environ.get('BOTBRIGADE_CATCH_UP_WINDOW', '3600'))
+CATCH_UP_RATE = float(os.environ.get('BOTBRIGADE_CATCH_UP_RATE', '1'))
+CATCH_UP_MAX = int(os.environ.get('BOTBRIGADE_CATCH_UP_MAX', '100'))
+
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_queue = []           # heap of (priority, fire time, sequence, task name, submit)
+_sequence = 0
+_limiter = RateLimiter(CATCH_UP_RATE)
+_thread = None
+_report = {}          # task name -> counts of what happened to its missed fires
+_started_at = datetime.now().isoformat(timespec='seconds')
+
+# 'replay:3' -> ('replay', 3). Raises ValueError with a message for the user.
+def parse_policy(text):
+    text = (text or '').strip()
+    if not text:
+        return None
+    kind, _, count = text.partition(':')
+    if kind not in POLICIES:
+        raise ValueError(f"Catch-up must be skip, once or replay:N, not '{text}'.")
+    if kind != 'replay':
+        if count:
+            raise ValueError(f"Catch-up '{kind}' takes no count.")
+        return kind, None
+    if not count.isdigit() or int(count) < 1:
+        raise ValueError('Catch-up replay needs a count of at least 1, like replay:3.')
+    return kind, int(count)
+
+# Normalized policy string for storage, or None for the default
+def clean_policy(text):
+    policy = parse_policy(text)
+    if policy is None:
+        return None
+    kind, count = policy
+    return f"{kind}:{count}" if count else kind
+
+def _task_policy(task):
+    try:
+        return parse_policy(task.get('catch_up')) or parse_policy(CATCH_UP_DEFAULT)
+    except ValueError:
+        return 'once', None
+
+def _count(task_name, outcome, amount=1):
+    counts = _report.setdefault(task_name, {'missed': 0, 'skipped': 0, 'queued': 0, 'run': 0, 'dropped': 0,
+                                            'last_missed': None})
+    counts[outcome] += amount
+
+# Split a job's due fire times into those to run now and missed ones, and deal with the missed
+# ones by the task's policy: queue_run(fire_time) is called later, from the drain thread, for
+# each that should run. Returns the fire times to run now.
+def split(task_name, run_times, queue_run, now=None):
+    now = now or datetime.now(timezone.utc)
+    on_time = [t for t in run_times if (now - t).total_seconds() <= LATE_AFTER]
+    missed = [t for t in run_times if (now - t).total_seconds() > LATE_AFTER]
+    if not missed:
+        return on_time
+    task = storage.get_task(task_name) or {}
+    kind, count = _task_policy(task)
+    in_window = [t for t in missed if (now - t).total_seconds() <= CATCH_UP_WINDOW]
+    if kind == 'skip':
+        keep = []
+    elif kind == 'once':
+        keep = [] if on_time else in_window[-1:]
+    else:
+        keep = in_window[-count:]
+    priority = task.get('nice') or 0
+    global _sequence
+    with _lock:
+        _count(task_name, 'missed', len(missed))
+        _report[task_name]['last_missed'] = missed[-1].astimezone().isoformat()
+        room = max(CATCH_UP_MAX - len(_queue), 0)
+        dropped = keep[:max(len(keep) - room, 0)]
+        keep = keep[len(dropped):]
+        _count(task_name, 'dropped', len(dropped))
+        _count(task_name, 'skipped', len(missed) - len(keep) - len(dropped))
+        _count(task_name, 'queued', len(keep))
+        for fire_time in keep:
+            _sequence += 1
+            heapq.heappush(_queue, (priority, fire_time, _sequence, task_name, queue_run))
+        if keep:
+            _wakeup.notify()
+    for _ in range(len(missed) - len(keep)):
+        metrics.job_missed(task_name)
+    logging.warning(f"Task {task_name} missed {len(missed)} fires (policy {kind}{f':{count}' if count else ''}): "
+                    f"{len(keep)} queued to catch up, {len(dropped)} over the catch-up limit, "
+                    f"{len(missed) - len(keep) - len(dropped)} skipped")
+    _ensure_started()
+    return on_time
+
+# Move a job that has been due since before the catch-up window (LATE_AFTER + CATCH_UP_WINDOW
+# ago) on to its first fire inside the window, straight from its trigger, so APScheduler never
+# lists the fires in between one by one (a minutely task down for a week has ~10k). They are
+# all skipped anyway. Called by the job store for each due job; returns True if job.next_run_time
+# was changed, and the store saves it.
+def fast_forward(job, now):
+    horizon = now - timedelta(seconds=LATE_AFTER + CATCH_UP_WINDOW)
+    due_since = job.next_run_time
+    if due_since is None or due_since >= horizon:
+        return False
+    next_run_time = job.trigger.get_next_fire_time(None, horizon)
+    if next_run_time is None or next_run_time <= due_since:
+        return False
+    with _lock:
+        _count(job.id, 'missed')
+        _count(job.id, 'skipped')
+        _report[job.id]['last_missed'] = due_since.astimezone().isoformat()
+    metrics.job_missed(job.id)
+    logging.warning(f"Task {job.id} has been due since {due_since.astimezone():%Y-%m-%d %H:%M:%S}; "
+                    f"fires before the catch-up window ({CATCH_UP_WINDOW:g}s) are skipped, "
+                    f"next fire {next_run_time.astimezone():%Y-%m-%d %H:%M:%S}")
+    job.next_run_time = next_run_time
+    return True
+
+def _ensure_started():
+    global _thread
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_drain, name='catch-up', daemon=True)
+        _thread.start()
+
+# Start queued catch-up runs, one per CATCH_UP_RATE tick, skipping tasks that were disabled
+# or deleted while they waited
+def _drain():
+    while True:
+        with _lock:
+            while not _queue:
+                _log_summary()
+                _wakeup.wait()
+            _, fire_time, _, task_name, queue_run = heapq.heappop(_queue)
+        delay = _limiter.reserve()
+        if delay:
+            time.sleep(delay)
+        task = storage.get_task(task_name)
+        if not task or task['status'] != 'enabled':
+            with _lock:
+                _count(task_name, 'queued', -1)
+                _count(task_name, 'skipped')
+            continue
+        try:
+            queue_run(fire_time)
+            outcome = 'run'
+        except MaxInstancesReachedError:
+            logging.warning(f"Catch-up run of task {task_name} skipped: it is already running "
+                            f"as many instances as it may")
+            outcome = 'skipped'
+        except Exception:
+            logging.exception(f"Catch-up run of task {task_name} failed to start")
+            outcome = 'skipped'
+        with _lock:
+            _count(task_name, 'queued', -1)
+            _count(task_name, outcome)
+
+# Drop the catch-up runs still queued; the scheduler is shutting down
+def clear():
+    with _lock:
+        dropped, _queue[:] = list(_queue), []
+        for _, _, _, task_name, _ in dropped:
+            _count(task_name, 'queued', -1)
+            _count(task_name, 'dropped')
+    if dropped:
+        logging.info(f"Scheduler stopping: {len(dropped)} queued catch-up runs dropped")
+
+_logged = {}
+
+# Log what happened to missed fires since the last summary (called with _lock held)
+def _log_summary():
+    totals = {'missed': 0, 'skipped': 0, 'run': 0, 'dropped': 0}
+    for task_name, counts in _report.items():
+        before = _logged.get(task_name, {})
+        for outcome in totals:
+            totals[outcome] += counts[outcome] - before.get(outcome, 0)
+        _logged[task_name] = dict(counts)
+    if totals['missed']:
+        logging.info(f"Catch-up done: {totals['missed']} missed fires, {totals['run']} caught up, "
+                     f"{totals['skipped']} skipped, {totals['dropped']} over the catch-up limit")
+
+# What happened to missed fires since startup: {'since', 'pending', 'tasks': {name: counts}}
+def report():
+    with _lock:
+        return {'since': _started_at, 'pending': len(_queue),
+                'tasks': {name: dict(counts) for name, counts in sorted(_report.items())}}
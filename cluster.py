@@ -0,0 +1,112 @@
+import os
+import socket
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+import storage
+import runner
+import dag
+
+# Cluster mode (override with environment variables)
+# Several botBrigade nodes can share one tasks database (BOTBRIGADE_DB) and one job store
+# (BOTBRIGADE_JOBSTORE_URL). Every node's scheduler fires the shared jobs, and each
+# fire is claimed with a lease in the tasks database, so exactly one node runs it.
+# The holder renews its leases while the run is queued or running. If a node dies, its
+# unfinished leases expire, and another node takes them over and runs the fire again.
+# CLUSTER: set BOTBRIGADE_CLUSTER=1 to claim fires before running them
+# NODE_ID: this node's name in the leases table (default host:pid)
+# LEASE_SECONDS: how long a lease lasts without being renewed
+# TAKEOVER_MAX_AGE: expired fires older than this many seconds are dropped rather than re-run
+# LEASE_HISTORY: how long (seconds) finished leases are kept
+ENABLED = os.environ.get('BOTBRIGADE_CLUSTER', '0') == '1'
+NODE_ID = os.environ.get('BOTBRIGADE_NODE_ID') or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = float(os.environ.get('BOTBRIGADE_LEASE_SECONDS', '60'))
+TAKEOVER_MAX_AGE = float(os.environ.get('BOTBRIGADE_TAKEOVER_MAX_AGE', '3600'))
+LEASE_HISTORY = float(os.environ.get('BOTBRIGADE_LEASE_HISTORY', str(24 * 3600)))
+# Leases are renewed, and expired ones looked for, this often
+HEARTBEAT_INTERVAL = LEASE_SECONDS / 3
+
+_lock = threading.Lock()
+_held = {}            # run_id -> (job_id, fire_time) of a lease this node holds
+_stop = threading.Event()
+_thread = None
+
+def _fire_key(fire_time):
+    return fire_time.astimezone(timezone.utc).isoformat()
+
+def claim(job_id, fire_time):
+    now = time.time()
+    return storage.claim_lease(job_id, _fire_key(fire_time), NODE_ID, now + LEASE_SECONDS, now)
+
+# Run a scheduled fire of task_name if this node wins its lease. Returns the run id, or None
+# if another node holds the fire (or the task's queue is full).
+def run_claimed(task_name, fire_time, trigger='Scheduled'):
+    if not claim(task_name, fire_time):
+        return None
+    return _submit(task_name, _fire_key(fire_time), trigger)
+
+def _submit(task_name, fire_key, trigger):
+    run_id = dag.submit(task_name, trigger)
+    if run_id is None:
+        # Queue full: the fire is dropped, as it would be on a single node
+        storage.finish_leases(NODE_ID, [(task_name, fire_key)])
+        return None
+    with _lock:
+        _held[run_id] = (task_name, fire_key)
+    return run_id
+
+# Start the heartbeat thread; wakeup is called on every beat so this node's scheduler
+# also notices jobs that other nodes added to the shared job store
+def start(wakeup=None):
+    global _thread
+    if _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_heartbeat, args=(wakeup,), name='botbrigade-cluster', daemon=True)
+    _thread.start()
+    logging.info(f"Cluster node {NODE_ID} started (lease {LEASE_SECONDS}s)")
+
+def stop():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+
+def _heartbeat(wakeup):
+    while not _stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            maintain()
+            if wakeup:
+                wakeup()
+        except Exception:
+            logging.exception('Cluster heartbeat failed')
+
+# Finish the leases of runs that are done, renew the rest, and take over expired ones
+def maintain():
+    now = time.time()
+    with _lock:
+        held = dict(_held)
+    finished = []
+    for run_id in held:
+        run = runner.get_run(run_id)
+        if run is None or run['finished_at']:
+            finished.append(run_id)
+    storage.finish_leases(NODE_ID, [held[run_id] for run_id in finished])
+    with _lock:
+        for run_id in finished:
+            _held.pop(run_id, None)
+        active = list(_held.values())
+    storage.renew_leases(NODE_ID, active, now + LEASE_SECONDS)
+    for job_id, fire_key, node in storage.expired_leases(now):
+        if not storage.claim_lease(job_id, fire_key, NODE_ID, now + LEASE_SECONDS, now):
+            continue  # another node got there first
+        age = now - datetime.fromisoformat(fire_key).timestamp()
+        if age > TAKEOVER_MAX_AGE:
+            logging.warning(f"Dropping fire {fire_key} of {job_id} from dead node {node}: {age:.0f}s old")
+            storage.finish_leases(NODE_ID, [(job_id, fire_key)])
+            continue
+        logging.warning(f"Taking over fire {fire_key} of {job_id} from node {node}")
+        _submit(job_id, fire_key, 'Takeover')
+    storage.prune_leases(now - LEASE_HISTORY)
@@ -0,0 +1,278 @@
+import os
+import uuid
+import threading
+from collections import deque
+from datetime import datetime
+import storage
+import runner
+
+# Task dependencies
+# A task can depend on upstream tasks, each with a condition on how the upstream run ended:
+# success (the default), failure, or always. Running a task that others depend on (from its
+# schedule, the dashboard or the API) starts a DAG run: every task downstream of it runs once
+# its upstreams in the DAG run have finished and their conditions hold, and is skipped if they
+# can no longer hold. Tasks whose upstreams are done run in parallel on the worker pool.
+# Upstream tasks outside the DAG run (not downstream of the task that started it) are ignored.
+# DAG_RUN_HISTORY: how many finished DAG runs are kept in memory for the DAG run view
+CONDITIONS = ('success', 'failure', 'always')
+DAG_RUN_HISTORY = int(os.environ.get('BOTBRIGADE_DAG_RUN_HISTORY', '100'))
+# Trigger type of runs started by their upstream tasks
+UPSTREAM_TRIGGER = 'Upstream'
+
+FINAL_STATES = ('succeeded', 'failed', 'skipped')
+
+_lock = threading.Lock()
+_dag_runs = {}        # dag_run_id -> DAG run record
+_finished = deque()   # finished DAG run ids, oldest first (bounded by DAG_RUN_HISTORY)
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+# --- Parsing and validation (task form and CSV import) ---
+
+# 'fetch, clean:failure' -> [('fetch', 'success'), ('clean', 'failure')].
+# Raises ValueError with a message for the user.
+def parse_dependencies(text):
+    dependencies = {}
+    for item in (text or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        upstream, _, condition = item.rpartition(':')
+        if not upstream or condition.strip() not in CONDITIONS:
+            # No condition given (task names may themselves contain ':')
+            upstream, condition = item, 'success'
+        upstream = upstream.strip()
+        condition = condition.strip()
+        if upstream in dependencies and dependencies[upstream] != condition:
+            raise ValueError(f"Upstream task '{upstream}' is listed twice with different conditions.")
+        dependencies[upstream] = condition
+    return list(dependencies.items())
+
+def format_dependencies(dependencies):
+    return ', '.join(upstream if condition == 'success' else f'{upstream}:{condition}'
+                     for upstream, condition in dependencies)
+
+# A cycle in {task: upstream names} as a list of names (first == last), or None
+def find_cycle(graph):
+    state = {}  # name -> 1 while on the DFS path, 2 when done
+    for start in graph:
+        if start in state:
+            continue
+        path = [start]
+        stack = [iter(graph.get(start, ()))]
+        state[start] = 1
+        while stack:
+            upstream = next(stack[-1], None)
+            if upstream is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(upstream) == 1:
+                cycle = path[path.index(upstream):] + [upstream]
+                # Report it in run order (upstream first)
+                return cycle[::-1]
+            elif upstream not in state:
+                state[upstream] = 1
+                path.append(upstream)
+                stack.append(iter(graph.get(upstream, ())))
+    return None
+
+def _graph(edges):
+    graph = {}
+    for task_name, upstream, _ in edges:
+        graph.setdefault(task_name, set()).add(upstream)
+    return graph
+
+def _check_cycles(graph):
+    cycle = find_cycle(graph)
+    if cycle:
+        raise ValueError(f"Dependencies would form a cycle: {' → '.join(cycle)}.")
+
+# Check that task_name may depend on dependencies: every upstream exists and no cycle forms.
+# old_name is the task's current name when it is being renamed.
+# Raises ValueError with a message for the user.
+def check_dependencies(task_name, dependencies, old_name=None):
+    renamed = {old_name: task_name} if old_name else {}
+    upstreams = {renamed.get(upstream, upstream) for upstream, _ in dependencies}
+    existing = storage.get_tasks(upstreams - {task_name})
+    missing = sorted(upstreams - {task_name} - existing.keys())
+    if missing:
+        raise ValueError(f"Upstream task '{missing[0]}' does not exist.")
+    graph = {}
+    for name, upstream, _ in storage.load_dependencies():
+        name = renamed.get(name, name)
+        if name != task_name:
+            graph.setdefault(name, set()).add(renamed.get(upstream, upstream))
+    graph[task_name] = upstreams
+    _check_cycles(graph)
+
+# Check a whole set of new dependencies ({task_name: [(upstream, condition)]}) against the
+# stored ones, e.g. after a CSV import. Raises ValueError with a message for the user.
+def check_graph(dependencies):
+    graph = _graph(edge for edge in storage.load_dependencies() if edge[0] not in dependencies)
+    for task_name, edges in dependencies.items():
+        graph[task_name] = {upstream for upstream, _ in edges}
+    upstreams = set().union(*graph.values()) if graph else set()
+    existing = storage.get_tasks(upstreams)
+    missing = sorted(upstreams - existing.keys())
+    if missing:
+        raise ValueError(f"Upstream task '{missing[0]}' does not exist.")
+    _check_cycles(graph)
+
+# --- DAG runs ---
+
+# Queue a run of task_name, and a DAG run of everything downstream of it if anything is.
+# Returns the task's own run id, or None if the run engine rejected it (see runner.submit).
+# A task nothing depends on costs one indexed lookup; only tasks with downstream edges walk
+# the graph, one lookup per task in the DAG run.
+def submit(task_name, trigger='One-off'):
+    downstream = storage.get_downstream(task_name)
+    if not downstream:
+        return runner.submit(task_name, trigger)
+    # Everything reachable from task_name takes part in this DAG run
+    upstreams = {task_name: []}
+    pending = [(task_name, downstream)]
+    while pending:
+        upstream, edges = pending.pop()
+        for name, condition in edges:
+            if name not in upstreams:
+                upstreams[name] = []
+                pending.append((name, storage.get_downstream(name)))
+            if name != task_name:
+                upstreams[name].append((upstream, condition))
+    for edges in upstreams.values():
+        edges.sort()
+    scope = set(upstreams)
+    dag_run = {
+        'id': uuid.uuid4().hex,
+        'root': task_name,
+        'trigger': trigger,
+        'status': 'running',
+        'started_at': _now(),
+        'finished_at': None,
+        'levels': _levels(upstreams),
+        'tasks': {name: {'state': 'pending', 'run_id': None, 'upstream': upstreams[name], 'reason': None}
+                  for name in scope},
+    }
+    dag_run['tasks'][task_name]['state'] = 'queued'
+    with _lock:
+        _dag_runs[dag_run['id']] = dag_run
+    run_id = runner.submit(task_name, trigger, dag_run=dag_run['id'])
+    if run_id is None:
+        with _lock:
+            del _dag_runs[dag_run['id']]
+        return None
+    with _lock:
+        dag_run['tasks'][task_name]['run_id'] = run_id
+    return run_id
+
+# Group the tasks of a DAG run by depth (longest path from the root), for display
+def _levels(upstreams):
+    depth = {}
+    remaining = dict(upstreams)
+    while remaining:
+        placed = [name for name, edges in remaining.items() if all(upstream in depth for upstream, _ in edges)]
+        if not placed:
+            break  # a cycle; saving dependencies never lets one form
+        for name in placed:
+            depth[name] = max((depth[upstream] + 1 for upstream, _ in remaining.pop(name)), default=0)
+    levels = {}
+    for name in sorted(depth):
+        levels.setdefault(depth[name], []).append(name)
+    return [levels[level] for level in sorted(levels)]
+
+def _condition_holds(condition, state):
+    if condition == 'always':
+        return True
+    return state == ('succeeded' if condition == 'success' else 'failed')
+
+# Tasks whose upstreams are all done: mark them queued (returned, to be submitted) or skipped
+def _ready(dag_run):
+    ready = []
+    changed = True
+    while changed:
+        changed = False
+        for name, task in dag_run['tasks'].items():
+            if task['state'] != 'pending':
+                continue
+            states = [(condition, dag_run['tasks'][upstream]['state']) for upstream, condition in task['upstream']]
+            if any(state not in FINAL_STATES for _, state in states):
+                continue
+            changed = True
+            if all(_condition_holds(condition, state) for condition, state in states):
+                task['state'] = 'queued'
+                ready.append(name)
+            else:
+                task['state'] = 'skipped'
+                task['reason'] = 'upstream condition not met'
+    return ready
+
+def _finish_if_done(dag_run):
+    if dag_run['finished_at'] or any(t['state'] not in FINAL_STATES for t in dag_run['tasks'].values()):
+        return
+    dag_run['finished_at'] = _now()
+    failed = any(t['state'] == 'failed' for t in dag_run['tasks'].values())
+    dag_run['status'] = 'failed' if failed else 'succeeded'
+    _finished.append(dag_run['id'])
+    while len(_finished) > DAG_RUN_HISTORY:
+        _dag_runs.pop(_finished.popleft(), None)
+
+# Run engine listener: record how a DAG run's task ended and start what is now ready
+def _run_finished(run):
+    if not run.get('dag_run'):
+        return
+    with _lock:
+        dag_run = _dag_runs.get(run['dag_run'])
+        if dag_run is None:
+            return
+        task = dag_run['tasks'][run['task']]
+        task['state'] = 'succeeded' if run['status'] == 'succeeded' else 'failed'
+        task['reason'] = run['error']
+        ready = _ready(dag_run)
+        _finish_if_done(dag_run)
+    while ready:
+        tasks = storage.get_tasks(ready)
+        submitted = {}
+        for name in ready:
+            if name not in tasks:
+                submitted[name] = (None, 'failed', 'Task not found.')
+            elif tasks[name]['status'] != 'enabled':
+                submitted[name] = (None, 'skipped', 'task disabled')
+            else:
+                run_id = runner.submit(name, UPSTREAM_TRIGGER, dag_run=dag_run['id'])
+                submitted[name] = (run_id, None, None) if run_id else (None, 'failed', 'Too many runs already queued')
+        with _lock:
+            for name, (run_id, state, reason) in submitted.items():
+                task = dag_run['tasks'][name]
+                if run_id:
+                    task['run_id'] = run_id
+                else:
+                    task['state'] = state
+                    task['reason'] = reason
+            # Tasks that were not started may make others ready (or skipped)
+            ready = _ready(dag_run)
+            _finish_if_done(dag_run)
+
+runner.add_finish_listener(_run_finished)
+
+def _view(dag_run):
+    view = dict(dag_run)
+    view['tasks'] = {}
+    for name, task in dag_run['tasks'].items():
+        task = dict(task)
+        if task['state'] == 'queued' and task['run_id']:
+            run = runner.get_run(task['run_id'])
+            if run and run['status'] == 'running':
+                task['state'] = 'running'
+        view['tasks'][name] = task
+    return view
+
+def get_dag_run(dag_run_id):
+    with _lock:
+        dag_run = _dag_runs.get(dag_run_id)
+        return _view(dag_run) if dag_run else None
+
+def list_dag_runs():
+    with _lock:
+        dag_runs = [_view(dag_run) for dag_run in _dag_runs.values()]
+    return sorted(dag_runs, key=lambda d: d['started_at'], reverse=True)
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+from apscheduler.executors.base import BaseExecutor, MaxInstancesReachedError, run_job
+import supervisor
+import catchup
+
+_local = threading.local()
+
+# The fire time the job running in this thread was scheduled for (an aware datetime),
+# or None outside a scheduled job. APScheduler does not pass it to the job function.
+def current_fire_time():
+    return getattr(_local, 'fire_time', None)
+
+# The trigger type of the run the job running in this thread starts: 'Scheduled', or
+# catchup.TRIGGER for a missed fire run late by catchup.py
+def current_trigger():
+    return catchup.TRIGGER if getattr(_local, 'catch_up', False) else 'Scheduled'
+
+def _run_job(job, jobstore_alias, run_times, logger_name, catch_up=False):
+    events = []
+    for run_time in run_times:
+        _local.fire_time = run_time
+        _local.catch_up = catch_up
+        try:
+            events.extend(run_job(job, jobstore_alias, [run_time], logger_name))
+        finally:
+            _local.fire_time = None
+            _local.catch_up = False
+    return events
+
+# Job executor on the supervisor's event loop. A fire only occupies a thread for as long as
+# the job function takes (run_task_job just queues a run, or claims a lease in cluster mode);
+# the command itself is supervised on the loop, so slow tasks never starve the scheduler.
+# The job function can see its fire time through current_fire_time().
+# Fires that come due late (missed while botBrigade was down or asleep) are handed to
+# catchup.py, which runs them later by the task's catch-up policy, through _submit_late.
+class SupervisorExecutor(BaseExecutor):
+    def _do_submit_job(self, job, run_times):
+        run_times = catchup.split(job.id, run_times, lambda fire_time: self._submit_late(job, fire_time))
+        # Submitted even when every fire was deferred, so the job's instance count is released
+        supervisor.submit(self._run(job, run_times))
+
+    # Same instance limit as on-time fires (BaseExecutor.submit_job)
+    def _submit_late(self, job, fire_time):
+        with self._lock:
+            if self._instances[job.id] >= job.max_instances:
+                raise MaxInstancesReachedError(job)
+            self._instances[job.id] += 1
+        supervisor.submit(self._run(job, [fire_time], catch_up=True))
+
+    # Queued catch-up runs go with the scheduler (it shuts its executors down)
+    def shutdown(self, wait=True):
+        catchup.clear()
+
+    async def _run(self, job, run_times, catch_up=False):
+        try:
+            events = await asyncio.to_thread(_run_job, job, job._jobstore_alias, run_times, self._logger.name,
+                                             catch_up)
+        except BaseException as e:
+            self._run_job_error(job.id, e, e.__traceback__)
+        else:
+            self._run_job_success(job.id, events)
@@ -0,0 +1,103 @@
+import contextlib
+import pickle
+import threading
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+from sqlalchemy import bindparam, select
+import catchup
+
+# Stand-in for the store's engine while a batch is open: every begin() hands out the
+# batch's connection and leaves the commit to the end of the batch.
+# New jobs are queued in `pending` and written with one executemany before the
+# connection is used for anything else.
+class _BatchEngine:
+    def __init__(self, engine, connection, jobs_t):
+        self._engine = engine
+        self._connection = connection
+        self._jobs_t = jobs_t
+        self.pending = {}  # job id -> row
+
+    def flush(self):
+        if self.pending:
+            self._connection.execute(self._jobs_t.insert(), list(self.pending.values()))
+            self.pending = {}
+
+    def begin(self):
+        self.flush()
+        return contextlib.nullcontext(self._connection)
+
+    def __getattr__(self, name):
+        return getattr(self._engine, name)
+
+# SQLAlchemyJobStore that can group many job writes into one transaction.
+# Outside batch() it behaves like SQLAlchemyJobStore, except that due jobs are first moved
+# past fires too old to catch up (get_due_jobs).
+class BatchingSQLAlchemyJobStore(SQLAlchemyJobStore):
+    def __init__(self, *args, **kwargs):
+        self._batch = None  # (thread id, _BatchEngine) while a batch is open
+        super().__init__(*args, **kwargs)
+        self._job_exists = select(self.jobs_t.c.id).where(self.jobs_t.c.id == bindparam('job_id'))
+
+    def _current_batch(self):
+        batch = self._batch
+        if batch is not None and batch[0] == threading.get_ident():
+            return batch[1]
+        return None
+
+    @property
+    def engine(self):
+        return self._current_batch() or self._engine
+
+    @engine.setter
+    def engine(self, value):
+        self._engine = value
+
+    # Jobs due since before the catch-up window are moved on first (see catchup.fast_forward),
+    # so the scheduler only ever lists a bounded number of missed fires per job
+    def get_due_jobs(self, now):
+        due = []
+        for job in super().get_due_jobs(now):
+            if catchup.fast_forward(job, now):
+                self.update_job(job)
+            if job.next_run_time <= now:
+                due.append(job)
+        return due
+
+    def add_job(self, job):
+        batch = self._current_batch()
+        if batch is None:
+            return super().add_job(job)
+        # Check for id conflicts up front, so the scheduler can still fall back to
+        # update_job for replace_existing, instead of failing at the end of the batch
+        if job.id in batch.pending:
+            raise ConflictingIdError(job.id)
+        if batch._connection.execute(self._job_exists, {'job_id': job.id}).first():
+            raise ConflictingIdError(job.id)
+        batch.pending[job.id] = {
+            'id': job.id,
+            'next_run_time': datetime_to_utc_timestamp(job.next_run_time),
+            'job_state': pickle.dumps(job.__getstate__(), self.pickle_protocol),
+        }
+
+    # Run every add/update/remove made by this thread inside the block as one transaction.
+    # The scheduler's job store lock is held throughout, so the scheduler thread waits
+    # instead of seeing a half-applied batch; lock order matches the scheduler's own.
+    @contextlib.contextmanager
+    def batch(self):
+        if self._scheduler is None:
+            # Not started yet: the scheduler only queues jobs, there is nothing to batch
+            yield
+            return
+        with self._scheduler._jobstores_lock:
+            if self._batch is not None:
+                yield
+                return
+            with self._engine.begin() as connection:
+                batch = _BatchEngine(self._engine, connection, self.jobs_t)
+                self._batch = (threading.get_ident(), batch)
+                try:
+                    yield
+                    batch.flush()
+                finally:
+                    self._batch = None
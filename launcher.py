@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import errno
+import signal
+import resource
+import socket
+import selectors
+import subprocess
+
+import limits
+
+# Launcher: a small helper process that starts task commands for the supervisor.
+# botBrigade itself carries Flask, APScheduler, SQLite caches and run history, so every fork
+# it does (e.g. for a command with rlimits, which needs a preexec_fn) copies a big address
+# space. The launcher is a fresh interpreter that imports only limits.py; it starts commands
+# with posix_spawn, or a fork of its own small process when limits must be applied, reaps
+# them with wait4() and reports their exit status and resource usage back.
+#
+# Protocol: one JSON message per SOCK_SEQPACKET packet.
+#   supervisor -> launcher: {'id', 'args', 'shell', 'limits', 'cgroup'} with the output pipe's
+#                           write end attached (SCM_RIGHTS)
+#   launcher -> supervisor: {'id', 'pid'} or {'id', 'error'} once started,
+#                           then {'id', 'status', 'rusage': [utime, stime, maxrss, own maxrss]}
+#                           when it exits (own maxrss: the launcher's peak RSS, see supervisor._usage)
+# LAUNCHER: set BOTBRIGADE_LAUNCHER=1 to start commands through the launcher (Unix only)
+ENABLED = os.environ.get('BOTBRIGADE_LAUNCHER', '0') == '1'
+SUPPORTED = hasattr(socket, 'send_fds') and hasattr(os, 'posix_spawn')
+MAX_MESSAGE = 65536
+
+# --- Launcher process ---
+
+def _argv(request):
+    return ['/bin/sh', '-c', request['args']] if request['shell'] else request['args']
+
+def _spawn(request, fd):
+    argv = _argv(request)
+    preexec = limits.make_preexec(request['limits'] or {}, request['cgroup'])
+    if preexec is None:
+        # Output goes to the pipe; nothing else of ours is inherited (fds are non-inheritable)
+        return os.posix_spawnp(argv[0], argv, os.environ, setsid=True, file_actions=[
+            (os.POSIX_SPAWN_DUP2, fd, 1), (os.POSIX_SPAWN_DUP2, fd, 2)])
+    # Limits are applied between fork and exec; forking this process is cheap
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            preexec()
+            os.execvp(argv[0], argv)
+        except BaseException as e:
+            try:
+                os.write(2, f"{argv[0]}: {e}\n".encode())
+            finally:
+                os._exit(127)
+    return pid
+
+def serve(sock):
+    sock.set_inheritable(False)
+    children = {}  # pid -> request id
+    # SIGCHLD wakes the selector; children are reaped without blocking
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, 'request')
+    selector.register(wakeup_read, selectors.EVENT_READ, 'child')
+
+    connected = True
+
+    # botBrigade went away: stop taking requests, but keep reaping what is running
+    def disconnect():
+        nonlocal connected
+        if connected:
+            selector.unregister(sock)
+            connected = False
+
+    def reply(message):
+        if not connected:
+            return
+        try:
+            sock.send(json.dumps(message).encode())
+        except OSError:
+            disconnect()
+
+    def reap():
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            request_id = children.pop(pid, None)
+            if request_id is not None:
+                reply({'id': request_id, 'status': status,
+                       'rusage': [rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]})
+
+    while connected or children:
+        for key, _ in selector.select():
+            if key.data == 'child':
+                try:
+                    while os.read(wakeup_read, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                reap()
+                continue
+            if not connected:
+                continue
+            try:
+                data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 1)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                data, fds = b'', []
+            if not data:
+                disconnect()
+                continue
+            for fd in fds:
+                os.set_inheritable(fd, False)
+            request = json.loads(data)
+            try:
+                pid = _spawn(request, fds[0])
+                children[pid] = request['id']
+                reply({'id': request['id'], 'pid': pid})
+            except Exception as e:
+                reply({'id': request['id'], 'error': str(e)})
+            finally:
+                for fd in fds:
+                    os.close(fd)
+        if not connected:
+            reap()
+
+# --- Client, used by the supervisor on its event loop ---
+
+# Path of this file, started as a script so the launcher imports nothing else of ours
+LAUNCHER_PATH = os.path.abspath(__file__)
+
+class Launcher:
+    def __init__(self):
+        self._sock = None
+        self._proc = None
+        self._next_id = 0
+        self._pending = {}  # request id -> [spawned future, exited future]
+
+    # Start the launcher process and listen for its replies on the running loop
+    def start(self, loop):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._proc = subprocess.Popen([sys.executable, '-S', LAUNCHER_PATH, str(theirs.fileno())],
+                                          pass_fds=[theirs.fileno()], stdin=subprocess.DEVNULL)
+        finally:
+            theirs.close()
+        self._sock = ours
+        self._loop = loop
+        loop.add_reader(ours.fileno(), self._on_message)
+
+    @property
+    def alive(self):
+        return self._sock is not None
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        self._fail_pending('launcher stopped')
+        # It exits once the commands it started have exited
+        self._proc = None
+
+    def _fail_pending(self, message):
+        for futures in self._pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(OSError(message))
+        self._pending.clear()
+
+    def _on_message(self):
+        try:
+            data = self._sock.recv(MAX_MESSAGE)
+        except OSError:
+            data = b''
+        if not data:
+            self.close()
+            return
+        message = json.loads(data)
+        futures = self._pending.get(message['id'])
+        if futures is None:
+            return
+        spawned, exited = futures
+        if 'error' in message:
+            del self._pending[message['id']]
+            spawned.set_exception(OSError(message['error']))
+        elif 'pid' in message:
+            spawned.set_result(message['pid'])
+        else:
+            del self._pending[message['id']]
+            exited.set_result((message['status'], message['rusage']))
+
+    # Start a command writing to fd (which the caller keeps and closes).
+    # Returns (pid, future of (wait status, [utime, stime, maxrss, own maxrss])).
+    async def spawn(self, args, shell, fd, task=None, cgroup=None):
+        if self._sock is None:
+            raise OSError('launcher is not running')
+        self._next_id += 1
+        request_id = self._next_id
+        spawned = self._loop.create_future()
+        exited = self._loop.create_future()
+        self._pending[request_id] = [spawned, exited]
+        request = {'id': request_id, 'args': args, 'shell': shell, 'cgroup': cgroup,
+                   'limits': {field: task.get(field) for field in limits.PREEXEC_FIELDS} if task else None}
+        try:
+            socket.send_fds(self._sock, [json.dumps(request).encode()], [fd])
+        except OSError:
+            del self._pending[request_id]
+            raise
+        try:
+            pid = await spawned
+        except BaseException:
+            self._pending.pop(request_id, None)
+            raise
+        return pid, exited
+
+if __name__ == '__main__':
+    serve(socket.socket(fileno=int(sys.argv[1])))
@@ -0,0 +1,259 @@
+import os
+import sys
+import signal
+import logging
+import platform
+import time
+
+# rlimits and process priorities are Unix-only
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Per-task resource limits, stored with the task (storage.LIMIT_FIELDS) and applied to
+# every run of its command, whichever way the run was started:
+# timeout: seconds before the command's process group is killed (default runner.RUN_TIMEOUT)
+# cpu_limit: CPU seconds (RLIMIT_CPU). The command gets SIGXCPU at the limit, and SIGKILL
+#   CPU_GRACE seconds later if it ignores that
+# memory_limit: MiB of address space (RLIMIT_AS); allocations beyond it fail
+# nice: scheduling priority, -20 (highest) to 19 (lowest); below 0 needs privileges
+# ionice: 'idle', or 'best-effort' with an optional level 0-7 (e.g. 'best-effort:7'); Linux only
+# cgroup_cpu / cgroup_memory: CPUs and MiB for a cgroup v2 group per run (Linux only, see below).
+#   Unlike rlimits these cover every process the command starts, together
+CPU_GRACE = 5
+# The limits make_preexec applies in the child
+PREEXEC_FIELDS = ('cpu_limit', 'memory_limit', 'nice', 'ionice')
+
+# cgroup v2 groups are created under CGROUP_ROOT, which botBrigade must be allowed to write to
+# (e.g. a delegated systemd slice). If a group can't be set up, the run goes ahead without it.
+CGROUP_ROOT = os.environ.get('BOTBRIGADE_CGROUP_ROOT', '/sys/fs/cgroup/botbrigade')
+CGROUP_PERIOD = 100000  # cpu.max period, microseconds
+
+MIB = 1024 * 1024
+IONICE_CLASSES = {'best-effort': 2, 'idle': 3}
+# ioprio_set has no Python binding; syscall numbers for the architectures we know
+IOPRIO_SET = {'x86_64': 251, 'aarch64': 30}.get(platform.machine())
+
+# --- Parsing (task form and CSV import) ---
+
+def _number(value, field, convert, minimum=None, maximum=None):
+    try:
+        number = convert(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a number, not '{value}'.")
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        raise ValueError(f"{field} must be between {minimum} and {maximum}." if maximum is not None
+                         else f"{field} must be at least {minimum}.")
+    return number
+
+def _ionice(value):
+    io_class, _, level = value.partition(':')
+    if io_class not in IONICE_CLASSES or (level and io_class == 'idle'):
+        raise ValueError(f"ionice must be 'idle' or 'best-effort[:0-7]', not '{value}'.")
+    if level:
+        _number(level, 'ionice level', int, 0, 7)
+    return value
+
+# Turn form/CSV values (strings, blank for no limit) into stored limit values.
+# Raises ValueError with a message for the user.
+def parse(values):
+    parsers = {
+        'timeout': lambda v: _number(v, 'Timeout', int, 1),
+        'cpu_limit': lambda v: _number(v, 'CPU time limit', int, 1),
+        'memory_limit': lambda v: _number(v, 'Memory limit', int, 1),
+        'nice': lambda v: _number(v, 'Nice', int, -20, 19),
+        'ionice': _ionice,
+        'cgroup_cpu': lambda v: _number(v, 'cgroup CPUs', float, 0.01),
+        'cgroup_memory': lambda v: _number(v, 'cgroup memory', int, 1),
+    }
+    limits = {}
+    for field, parse_value in parsers.items():
+        value = (values.get(field) or '').strip()
+        limits[field] = parse_value(value) if value else None
+    return limits
+
+# Human-readable summary for the task log, or '' if the task has no limits
+def describe(task):
+    parts = []
+    for field, label, unit in (('timeout', 'timeout', 's'), ('cpu_limit', 'cpu', 's'),
+                               ('memory_limit', 'memory', 'MiB'), ('nice', 'nice', ''),
+                               ('ionice', 'ionice', ''), ('cgroup_cpu', 'cgroup cpus', ''),
+                               ('cgroup_memory', 'cgroup memory', 'MiB')):
+        if task.get(field) is not None:
+            parts.append(f"{label}={task[field]}{unit}")
+    return ' '.join(parts)
+
+# --- Applying limits in the child, between fork and exec ---
+
+def _ioprio(value):
+    io_class, _, level = value.partition(':')
+    return IONICE_CLASSES[io_class] << 13 | int((level or 4) if io_class == 'best-effort' else 0)
+
+def _ioprio_set():
+    if IOPRIO_SET is None or not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    return lambda ioprio: syscall(IOPRIO_SET, 1, 0, ioprio)  # IOPRIO_WHO_PROCESS, this process
+
+def _rlimit(kind, soft, hard):
+    # Never ask for more than the current hard limit allows
+    _, current_hard = resource.getrlimit(kind)
+    if current_hard != resource.RLIM_INFINITY:
+        soft, hard = min(soft, current_hard), min(hard, current_hard)
+    return kind, (soft, hard)
+
+# Build the preexec_fn for a task's command, or None if it needs none (so subprocess can
+# keep using its fast spawn path). Everything that can fail in an unexpected way is worked
+# out here, in the parent; the child only makes system calls.
+def make_preexec(task, cgroup=None):
+    rlimits = []
+    if resource is not None:
+        if task.get('cpu_limit'):
+            rlimits.append(_rlimit(resource.RLIMIT_CPU, task['cpu_limit'], task['cpu_limit'] + CPU_GRACE))
+        if task.get('memory_limit') and hasattr(resource, 'RLIMIT_AS'):
+            size = task['memory_limit'] * MIB
+            rlimits.append(_rlimit(resource.RLIMIT_AS, size, size))
+    nice = task.get('nice')
+    ioprio_set = _ioprio_set() if task.get('ionice') else None
+    ioprio = _ioprio(task['ionice']) if ioprio_set else None
+    procs_file = os.path.join(cgroup, 'cgroup.procs') if cgroup else None
+    if not (rlimits or nice is not None or ioprio_set or procs_file):
+        return None
+
+    def preexec():
+        if procs_file:
+            # Join the run's cgroup before exec, so every process the command starts is in it.
+            # If that's not allowed the command runs anyway; cgroup_joined() reports it after.
+            try:
+                fd = os.open(procs_file, os.O_WRONLY)
+                try:
+                    os.write(fd, b'0')
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        for kind, value in rlimits:
+            resource.setrlimit(kind, value)
+        if nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        if ioprio_set:
+            ioprio_set(ioprio)
+
+    return preexec
+
+# --- cgroup v2 ---
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+# Create a cgroup for one run with the task's caps. Returns its path, or None if the task has
+# no cgroup caps. Raises OSError if the group can't be set up.
+def create_cgroup(task, run_id):
+    if not task.get('cgroup_cpu') and not task.get('cgroup_memory'):
+        return None
+    if not sys.platform.startswith('linux'):
+        raise OSError('cgroup limits need Linux')
+    # Only ever create directories inside a cgroup v2 hierarchy
+    if not os.path.isdir(CGROUP_ROOT):
+        if not os.path.exists(os.path.join(os.path.dirname(CGROUP_ROOT), 'cgroup.controllers')):
+            raise OSError(f"{os.path.dirname(CGROUP_ROOT)} is not in a cgroup v2 hierarchy")
+        os.mkdir(CGROUP_ROOT)
+    elif not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        raise OSError(f"{CGROUP_ROOT} is not in a cgroup v2 hierarchy")
+    try:
+        # Let run groups use the cpu and memory controllers (may already be on)
+        _write(os.path.join(CGROUP_ROOT, 'cgroup.subtree_control'), '+cpu +memory')
+    except OSError:
+        pass
+    path = os.path.join(CGROUP_ROOT, run_id)
+    os.mkdir(path)
+    try:
+        if task.get('cgroup_cpu'):
+            quota = max(int(task['cgroup_cpu'] * CGROUP_PERIOD), 1000)
+            _write(os.path.join(path, 'cpu.max'), f"{quota} {CGROUP_PERIOD}")
+        if task.get('cgroup_memory'):
+            _write(os.path.join(path, 'memory.max'), str(task['cgroup_memory'] * MIB))
+            try:
+                # Kill at the cap rather than swap
+                _write(os.path.join(path, 'memory.swap.max'), '0')
+            except OSError:
+                pass
+    except OSError:
+        remove_cgroup(path)
+        raise
+    return path
+
+# How many processes in the group the kernel killed for going over memory.max
+def cgroup_oom_kills(path):
+    try:
+        with open(os.path.join(path, 'memory.events')) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if key == 'oom_kill':
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+# Peak memory use of everything that ran in the group, in KiB (memory.peak, Linux 5.19+), or None
+def cgroup_memory_peak(path):
+    try:
+        with open(os.path.join(path, 'memory.peak')) as f:
+            return int(f.read()) // 1024
+    except (OSError, ValueError):
+        return None
+
+# Whether anything ever ran in the group (its CPU usage is counted even without the cpu controller)
+def cgroup_joined(path):
+    try:
+        with open(os.path.join(path, 'cpu.stat')) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if key == 'usage_usec':
+                    return int(value) > 0
+    except (OSError, ValueError):
+        pass
+    return False
+
+# Kill whatever the command left running in the group and remove it
+def remove_cgroup(path):
+    try:
+        _write(os.path.join(path, 'cgroup.kill'), '1')
+    except OSError:
+        pass  # cgroup.kill is Linux 5.14+; the command's process group was killed already
+    for _ in range(20):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.05)  # still has processes on their way out
+    logging.warning(f"Could not remove cgroup {path}")
+
+# --- After the run ---
+
+# Why a run was killed, if it was killed by one of its limits, else None.
+# result is what supervisor.stream_command returned.
+def kill_reason(task, result, oom_kills=0):
+    if result['timed_out']:
+        return 'timeout'
+    if result.get('stopped'):
+        return 'shutdown'
+    if oom_kills:
+        return 'cgroup memory limit'
+    returncode = result['returncode']
+    if task.get('cpu_limit'):
+        # -SIGXCPU when the command itself was killed, 128+SIGXCPU when the shell reports
+        # that a child was; SIGKILL after the grace period if it kept running
+        xcpu = getattr(signal, 'SIGXCPU', None)
+        if xcpu and returncode in (-xcpu, 128 + xcpu):
+            return 'cpu limit'
+        usage = result.get('usage') or {}
+        cpu = (usage.get('cpu_user') or 0) + (usage.get('cpu_system') or 0)
+        if returncode in (-signal.SIGKILL, 128 + signal.SIGKILL) and cpu >= task['cpu_limit']:
+            return 'cpu limit'
+    return None
@@ -0,0 +1,127 @@
+import os
+import re
+import codecs
+import logging
+import sqlite3
+import threading
+import storage
+import logstore
+import runner
+
+# Full-text search over the output of every run
+# Each finished run's output is read back from its log segment and indexed in the run_text
+# FTS5 table in tasks.db, in chunks of INDEX_CHUNK_BYTES split at line ends. Only what the
+# command wrote is indexed, not the lines botBrigade adds around it (runs recorded before
+# storage.RUN_TEXT_COLUMNS existed are indexed whole). A query matches a run when each of its
+# terms is anywhere in the run's output, in whichever chunk. New runs are
+# indexed as they finish; runs recorded before the index existed are backfilled in the
+# background, BACKFILL_BATCH runs at a time, resuming where it left off after a restart.
+# Searches join the matches with the runs table, so they can be narrowed by task, start
+# time and return code, and runs dropped by log retention drop out of the index with them.
+# INDEX_MAX_BYTES: how much of each run's output is indexed (the rest is not searchable)
+INDEX_MAX_BYTES = int(os.environ.get('BOTBRIGADE_SEARCH_MAX_BYTES', str(4 * 1024 * 1024)))
+INDEX_CHUNK_BYTES = 64 * 1024
+BACKFILL_BATCH = 200
+BACKFILL_KEY = 'search_backfilled_through'
+
+_backfill_thread = None
+
+# The output of a run as text chunks of about INDEX_CHUNK_BYTES, each ending at a line end
+# where there is one
+def _chunks(run):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    chunks = []
+    if run['text_offset'] is not None:
+        offset, length = run['text_offset'], run['text_length']
+    else:
+        offset, length = run['output_offset'], run['output_length']
+    for data in logstore.iter_output(run['output_path'], offset, length, INDEX_CHUNK_BYTES, INDEX_MAX_BYTES):
+        pending += decoder.decode(data)
+        cut = pending.rfind('\n') + 1 or len(pending)
+        chunks.append(pending[:cut])
+        pending = pending[cut:]
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        chunks.append(pending)
+    return chunks
+
+def index_run(run_id):
+    run = storage.get_run_record(run_id)
+    if run is None or run['finished_at'] is None:
+        return
+    try:
+        chunks = _chunks(run)
+    except OSError as e:
+        logging.warning(f"Could not index output of run {run_id} of task {run['task_name']}: {e}")
+        return
+    storage.index_run_text(run_id, chunks)
+
+def _run_finished(run):
+    if storage.search_available() and run['record_id'] is not None:
+        index_run(run['record_id'])
+
+runner.add_finish_listener(_run_finished)
+
+# Index every recorded run that is not indexed yet, oldest first
+def backfill():
+    if not storage.search_available():
+        return
+    after_id = int(storage.get_meta(BACKFILL_KEY, 0))
+    while True:
+        runs = storage.runs_after(after_id, BACKFILL_BATCH)
+        if not runs:
+            return
+        for run in runs:
+            if not storage.run_text_indexed(run['id']):
+                index_run(run['id'])
+        after_id = runs[-1]['id']
+        storage.set_meta(BACKFILL_KEY, after_id)
+
+def start_backfill():
+    global _backfill_thread
+    if _backfill_thread is not None and _backfill_thread.is_alive():
+        return
+
+    def work():
+        try:
+            backfill()
+        except Exception:
+            logging.exception("Backfilling the log search index failed")
+        finally:
+            storage.close_connection()
+
+    _backfill_thread = threading.Thread(target=work, name='log-search-backfill', daemon=True)
+    _backfill_thread.start()
+
+# --- Searching ---
+QUERY_TERM_RE = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+
+# Turn what the user typed into FTS5 terms, as (wanted, unwanted): every word or "quoted
+# phrase" must appear, word* matches words starting with word, and -word leaves out runs
+# containing it. Raises ValueError with a message for the user.
+def parse_query(text):
+    wanted = []
+    unwanted = []
+    for exclude, phrase, word in QUERY_TERM_RE.findall(text or ''):
+        term = phrase if phrase else word
+        prefix = not phrase and term.endswith('*')
+        term = term.rstrip('*') if prefix else term
+        if not term.strip():
+            continue
+        term = '"' + term.replace('"', '""') + '"' + ('*' if prefix else '')
+        (unwanted if exclude else wanted).append(term)
+    if not wanted:
+        raise ValueError('Enter at least one word to search for.')
+    return wanted, unwanted
+
+# Runs whose output matches query, newest first, as (runs, total). Each run carries a
+# 'snippet' with the matched terms between storage.MATCH_START and storage.MATCH_END.
+def search(query, task_name=None, since=None, until=None, returncode=None, limit=50, offset=0):
+    if not storage.search_available():
+        raise ValueError('Log search needs SQLite with FTS5, which this Python does not have.')
+    wanted, unwanted = parse_query(query)
+    try:
+        return storage.search_run_text(wanted, unwanted, task_name, since, until, returncode, limit, offset)
+    except sqlite3.OperationalError as e:
+        raise ValueError(f'Could not search for {query!r}: {e}')
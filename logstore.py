@@ -0,0 +1,286 @@
+import os
+import re
+import gzip
+import shutil
+import time
+from datetime import datetime, timedelta
+import storage
+
+# zstd compression is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGS_DIR = 'logs'
+
+# Size of the reads used when streaming run output and following a log
+CHUNK_SIZE = 64 * 1024
+# How often a live tail checks the log file for new output (seconds)
+FOLLOW_INTERVAL = 0.5
+
+# Log rotation (override with environment variables)
+# Each task writes to logs/<task>.log. Before a run starts, that file is closed into a
+# numbered segment logs/<task>.log.<n> once it is LOG_MAX_BYTES big or its oldest run is
+# LOG_MAX_AGE_DAYS old (0 disables the age check). Closed segments are compressed with
+# LOG_COMPRESSION ('gzip', 'zstd' or 'none') and only the newest LOG_KEEP_SEGMENTS closed
+# segments of each task are kept (or the task's own log_keep_segments); runs whose output was
+# in a dropped segment are deleted.
+LOG_MAX_BYTES = int(os.environ.get('BOTBRIGADE_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_MAX_AGE_DAYS = float(os.environ.get('BOTBRIGADE_LOG_MAX_AGE_DAYS', '7'))
+LOG_KEEP_SEGMENTS = int(os.environ.get('BOTBRIGADE_LOG_KEEP_SEGMENTS', '10'))
+LOG_COMPRESSION = os.environ.get('BOTBRIGADE_LOG_COMPRESSION', 'gzip')
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+def log_file_name(task_name):
+    return f"{task_name}.log"
+
+def log_path(task_name):
+    return os.path.join(LOGS_DIR, log_file_name(task_name))
+
+# Open a task log for appending raw bytes; output is written exactly as the command produced it
+def open_log(task_name):
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    return open(log_path(task_name), 'ab')
+
+# Closed segments of a task as (number, file name), oldest first
+def list_segments(task_name):
+    if not os.path.isdir(LOGS_DIR):
+        return []
+    pattern = re.compile(re.escape(log_file_name(task_name)) + r'\.(\d+)(\.gz|\.zst)?$')
+    segments = []
+    for file_name in os.listdir(LOGS_DIR):
+        match = pattern.match(file_name)
+        if match:
+            segments.append((int(match.group(1)), file_name))
+    return sorted(segments)
+
+# Close the active log into a new segment if it is too big or too old.
+# Must only be called while no run of the task is writing to the log.
+def rotate_if_needed(task_name):
+    path = log_path(task_name)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    too_big = size >= LOG_MAX_BYTES
+    too_old = False
+    if not too_big and LOG_MAX_AGE_DAYS > 0 and size:
+        oldest = storage.oldest_run_started(log_file_name(task_name))
+        too_old = oldest is not None and oldest < (datetime.now() - timedelta(days=LOG_MAX_AGE_DAYS)).isoformat()
+    if not (too_big or too_old):
+        return False
+    rotate(task_name)
+    return True
+
+def rotate(task_name):
+    segments = list_segments(task_name)
+    number = segments[-1][0] + 1 if segments else 1
+    segment_name = f"{log_file_name(task_name)}.{number}"
+    os.rename(log_path(task_name), os.path.join(LOGS_DIR, segment_name))
+    storage.set_run_output_path(log_file_name(task_name), segment_name)
+    _compress_segment(segment_name)
+    _apply_retention(task_name)
+
+def _compress_segment(segment_name):
+    if LOG_COMPRESSION == 'gzip':
+        compressed_name = segment_name + '.gz'
+        opener = lambda path: gzip.open(path, 'wb')
+    elif LOG_COMPRESSION == 'zstd' and zstandard is not None:
+        compressed_name = segment_name + '.zst'
+        opener = lambda path: zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    else:
+        return
+    source = os.path.join(LOGS_DIR, segment_name)
+    target = os.path.join(LOGS_DIR, compressed_name)
+    with open(source, 'rb') as src, opener(target + '.tmp') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.rename(target + '.tmp', target)
+    storage.set_run_output_path(segment_name, compressed_name)
+    os.remove(source)
+
+# A task's log_keep_segments from a form or CSV value, or None for the default
+def parse_keep_segments(text):
+    text = (text or '').strip()
+    if not text:
+        return None
+    try:
+        keep = int(text)
+    except ValueError:
+        raise ValueError(f"Log segments kept must be a number, not '{text}'.")
+    if keep < 0:
+        raise ValueError('Log segments kept must be at least 0.')
+    return keep
+
+# How many closed segments of the task are kept
+def keep_segments(task_name):
+    task = storage.get_task(task_name)
+    keep = task.get('log_keep_segments') if task else None
+    return LOG_KEEP_SEGMENTS if keep is None else keep
+
+def _apply_retention(task_name):
+    segments = list_segments(task_name)
+    for _, file_name in segments[:max(len(segments) - keep_segments(task_name), 0)]:
+        storage.delete_runs_by_output_path(file_name)
+        os.remove(os.path.join(LOGS_DIR, file_name))
+
+# Move a task's active log and all of its segments to the new name,
+# and repoint the recorded runs at them
+def rename_log(old_name, new_name):
+    old_prefix = log_file_name(old_name)
+    new_prefix = log_file_name(new_name)
+    files = [file_name for _, file_name in list_segments(old_name)]
+    if os.path.exists(log_path(old_name)):
+        files.append(old_prefix)
+    for file_name in files:
+        new_file_name = new_prefix + file_name[len(old_prefix):]
+        os.rename(os.path.join(LOGS_DIR, file_name), os.path.join(LOGS_DIR, new_file_name))
+        storage.set_run_output_path(file_name, new_file_name)
+
+def log_size(task_name):
+    try:
+        return os.path.getsize(log_path(task_name))
+    except OSError:
+        return 0
+
+# Yield (offset, chunk) pairs of bytes appended to a task log from offset onwards.
+# Stops once the file is drained and is_running() reports the task has finished.
+# If the log was rotated underneath us, carry on from the start of the new file.
+def follow(task_name, offset, is_running):
+    path = log_path(task_name)
+    while True:
+        running = is_running()
+        drained = True
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0
+                f.seek(offset)
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    drained = False
+                    yield offset, chunk
+        if drained and not running:
+            return
+        if drained:
+            time.sleep(FOLLOW_INTERVAL)
+
+# Largest slice of a single run's output shown on the log page
+MAX_ENTRY_BYTES = 256 * 1024
+
+def _open_output(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise OSError('zstandard is not installed')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+# Read the output of one run from its log segment without loading the rest of the log.
+# Compressed segments are decompressed as a stream up to the offset, never as a whole.
+def read_output(output_path, offset, length, limit=MAX_ENTRY_BYTES):
+    if not output_path or offset is None:
+        return ''
+    path = os.path.join(LOGS_DIR, output_path)
+    if not os.path.exists(path):
+        return ''
+    if length is None:
+        # Still running, so the output is at the end of the (uncompressed) active log
+        length = max(0, os.path.getsize(path) - offset)
+    try:
+        with _open_output(path) as f:
+            f.seek(offset)
+            data = f.read(min(length, limit))
+    except OSError as e:
+        return f"Could not read output from {output_path}: {e}"
+    text = data.decode('utf-8', errors='replace')
+    if length > limit:
+        text += f"\n... output truncated, showing the first {limit} of {length} bytes"
+    return text
+
+# Yield the output of one finished run in pieces of at most chunk_size bytes, at most limit
+# bytes in all, so even a huge run is read in bounded memory
+def iter_output(output_path, offset, length, chunk_size=CHUNK_SIZE, limit=None):
+    if not output_path or offset is None or not length:
+        return
+    path = os.path.join(LOGS_DIR, output_path)
+    if not os.path.exists(path):
+        return
+    remaining = length if limit is None else min(length, limit)
+    with _open_output(path) as f:
+        f.seek(offset)
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+# --- One-time import of log files written before the runs table existed ---
+LEGACY_IMPORT_KEY = 'legacy_logs_imported'
+HEADER_RE = re.compile(rb'^--- (.+?) run at (\S+) ---\r?\n?$')
+RETURN_CODE_RE = re.compile(rb'^Return code: (-?\d+)')
+
+def import_legacy_logs():
+    if storage.get_meta(LEGACY_IMPORT_KEY):
+        return
+    storage.import_runs(_scan_legacy_logs(), LEGACY_IMPORT_KEY)
+
+def _scan_legacy_logs():
+    if not os.path.isdir(LOGS_DIR):
+        return
+    for file_name in sorted(os.listdir(LOGS_DIR)):
+        if file_name.endswith('.log'):
+            yield from _scan_legacy_log(file_name)
+
+# Walk a log line by line and yield one run per '--- <type> run at <time> ---' header line.
+# Older entries put 'Return code:' right after 'Command:', newer ones after the output.
+def _scan_legacy_log(file_name):
+    task_name = file_name[:-len('.log')]
+    entry = None
+    offset = 0
+
+    def finish(entry, end):
+        first_code = entry.pop('first_code')
+        last_code = entry.pop('last_code')
+        if first_code and first_code[0] == 1:
+            entry['returncode'] = first_code[1]
+        elif last_code:
+            entry['returncode'] = last_code[1]
+        entry['output_length'] = end - entry['output_offset']
+        entry.pop('line_no')
+        return entry
+
+    with open(os.path.join(LOGS_DIR, file_name), 'rb') as f:
+        for line in f:
+            header = HEADER_RE.match(line)
+            if header:
+                if entry:
+                    yield finish(entry, offset)
+                entry = {
+                    'task_name': task_name,
+                    'trigger_type': header.group(1).decode('utf-8', errors='replace'),
+                    'started_at': header.group(2).decode('utf-8', errors='replace'),
+                    'finished_at': header.group(2).decode('utf-8', errors='replace'),
+                    'returncode': None,
+                    'duration': None,
+                    'output_path': file_name,
+                    'output_offset': offset + len(line),
+                    'line_no': 0,
+                    'first_code': None,
+                    'last_code': None,
+                }
+            elif entry:
+                code = RETURN_CODE_RE.match(line)
+                if code:
+                    entry['last_code'] = (entry['line_no'], int(code.group(1)))
+                    entry['first_code'] = entry['first_code'] or entry['last_code']
+                entry['line_no'] += 1
+            offset += len(line)
+    if entry:
+        yield finish(entry, offset)
@@ -0,0 +1,128 @@
+import os
+import threading
+
+# In-process run and scheduler metrics, served as Prometheus text at /metrics.
+# Set BOTBRIGADE_METRICS=0 to turn collection off.
+ENABLED = os.environ.get('BOTBRIGADE_METRICS', '1') != '0'
+
+# Histogram bucket upper bounds (seconds)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# name -> (type, help, buckets); rendered in this order
+METRICS = {
+    'botbrigade_runs_queued': ('gauge', 'Runs waiting for a worker or a per-task slot.', None),
+    'botbrigade_runs_in_flight': ('gauge', 'Runs currently executing.', None),
+    'botbrigade_runs_rejected_total': ('counter', 'Runs rejected because the task queue was full.', None),
+    'botbrigade_run_exit_codes_total': ('counter', 'Finished runs by exit code ("error" if the run could not finish).', None),
+    'botbrigade_run_duration_seconds': ('histogram', 'Time from a run starting to it finishing.', DURATION_BUCKETS),
+    'botbrigade_run_start_lag_seconds': (
+        'histogram', 'Time from when a run was meant to start (fire time, or when it was queued) to it starting.',
+        LAG_BUCKETS),
+    'botbrigade_job_misfires_total': ('counter', 'Scheduled fire times skipped because they were too late.', None),
+    'botbrigade_job_errors_total': ('counter', 'Scheduled jobs that raised instead of queueing a run.', None),
+}
+
+_lock = threading.Lock()
+_values = {}  # (name, labels) -> number, or [bucket counts..., sum, count] for histograms
+
+def _add(name, labels, amount=1):
+    key = (name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+def _observe(name, labels, value):
+    buckets = METRICS[name][2]
+    key = (name, labels)
+    with _lock:
+        series = _values.get(key)
+        if series is None:
+            series = _values[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+# --- Recording, called from the run engine and the scheduler ---
+
+def run_queued(task_name):
+    if ENABLED:
+        _add('botbrigade_runs_queued', (('task', task_name),))
+
+def run_rejected(task_name):
+    if ENABLED:
+        _add('botbrigade_runs_rejected_total', (('task', task_name),))
+
+def run_started(task_name):
+    if ENABLED:
+        _add('botbrigade_runs_queued', (('task', task_name),), -1)
+        _add('botbrigade_runs_in_flight', (('task', task_name),))
+
+# A queued run dropped at shutdown
+def run_cancelled(task_name):
+    if ENABLED:
+        _add('botbrigade_runs_queued', (('task', task_name),), -1)
+
+def run_start_lag(task_name, trigger, lag):
+    if ENABLED:
+        _observe('botbrigade_run_start_lag_seconds', (('task', task_name), ('trigger', trigger)), max(lag, 0))
+
+def run_finished(task_name, duration, returncode):
+    if ENABLED:
+        labels = (('task', task_name),)
+        _add('botbrigade_runs_in_flight', labels, -1)
+        _observe('botbrigade_run_duration_seconds', labels, duration)
+        code = 'error' if returncode is None else str(returncode)
+        _add('botbrigade_run_exit_codes_total', labels + (('code', code),))
+
+def job_missed(task_name):
+    if ENABLED:
+        _add('botbrigade_job_misfires_total', (('task', task_name),))
+
+def job_error(task_name):
+    if ENABLED:
+        _add('botbrigade_job_errors_total', (('task', task_name),))
+
+def reset():
+    with _lock:
+        _values.clear()
+
+# --- Exposition ---
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+def _format_number(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+# Prometheus text exposition format (version 0.0.4)
+def render():
+    with _lock:
+        snapshot = {key: (list(v) if isinstance(v, list) else v) for key, v in _values.items()}
+    by_name = {}
+    for (name, labels), value in snapshot.items():
+        by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name.get(name, ())):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-2] + [value[-1] - sum(value[:-2])]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(value[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,28 @@
+import time
+
+# Start-rate limiter (GCRA, the "virtual scheduling" form of a token bucket): lets `burst`
+# events through at once, then `rate` per second. reserve() books the caller the next free
+# slot and returns how long to wait for it, so concurrent callers are served in the order
+# they asked, each waiting on its own (time.sleep or asyncio.sleep), without a lock or timer.
+# A rate of 0 means unlimited.
+class RateLimiter:
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._clock = clock
+        self._next = 0.0  # when the bucket is next empty enough for one more event
+
+    # Seconds the caller has to wait before its event may happen
+    def reserve(self, now=None):
+        if self.rate <= 0:
+            return 0.0
+        now = self._clock() if now is None else now
+        interval = 1 / self.rate
+        start = max(self._next, now)
+        wait = max(start - (self.burst - 1) * interval - now, 0.0)
+        self._next = start + interval
+        return wait
+
+    # The times at which events wanted at `times` (seconds, ascending) would happen
+    def schedule(self, times):
+        return [t + self.reserve(t) for t in times]
@@ -0,0 +1,321 @@
+import os
+import asyncio
+import logging
+import shlex
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+import storage
+import logstore
+import limits
+import metrics
+import supervisor
+import runstatus
+from ratelimit import RateLimiter
+
+LOGS_DIR = logstore.LOGS_DIR
+
+# Run engine limits (override with environment variables)
+# MAX_WORKERS: how many task commands may run at the same time across all tasks. Commands are
+#   supervised by one asyncio loop (supervisor.py), not a thread each, so this can be in the thousands
+# PER_TASK_LIMIT: how many runs of the same task may run at the same time
+# MAX_PENDING_PER_TASK: how many runs of one task may wait for a free slot; extra submissions are rejected
+# RUN_HISTORY: how many finished runs are kept in memory for the /runs status endpoint
+MAX_WORKERS = int(os.environ.get('BOTBRIGADE_MAX_WORKERS', '4'))
+PER_TASK_LIMIT = int(os.environ.get('BOTBRIGADE_PER_TASK_LIMIT', '1'))
+MAX_PENDING_PER_TASK = int(os.environ.get('BOTBRIGADE_MAX_PENDING_PER_TASK', '1'))
+RUN_HISTORY = int(os.environ.get('BOTBRIGADE_RUN_HISTORY', '500'))
+# Timeout for tasks that don't set their own (see limits.py)
+RUN_TIMEOUT = int(os.environ.get('BOTBRIGADE_RUN_TIMEOUT', '3600'))
+# START_RATE: how many runs may start per second across all tasks (0: no limit), after a burst
+#   of START_BURST. Runs over the rate stay queued until their turn, so a burst of fires becomes
+#   a steady stream of forks and database writes
+START_RATE = float(os.environ.get('BOTBRIGADE_START_RATE', '0'))
+START_BURST = int(os.environ.get('BOTBRIGADE_START_BURST', '10'))
+# SHUTDOWN_GRACE: seconds shutdown() gives running commands to finish before they are terminated
+SHUTDOWN_GRACE = float(os.environ.get('BOTBRIGADE_SHUTDOWN_GRACE', '30'))
+
+_lock = threading.Lock()
+_slots = None         # asyncio.Semaphore(MAX_WORKERS), created on the supervisor loop
+_runs = {}            # run_id -> run record
+_finished = deque()   # finished run ids, oldest first (bounded by RUN_HISTORY)
+_active = {}          # task_name -> number of runs holding a per-task slot
+_waiting = {}         # task_name -> deque of run ids waiting for a per-task slot
+_start_times = {}     # run_id -> [planned, started] epoch seconds, until its start lag is recorded
+_finish_listeners = []
+_start_limiter = RateLimiter(START_RATE, START_BURST)
+_stopping = False     # set by shutdown(): no new runs start
+_dropped = 0          # queued runs dropped by the current shutdown()
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+# Queue a run of task_name and return its run id straight away.
+# Returns None if the task already has MAX_PENDING_PER_TASK runs waiting, or during shutdown.
+# dag_run is the id of the DAG run the run belongs to, if any (see dag.py).
+def submit(task_name, trigger='One-off', dag_run=None):
+    run_id = uuid.uuid4().hex
+    run = {
+        'id': run_id,
+        'task': task_name,
+        'trigger': trigger,
+        'status': 'queued',
+        'queued_at': _now(),
+        'started_at': None,
+        'finished_at': None,
+        'returncode': None,
+        'error': None,
+        'kill_reason': None,
+        'record_id': None,
+        'dag_run': dag_run,
+    }
+    # Scheduled runs are measured from their fire time, which the scheduler reports later
+    planned = None if trigger == 'Scheduled' else time.time()
+    with _lock:
+        if _stopping:
+            return None
+        if _active.get(task_name, 0) < PER_TASK_LIMIT:
+            _active[task_name] = _active.get(task_name, 0) + 1
+            _runs[run_id] = run
+            _start_times[run_id] = [planned, None]
+            supervisor.submit(_execute(run_id))
+        else:
+            waiting = _waiting.setdefault(task_name, deque())
+            if len(waiting) >= MAX_PENDING_PER_TASK:
+                metrics.run_rejected(task_name)
+                return None
+            _runs[run_id] = run
+            _start_times[run_id] = [planned, None]
+            waiting.append(run_id)
+    metrics.run_queued(task_name)
+    return run_id
+
+# Report when a scheduled run was due to start (a datetime); may arrive before or after it starts.
+# Only on-time scheduled runs are measured from their fire time: catch-up runs of missed fires
+# are measured from when they were queued, like manual runs.
+def set_fire_time(run_id, fire_time):
+    with _lock:
+        run = _runs.get(run_id)
+        if run is None or run['trigger'] != 'Scheduled':
+            return
+    _note_start_time(run_id, 0, fire_time.timestamp())
+
+def _note_start_time(run_id, index, value):
+    with _lock:
+        times = _start_times.get(run_id)
+        if times is None:
+            return
+        times[index] = value
+        if None in times:
+            return
+        del _start_times[run_id]
+        run = _runs[run_id]
+    metrics.run_start_lag(run['task'], run['trigger'], times[1] - times[0])
+
+def get_run(run_id):
+    with _lock:
+        run = _runs.get(run_id)
+        return dict(run) if run else None
+
+def list_runs(task_name=None):
+    with _lock:
+        runs = [dict(r) for r in _runs.values() if task_name is None or r['task'] == task_name]
+    return sorted(runs, key=lambda r: r['queued_at'], reverse=True)
+
+# Call listener(run) with a copy of every run record once the run has finished.
+# Listeners are called in a worker thread, so they may block.
+def add_finish_listener(listener):
+    _finish_listeners.append(listener)
+
+def is_running(task_name):
+    with _lock:
+        return _active.get(task_name, 0) > 0
+
+# Stop the run engine: runs still queued are dropped (status 'cancelled'), running commands
+# get grace seconds (SHUTDOWN_GRACE) to finish and are then terminated, and the run status
+# they recorded is written last. With wait=False, the loop is stopped at once.
+def shutdown(wait=True, grace=None):
+    global _slots, _stopping, _dropped
+    with _lock:
+        _stopping = True
+        _dropped = 0
+        for waiting in _waiting.values():
+            for run_id in waiting:
+                _cancel(_runs[run_id])
+                _finished.append(run_id)
+        _waiting.clear()
+    # Runs already handed to the loop drop out in _execute when they get a slot
+    supervisor.shutdown(wait=wait, grace=SHUTDOWN_GRACE if grace is None else grace)
+    _slots = None  # bound to the stopped loop
+    runstatus.shutdown()
+    with _lock:
+        _stopping = False
+        if _dropped:
+            logging.info(f"Run engine stopped: {_dropped} queued runs dropped")
+
+# Mark a run that never started as dropped at shutdown (called with _lock held)
+def _cancel(run):
+    global _dropped
+    _dropped += 1
+    run['status'] = 'cancelled'
+    run['error'] = 'botBrigade shut down before the run started'
+    run['finished_at'] = _now()
+    _start_times.pop(run['id'], None)
+    metrics.run_cancelled(run['task'])
+
+# Drop a run that got its slot after shutdown() began; True if it was dropped
+def _dropped_at_shutdown(run):
+    with _lock:
+        if not _stopping:
+            return False
+        _cancel(run)
+    _release(run)
+    return True
+
+async def _execute(run_id):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(MAX_WORKERS)
+    async with _slots:
+        run = _runs[run_id]
+        if _dropped_at_shutdown(run):
+            return
+        # The start token is taken once the run has a slot, so runs that waited for one
+        # are still spaced out by START_RATE when slots free up
+        delay = _start_limiter.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+            if _dropped_at_shutdown(run):
+                return
+        started = time.time()
+        metrics.run_started(run['task'])
+        _note_start_time(run_id, 1, started)
+        try:
+            await _run_task(run)
+        except Exception as e:
+            run['status'] = 'failed'
+            run['error'] = str(e)
+        finally:
+            run['finished_at'] = _now()
+            metrics.run_finished(run['task'], time.time() - started, run['returncode'])
+            _release(run)
+    for listener in _finish_listeners:
+        try:
+            await asyncio.to_thread(listener, dict(run))
+        except Exception:
+            logging.exception(f"Run finish listener failed for task {run['task']}")
+
+# Hand the per-task slot to the next waiting run, or give it back
+def _release(run):
+    task_name = run['task']
+    with _lock:
+        _finished.append(run['id'])
+        while len(_finished) > RUN_HISTORY:
+            old_id = _finished.popleft()
+            _runs.pop(old_id, None)
+            _start_times.pop(old_id, None)
+        waiting = _waiting.get(task_name)
+        if waiting:
+            next_id = waiting.popleft()
+            if not waiting:
+                del _waiting[task_name]
+            supervisor.submit(_execute(next_id))
+            return
+        _active[task_name] -= 1
+        if _active[task_name] == 0:
+            del _active[task_name]
+
+# Run the task's command as a shell command line, or in exec mode as an argv list without a shell
+async def _stream(task, log, cgroup):
+    timeout = task.get('timeout') or RUN_TIMEOUT
+    if task.get('command_mode') != 'exec':
+        return await supervisor.stream_command(task['command'], log, timeout, True, task, cgroup)
+    try:
+        args = shlex.split(task['command'])
+    except ValueError as e:
+        return {'returncode': -1, 'error': f"Could not split command: {e}", 'timed_out': False, 'usage': None}
+    if not args:
+        return {'returncode': -1, 'error': 'Empty command', 'timed_out': False, 'usage': None}
+    return await supervisor.stream_command(args, log, timeout, False, task, cgroup)
+
+# Database and rotation work is blocking, so it runs in the loop's thread pool;
+# the command itself is supervised on the loop
+async def _run_task(run):
+    task_name = run['task']
+    task = await asyncio.to_thread(storage.get_task, task_name)
+    if not task:
+        run['status'] = 'failed'
+        run['error'] = 'Task not found.'
+        return
+    run['status'] = 'running'
+    run['started_at'] = _now()
+    # Rotate the log only when no other run of this task is writing to it
+    with _lock:
+        sole_run = _active.get(task_name) == 1
+    if sole_run:
+        try:
+            await asyncio.to_thread(logstore.rotate_if_needed, task_name)
+        except OSError:
+            logging.exception(f"Could not rotate log for task {task_name}")
+    started = time.monotonic()
+    started_at = datetime.now().isoformat()
+    with logstore.open_log(task_name) as log:
+        log.write(f"\n--- {run['trigger']} run at {started_at} ---\n".encode())
+        log.flush()
+        # Record the run with a pointer to where its output starts in the log
+        output_offset = log.tell()
+        run['record_id'] = await asyncio.to_thread(storage.start_run, task_name, run['trigger'], started_at,
+                                                   logstore.log_file_name(task_name), output_offset)
+        log.write(f"Command: {task['command']}\n".encode())
+        described = limits.describe(task)
+        if described:
+            log.write(f"Limits: {described}\n".encode())
+        cgroup = None
+        try:
+            cgroup = await asyncio.to_thread(limits.create_cgroup, task, run['id'])
+        except OSError as e:
+            log.write(f"Warning: cgroup limits not applied: {e}\n".encode())
+            logging.warning(f"Could not create cgroup for task {task_name}: {e}")
+        log.flush()
+        text_offset = log.tell()
+        try:
+            result = await _stream(task, log, cgroup)
+        finally:
+            text_end = log.tell()
+            oom_kills = 0
+            memory_peak = None
+            if cgroup:
+                oom_kills = limits.cgroup_oom_kills(cgroup)
+                memory_peak = limits.cgroup_memory_peak(cgroup)
+                if not limits.cgroup_joined(cgroup):
+                    log.write(b"Warning: command could not join its cgroup; cgroup limits not applied\n")
+                await asyncio.to_thread(limits.remove_cgroup, cgroup)
+        returncode, error, usage = result['returncode'], result['error'], result['usage']
+        # What the command wrote, after the line supervisor.stream_command() puts before it
+        if text_end > text_offset:
+            text_offset += len(supervisor.OUTPUT_HEADER)
+        # The cgroup counts the command alone, where wait4() may count botBrigade's own RSS
+        if usage and memory_peak is not None:
+            usage['max_rss_kb'] = memory_peak
+        kill_reason = limits.kill_reason(task, result, oom_kills)
+        log.write(f"Return code: {returncode}\n".encode())
+        if kill_reason:
+            log.write(f"Killed: {kill_reason}\n".encode())
+        if usage:
+            max_rss = 'unknown' if usage['max_rss_kb'] is None else f"{usage['max_rss_kb']} KiB"
+            log.write(f"Usage: user {usage['cpu_user']:.2f}s system {usage['cpu_system']:.2f}s "
+                      f"max RSS {max_rss}\n".encode())
+        if error:
+            log.write(f"Error:\n{error}\n".encode())
+        output_length = log.tell() - output_offset
+    duration = time.monotonic() - started
+    await asyncio.to_thread(storage.finish_run, run['record_id'], datetime.now().isoformat(), returncode,
+                            duration, output_length, kill_reason, usage, text_offset, text_end - text_offset)
+    # last_run, return code and duration are written behind, in batches (see runstatus.py)
+    runstatus.record(task_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), returncode, duration)
+    run['returncode'] = returncode
+    run['error'] = error
+    run['kill_reason'] = kill_reason
+    run['status'] = 'succeeded' if returncode == 0 else 'failed'
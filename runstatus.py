@@ -0,0 +1,87 @@
+import os
+import logging
+import sqlite3
+import threading
+import storage
+
+# Write-behind run bookkeeping
+# Every finished run sets its task's last_run, last_returncode and last_duration. Instead of a
+# transaction per run, record() keeps the latest values of each task in memory and a background
+# thread writes whatever is waiting in one transaction (storage.set_run_status) every
+# FLUSH_INTERVAL seconds, or as soon as FLUSH_RUNS runs have been recorded. Thousands of runs a
+# minute then cost a few commits a second, which UI writes don't have to queue behind.
+# Only those three columns are written, so a task edited or disabled while it ran keeps its
+# changes. runner.shutdown() calls shutdown(), which writes what is still waiting.
+# FLUSH_RUNS 1 writes every run as soon as it is recorded.
+FLUSH_INTERVAL = float(os.environ.get('BOTBRIGADE_STATUS_FLUSH_INTERVAL', '0.25'))
+FLUSH_RUNS = int(os.environ.get('BOTBRIGADE_STATUS_FLUSH_RUNS', '200'))
+
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_flush_lock = threading.Lock()   # one flush at a time, so a task's values land in run order
+_pending = {}         # task name -> (last_run, returncode, duration) of its latest run
+_recorded = 0         # runs recorded since the last flush
+_thread = None
+_stop = None          # threading.Event that stops _thread
+
+def record(task_name, last_run, returncode, duration):
+    global _recorded
+    with _lock:
+        _pending[task_name] = (last_run, returncode, duration)
+        _recorded += 1
+        if _recorded == 1 or _recorded >= FLUSH_RUNS:
+            _wakeup.notify()
+        running = _thread is not None and _thread.is_alive()
+    if not running:
+        _ensure_started()
+
+def _ensure_started():
+    global _thread, _stop
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop = threading.Event()
+        _thread = threading.Thread(target=_flush_loop, args=(_stop,), name='run-status', daemon=True)
+        _thread.start()
+
+# Sleep until something is recorded, give more runs FLUSH_INTERVAL to arrive, write them
+def _flush_loop(stop):
+    while not stop.is_set():
+        with _lock:
+            while not _pending and not stop.is_set():
+                _wakeup.wait()
+            if _recorded < FLUSH_RUNS and not stop.is_set():
+                _wakeup.wait(FLUSH_INTERVAL)
+        flush()
+
+# Write everything recorded so far. Returns the number of tasks written.
+def flush():
+    global _pending, _recorded
+    with _flush_lock:
+        with _lock:
+            pending, _pending = _pending, {}
+            _recorded = 0
+        if not pending:
+            return 0
+        try:
+            storage.set_run_status([(name,) + values for name, values in pending.items()])
+        except sqlite3.Error:
+            logging.exception(f"Could not record the status of {len(pending)} runs; retrying")
+            # Keep them for the next flush, unless a newer run of the task came in meanwhile
+            with _lock:
+                for name, values in pending.items():
+                    _pending.setdefault(name, values)
+            return 0
+        return len(pending)
+
+# Stop the flush thread and write what is left
+def shutdown():
+    global _thread
+    with _lock:
+        thread, _thread = _thread, None
+        if _stop is not None:
+            _stop.set()
+        _wakeup.notify_all()
+    if thread is not None:
+        thread.join()
+    flush()
@@ -1,40 +1,92 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime, timedelta, time
+from datetime import datetime
+from triggers import WeekdayWindowTrigger, SpreadTrigger
+from timeline import Timeline, SHARED_MAX_AGE
 import storage
-import app
+import metrics
+import runner
+import cluster
+import dag
+import os
 import threading
 import re
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+import hashlib
+from executors import SupervisorExecutor, current_fire_time, current_trigger
 import logging
-from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_ERROR
+from apscheduler.events import (EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_ERROR,
+                                EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED)
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.util import utc_timestamp_to_datetime
 
-# Set up persistent job store
-jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite')
-}
-scheduler = BackgroundScheduler(jobstores=jobstores)
+# Persistent job store (in cluster mode, every node points at the same one)
+JOBSTORE_URL = os.environ.get('BOTBRIGADE_JOBSTORE_URL', 'sqlite:///jobs.sqlite')
 scheduler_lock = threading.Lock()
 
-# Set up logging to a file for scheduler events
-logging.basicConfig(
-    filename='scheduler.log',
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s'
-)
+# The scheduler and its job store are built on first use, not when this module is imported,
+# so importing it opens no database and doesn't import SQLAlchemy. Other modules reach the
+# scheduler as scheduler.scheduler (see __getattr__) or get_scheduler().
+_scheduler = None
+_jobstore = None
+_setup_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler, _jobstore
+    if _scheduler is None:
+        with _setup_lock:
+            if _scheduler is None:
+                from jobstores import BatchingSQLAlchemyJobStore
+                _jobstore = BatchingSQLAlchemyJobStore(url=JOBSTORE_URL)
+                scheduler = BackgroundScheduler(jobstores={'default': _jobstore},
+                                                executors={'default': SupervisorExecutor()})
+                scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+                scheduler.add_listener(job_index_listener, EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+                _scheduler = scheduler
+    return _scheduler
+
+def _store():
+    get_scheduler()
+    return _jobstore
+
+# Whether this process runs the scheduler (worker.start()). A web UI served on its own
+# (`flask --app app run`) doesn't: its task changes only reach the tasks table, and the worker
+# process that owns the job store reconciles from there. The schedule helpers below leave the
+# job store and job_fingerprints alone in such a process, so the worker never takes a job it
+# has not built for an up-to-date one.
+def running():
+    return _scheduler is not None and _scheduler.running
+
+def __getattr__(name):
+    if name == 'scheduler':
+        return get_scheduler()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Function for APScheduler to call
+# The run itself happens on the run engine's worker pool. The run id is returned
+# so the scheduler's listener can report the run's fire time for start-lag metrics
+def run_task_job(task_name):
+    fire_time = current_fire_time()
+    trigger = current_trigger()
+    if cluster.ENABLED and fire_time is not None:
+        # Only the node that wins this fire's lease runs it
+        return cluster.run_claimed(task_name, fire_time, trigger)
+    # Tasks that depend on this one are started as it finishes (see dag.py)
+    return dag.submit(task_name, trigger)
 
 # Listener for task events
 def job_listener(event):
     if event.code == EVENT_JOB_EXECUTED:
         logging.info(f"Task executed: {event.job_id}")
+        # run_task_job returns the id of the run it queued
+        if event.retval:
+            runner.set_fire_time(event.retval, event.scheduled_run_time)
     elif event.code == EVENT_JOB_MISSED:
         logging.warning(f"Task MISSED: {event.job_id}")
+        metrics.job_missed(event.job_id)
     elif event.code == EVENT_JOB_ERROR:
         logging.error(f"Task ERROR: {event.job_id}")
-
-scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+        metrics.job_error(event.job_id)
 
 # Helper to parse schedule string
 # Supports: 'YYYY-MM-DD HH:MM' (one-time), 'interval:5m', 'interval:2h', 'interval:1d',
@@ -55,27 +107,11 @@ def parse_schedule(schedule_str):
             start_str, end_str, interval_val, interval_unit = match.groups()
             start_hour, start_minute = map(int, start_str.split(':'))
             end_hour, end_minute = map(int, end_str.split(':'))
-            interval = int(interval_val)
-            # Only support minute or hour intervals for now
-            triggers = []
-            # Calculate all times between start and end at the given interval
-            t = time(start_hour, start_minute)
-            end_t = time(end_hour, end_minute)
-            times = []
-            while True:
-                times.append((t.hour, t.minute))
-                if interval_unit == 'm':
-                    dt = (datetime.combine(datetime.today(), t) + timedelta(minutes=interval)).time()
-                else:
-                    dt = (datetime.combine(datetime.today(), t) + timedelta(hours=interval)).time()
-                if (dt.hour, dt.minute) > (end_t.hour, end_t.minute):
-                    break
-                t = dt
-            # Create a CronTrigger for each time
-            for hour, minute in times:
-                triggers.append(CronTrigger(day_of_week='mon-fri', hour=hour, minute=minute))
-            # Return a list of triggers (handled in schedule_all_tasks)
-            return triggers
+            interval = int(interval_val) * (60 if interval_unit == 'h' else 1)
+            if interval <= 0:
+                return None
+            # One trigger covers every slot in the window
+            return WeekdayWindowTrigger(start_hour * 60 + start_minute, end_hour * 60 + end_minute, interval)
     else:
         # Assume date/time string
         try:
@@ -84,74 +120,276 @@ def parse_schedule(schedule_str):
         except Exception:
             return None
 
+# --- Fire-time spreading ---
+# With SPREAD_WINDOW set, each task fires a fixed number of seconds (0 to SPREAD_WINDOW) after
+# its schedule says, so hundreds of 'interval:5m' or 'weekdays:09:00-...' tasks no longer all
+# start in the same second. The offset comes from a hash of the task name: it stays the same
+# across restarts and on every cluster node, and it is kept below the task's interval.
+# SPREAD_WINDOW: seconds (0: off, every task fires exactly on its schedule)
+SPREAD_WINDOW = float(os.environ.get('BOTBRIGADE_SPREAD_WINDOW', '0'))
+
+def _schedule_period(trigger):
+    if isinstance(trigger, IntervalTrigger):
+        return trigger.interval.total_seconds()
+    if isinstance(trigger, WeekdayWindowTrigger):
+        return trigger.interval * 60
+    return None
+
+# Seconds this task's fires are shifted by
+def spread_offset(task_name, trigger, window=None):
+    window = SPREAD_WINDOW if window is None else window
+    period = _schedule_period(trigger)
+    if period:
+        window = min(window, period)
+    if window <= 0:
+        return 0
+    fraction = int.from_bytes(hashlib.sha1(task_name.encode()).digest()[:8], 'big') / 2 ** 64
+    return int(fraction * window)
+
+# The trigger a task's job runs on: its schedule, shifted by its spread offset
+def task_trigger(task):
+    trigger = parse_schedule(task['schedule'])
+    if trigger is None:
+        return None
+    offset = spread_offset(task['name'], trigger)
+    return SpreadTrigger(trigger, offset) if offset else trigger
+
+# --- Task -> job id index ---
+# Exact map from task name to the ids of its jobs in the store, so edits, toggles and
+# deletes never have to list (and unpickle) every job. Rebuilt from the job store's id
+# column by reconcile(), and kept current by the helpers below and by job_index_listener
+# for jobs the scheduler removes itself (e.g. one-time jobs after they fire).
+_job_index = {}     # task name -> set of job ids
+_job_owner = {}     # job id -> task name
+_index_lock = threading.Lock()
+
+def _index_job(task_name, job_id):
+    with _index_lock:
+        _job_index.setdefault(task_name, set()).add(job_id)
+        _job_owner[job_id] = task_name
+
+def _unindex_job(job_id):
+    with _index_lock:
+        task_name = _job_owner.pop(job_id, None)
+        job_ids = _job_index.get(task_name)
+        if job_ids is not None:
+            job_ids.discard(job_id)
+            if not job_ids:
+                del _job_index[task_name]
+
+def _rebuild_job_index(job_ids):
+    with _index_lock:
+        _job_index.clear()
+        _job_owner.clear()
+        # Every job belongs to the task of the same name
+        for job_id in job_ids:
+            _job_index[job_id] = {job_id}
+            _job_owner[job_id] = job_id
+
+def _add_task_job(task, trigger):
+    get_scheduler().add_job(
+        func=run_task_job,
+        trigger=trigger,
+        args=[task['name']],
+        id=task['name'],
+        replace_existing=True,
+        # Every missed fire reaches the executor, which leaves them to catchup.py
+        coalesce=False,
+        misfire_grace_time=None
+    )
+    _index_job(task['name'], task['name'])
+
+def _remove_task_jobs(task_name):
+    # The task's own id is always tried: in cluster mode another node may have added it
+    for job_id in task_job_ids(task_name) | {task_name}:
+        try:
+            get_scheduler().remove_job(job_id)
+        except JobLookupError:
+            # Already gone from the store; just forget it
+            _unindex_job(job_id)
+
+def task_job_ids(task_name):
+    with _index_lock:
+        return set(_job_index.get(task_name, ()))
+
+def job_index_listener(event):
+    if event.code == EVENT_ALL_JOBS_REMOVED:
+        _rebuild_job_index(())
+        timeline.invalidate()
+    else:
+        _unindex_job(event.job_id)
+        timeline.invalidate([event.job_id])
+
+# --- Upcoming fire times ---
+# The /scheduled view reads timeline (see timeline.py), which is built from the tasks' schedules
+# and the job store's next_run_time column. Every change below invalidates the tasks it touched
+# once its job store transaction has committed, so the timeline never caches a half-written batch.
+
+# {task name: (trigger, next run time)} for the named tasks' jobs (all jobs if names is None)
+def _load_timeline(names):
+    from sqlalchemy import inspect, select
+    store = _store()
+    jobs_t = store.jobs_t
+    if not running():
+        # The job store belongs to a worker in another process, which changes it without telling
+        # this one, and may not have created it yet
+        timeline.max_age = timeline.max_age or SHARED_MAX_AGE
+        if not inspect(store.engine).has_table(jobs_t.name, schema=jobs_t.schema):
+            return {}
+    query = select(jobs_t.c.id, jobs_t.c.next_run_time).where(jobs_t.c.next_run_time.isnot(None))
+    next_run_times = {}
+    with store.engine.begin() as connection:
+        if names is None:
+            next_run_times.update(connection.execute(query).all())
+        else:
+            names = list(names)
+            for start in range(0, len(names), storage.LOOKUP_BATCH_SIZE):
+                batch = names[start:start + storage.LOOKUP_BATCH_SIZE]
+                next_run_times.update(connection.execute(query.where(jobs_t.c.id.in_(batch))).all())
+    loaded = {}
+    for name, task in storage.get_tasks(list(next_run_times)).items():
+        trigger = task_trigger(task) if task['status'] == 'enabled' else None
+        if trigger:
+            loaded[name] = (trigger, utc_timestamp_to_datetime(next_run_times[name]))
+    return loaded
+
+timeline = Timeline(_load_timeline)
+
+# --- Reconciliation ---
+# Each enabled task owns one job whose id is the task name. The job store keeps its
+# next_run_time across restarts, so jobs are only rebuilt when what they were built from
+# changes. storage.job_fingerprints records that per task.
+
+# Bump when the way a task is turned into a job changes, so every job gets rebuilt
+# (2: missed fires are no longer coalesced by APScheduler, see catchup.py;
+#  3: jobs call scheduler.run_task_job instead of app.run_task_job)
+JOB_FORMAT_VERSION = 3
+
+def job_fingerprint(task):
+    key = f"{JOB_FORMAT_VERSION}|{task['schedule']}|{task['status']}"
+    trigger = parse_schedule(task['schedule']) if SPREAD_WINDOW else None
+    if trigger:
+        # Changing the spread window moves the task's fires, so its job is rebuilt
+        key += f"|spread={spread_offset(task['name'], trigger)}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _is_one_time(schedule_str):
+    return not schedule_str.startswith(('interval:', 'weekdays:'))
+
+# Ids of the jobs in the persistent store, read without unpickling the jobs
+def _stored_job_ids():
+    from sqlalchemy import select
+    store = _store()
+    with store.engine.begin() as connection:
+        return {row[0] for row in connection.execute(select(store.jobs_t.c.id))}
+
+# Bring the job store in line with the tasks table, touching only jobs that changed.
+# Safe to call at runtime (e.g. after a bulk import). Returns counts of what was done, or None
+# when this process doesn't run the scheduler (the worker that does reconciles instead).
+def reconcile(tasks=None):
+    if not running():
+        return None
+    with scheduler_lock, _store().batch():
+        if tasks is None:
+            tasks = storage.load_tasks()
+        desired = {t['name']: t for t in tasks if t['status'] == 'enabled'}
+        stored_ids = _stored_job_ids()
+        fingerprints = storage.load_job_fingerprints()
+        new_fingerprints = {}
+        added = unchanged = 0
+        for name, task in list(desired.items()):
+            fingerprint = job_fingerprint(task)
+            if fingerprints.get(name) == fingerprint:
+                # Up to date, or a one-time job that has already fired and left the store
+                if name in stored_ids or _is_one_time(task['schedule']):
+                    unchanged += 1
+                    continue
+            trigger = task_trigger(task)
+            if not trigger:
+                # Schedule no longer parses; drop whatever job it had
+                del desired[name]
+                continue
+            _add_task_job(task, trigger)
+            new_fingerprints[name] = fingerprint
+            added += 1
+        stale = stored_ids - desired.keys()
+        for job_id in stale:
+            get_scheduler().remove_job(job_id)
+        _rebuild_job_index((stored_ids - stale) | new_fingerprints.keys())
+        storage.set_job_fingerprints(new_fingerprints)
+        storage.delete_job_fingerprints(fingerprints.keys() - desired.keys())
+    timeline.invalidate(new_fingerprints.keys() | stale)
+    return {'added': added, 'removed': len(stale), 'unchanged': unchanged}
+
 # Schedule all enabled tasks on startup
 def schedule_all_tasks():
-    with scheduler_lock:
-        scheduler.remove_all_jobs()
-        tasks = storage.load_tasks()
+    return reconcile()
+
+# Add, replace or remove the jobs of the given tasks in one job store transaction
+def update_task_schedules(tasks):
+    if not running():
+        return
+    changed = []
+    with scheduler_lock, _store().batch():
+        scheduled = {}
+        unscheduled = []
         for task in tasks:
-            if task['status'] == 'enabled':
-                triggers = parse_schedule(task['schedule'])
-                if isinstance(triggers, list):
-                    for idx, trigger in enumerate(triggers):
-                        scheduler.add_job(
-                            func=app.run_task_job,
-                            trigger=trigger,
-                            args=[task['name']],
-                            id=f"{task['name']}_{idx}",
-                            replace_existing=True,
-                            misfire_grace_time=3600  # 1 hour
-                        )
-                elif triggers:
-                    scheduler.add_job(
-                        func=app.run_task_job,
-                        trigger=triggers,
-                        args=[task['name']],
-                        id=task['name'],
-                        replace_existing=True,
-                        misfire_grace_time=3600  # 1 hour
-                    )
+            changed.append(task['name'])
+            if task['status'] != 'enabled':
+                # Remove all jobs for this task
+                _remove_task_jobs(task['name'])
+                unscheduled.append(task['name'])
+                continue
+            trigger = task_trigger(task)
+            if trigger:
+                _add_task_job(task, trigger)
+                scheduled[task['name']] = job_fingerprint(task)
+                continue
+            # No schedule, or one that doesn't parse: the old job must not keep firing
+            if task['schedule']:
+                logging.warning(f"Task {task['name']} not scheduled: cannot parse schedule '{task['schedule']}'")
+            _remove_task_jobs(task['name'])
+            unscheduled.append(task['name'])
+        storage.set_job_fingerprints(scheduled)
+        storage.delete_job_fingerprints(unscheduled)
+    timeline.invalidate(changed)
 
 def add_or_update_task_schedule(task):
-    with scheduler_lock:
-        if task['status'] != 'enabled':
-            # Remove all jobs for this task
-            for job in list(scheduler.get_jobs()):
-                if job.id.startswith(task['name']):
-                    scheduler.remove_job(job.id, jobstore=None)
-            return
-        triggers = parse_schedule(task['schedule'])
-        if isinstance(triggers, list):
-            for idx, trigger in enumerate(triggers):
-                scheduler.add_job(
-                    func=app.run_task_job,
-                    trigger=trigger,
-                    args=[task['name']],
-                    id=f"{task['name']}_{idx}",
-                    replace_existing=True,
-                    misfire_grace_time=3600  # 1 hour
-                )
-        elif triggers:
-            scheduler.add_job(
-                func=app.run_task_job,
-                trigger=triggers,
-                args=[task['name']],
-                id=task['name'],
-                replace_existing=True,
-                misfire_grace_time=3600  # 1 hour
-            )
+    update_task_schedules([task])
+
+def remove_task_schedules(task_names):
+    task_names = list(task_names)
+    if not running():
+        return
+    with scheduler_lock, _store().batch():
+        for task_name in task_names:
+            _remove_task_jobs(task_name)
+        storage.delete_job_fingerprints(task_names)
+    timeline.invalidate(task_names)
 
 def remove_task_schedule(task_name):
+    remove_task_schedules([task_name])
+
+def remove_all_task_schedules():
+    if not running():
+        return
     with scheduler_lock:
-        for job in list(scheduler.get_jobs()):
-            if job.id.startswith(task_name):
-                scheduler.remove_job(job.id, jobstore=None)
+        get_scheduler().remove_all_jobs()
+        storage.delete_job_fingerprints(None)
+    timeline.invalidate()
 
 def start():
-    schedule_all_tasks()
-    # Log all tasks and their next run times
-    jobs = scheduler.get_jobs()
-    for job in jobs:
-        nrt = getattr(job, 'next_run_time', None)
-        logging.info(f"Scheduled task: {job.id}, next run: {nrt}")
-    scheduler.start() 
\ No newline at end of file
+    # Start paused so the job store is open while reconciling, but nothing fires yet
+    get_scheduler().start(paused=True)
+    counts = schedule_all_tasks()
+    logging.info(f"Scheduler reconciled: {counts['added']} jobs added or updated, "
+                 f"{counts['removed']} removed, {counts['unchanged']} unchanged")
+    get_scheduler().resume()
+    if cluster.ENABLED:
+        cluster.start(get_scheduler().wakeup)
+
+def shutdown(wait=True):
+    if cluster.ENABLED:
+        cluster.stop()
+    if _scheduler is not None and _scheduler.running:
+        _scheduler.shutdown(wait=wait)
@@ -1,87 +1,721 @@
 import sqlite3
 import os
+import threading
+import time
+import functools
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, 'tasks.db')
+DB_FILE = os.environ.get('BOTBRIGADE_DB', os.path.join(BASE_DIR, 'tasks.db'))
 FIELDNAMES = ['name', 'command', 'schedule', 'status', 'last_run']
+# Per-task resource limits (see limits.py); None means no limit
+LIMIT_FIELDS = ['timeout', 'cpu_limit', 'memory_limit', 'nice', 'ionice', 'cgroup_cpu', 'cgroup_memory']
+LIMIT_COLUMNS = {
+    'timeout': 'INTEGER',        # seconds
+    'cpu_limit': 'INTEGER',      # CPU seconds (RLIMIT_CPU)
+    'memory_limit': 'INTEGER',   # MiB of address space (RLIMIT_AS)
+    'nice': 'INTEGER',
+    'ionice': 'TEXT',            # 'idle' or 'best-effort[:level]'
+    'cgroup_cpu': 'REAL',        # CPUs (cgroup v2 cpu.max)
+    'cgroup_memory': 'INTEGER',  # MiB (cgroup v2 memory.max)
+}
+# How the command is run: 'shell' (a /bin/sh command line, the default) or 'exec' (split into
+# an argv list and run without a shell)
+COMMAND_MODES = ('shell', 'exec')
+# Columns besides FIELDNAMES; NULL means the default. catch_up is what happens to fires
+# missed while botBrigade was down (see catchup.py); log_keep_segments is how many closed log
+# segments of the task are kept (see logstore.py)
+OPTION_FIELDS = ['command_mode', 'catch_up', 'log_keep_segments'] + LIMIT_FIELDS
+# How the latest run of each task ended; written with last_run by set_run_status() only
+RUN_STATUS_COLUMNS = {
+    'last_returncode': 'INTEGER',
+    'last_duration': 'REAL',     # seconds
+}
+RUN_STATUS_FIELDS = list(RUN_STATUS_COLUMNS)
+TASK_COLUMNS = FIELDNAMES + OPTION_FIELDS + RUN_STATUS_FIELDS
+TASK_SELECT = 'SELECT ' + ', '.join(TASK_COLUMNS) + ' FROM tasks'
+# Why a run was killed by one of its limits, and its resource usage
+RUN_USAGE_COLUMNS = {
+    'kill_reason': 'TEXT',
+    'cpu_user': 'REAL',       # seconds
+    'cpu_system': 'REAL',     # seconds
+    'max_rss_kb': 'INTEGER',
+}
+# Where the command's own output is in the log (offset and length in bytes), without the lines
+# botBrigade writes around it (Command:, Return code:, ...); it is what the search index covers.
+# NULL for runs recorded before these columns existed.
+RUN_TEXT_COLUMNS = {
+    'text_offset': 'INTEGER',
+    'text_length': 'INTEGER',
+}
+# Whether the full-text index of run output exists (SQLite built with FTS5); set by init_db(),
+# so read it through search_available()
+SEARCH_AVAILABLE = False
+
+# Connection tuning
+# Each thread keeps one open connection, so SQLite's per-connection statement cache
+# (STATEMENT_CACHE_SIZE) re-uses the prepared form of the constant queries below.
+# WAL lets readers run alongside a writer; BUSY_TIMEOUT_MS makes SQLite wait for a lock
+# instead of failing at once, and BUSY_RETRIES retries what still comes back as locked.
+BUSY_TIMEOUT_MS = 5000
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY = 0.05
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+]
+
+_local = threading.local()
+# The schema is brought up to date by the first connection to a database, not at import
+_initialized = None   # DB_FILE that init_db() last ran against
+_init_lock = threading.Lock()
+
+# Return this thread's connection to DB_FILE, opening and tuning it on first use
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == DB_FILE:
+        return conn
+    if conn is not None:
+        conn.close()
+    conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    _local.conn = conn
+    _local.path = DB_FILE
+    if _initialized != DB_FILE:
+        with _init_lock:
+            if _initialized != DB_FILE:
+                init_db()
+    return conn
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+# Retry a storage call with exponential backoff while the database reports it is locked
+def retry_on_busy(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = BUSY_RETRY_DELAY
+        for attempt in range(BUSY_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or attempt == BUSY_RETRIES - 1:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+    return wrapper
 
 # Ensure the tasks table exists and has an 'order' column
-conn = sqlite3.connect(DB_FILE)
-c = conn.cursor()
-c.execute('''
-    CREATE TABLE IF NOT EXISTS tasks (
-        name TEXT PRIMARY KEY,
-        command TEXT NOT NULL,
-        schedule TEXT NOT NULL,
-        status TEXT NOT NULL,
-        last_run TEXT,
-        "order" INTEGER DEFAULT 0
-    )
-''')
-# Add 'order' column if missing
-try:
-    c.execute('ALTER TABLE tasks ADD COLUMN "order" INTEGER DEFAULT 0')
-except sqlite3.OperationalError:
-    pass
-conn.commit()
-conn.close()
+def init_db():
+    global _initialized
+    conn = get_connection()
+    if _initialized == DB_FILE:
+        return
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                name TEXT PRIMARY KEY,
+                command TEXT NOT NULL,
+                schedule TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_run TEXT,
+                "order" INTEGER DEFAULT 0
+            )
+        ''')
+    # Add 'order' column if missing
+    try:
+        with conn:
+            conn.execute('ALTER TABLE tasks ADD COLUMN "order" INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass
+    # Add command mode, catch-up policy, log retention, limit and run status columns if missing
+    for column, column_type in ([('command_mode', 'TEXT'), ('catch_up', 'TEXT'), ('log_keep_segments', 'INTEGER')]
+                                + list(LIMIT_COLUMNS.items())
+                                + list(RUN_STATUS_COLUMNS.items())):
+        try:
+            with conn:
+                conn.execute(f'ALTER TABLE tasks ADD COLUMN {column} {column_type}')
+        except sqlite3.OperationalError:
+            pass
+    # One row per run; the output itself stays in the task log and is located by
+    # output_path (relative to the logs directory), output_offset and output_length
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_name TEXT NOT NULL,
+                trigger_type TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                finished_at TEXT,
+                returncode INTEGER,
+                duration REAL,
+                output_path TEXT,
+                output_offset INTEGER,
+                output_length INTEGER
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_task_started ON runs (task_name, started_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_output_path ON runs (output_path)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS job_fingerprints (task_name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS tasks_order ON tasks ("order", name)')
+        # Cluster mode: one row per scheduled fire a node has claimed (see cluster.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                job_id TEXT NOT NULL,
+                fire_time TEXT NOT NULL,
+                node TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                finished INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (job_id, fire_time)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS leases_expiry ON leases (finished, expires_at)')
+        # Task dependencies: task_name runs after upstream finishes, if condition holds (see dag.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dependencies (
+                task_name TEXT NOT NULL,
+                upstream TEXT NOT NULL,
+                condition TEXT NOT NULL DEFAULT 'success',
+                PRIMARY KEY (task_name, upstream)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS dependencies_upstream ON dependencies (upstream)')
+        # meta.tasks_version goes up on every change to the tasks table; it is the
+        # dashboard API's ETag, so an unchanged task list costs one lookup
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('tasks_version', 0)")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS tasks_version_{event.lower()} AFTER {event} ON tasks
+                BEGIN UPDATE meta SET value = value + 1 WHERE key = 'tasks_version'; END
+            ''')
+        # meta.schedules_version only goes up when what the scheduler builds jobs from changes
+        # (not on run bookkeeping); a worker serving another process's UI polls it (see worker.py)
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('schedules_version', 0)")
+        for event in ('INSERT', 'UPDATE OF name, schedule, status', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS schedules_version_{event.split()[0].lower()} AFTER {event} ON tasks
+                BEGIN UPDATE meta SET value = value + 1 WHERE key = 'schedules_version'; END
+            ''')
+
+    # Why a run was killed (timeout, cpu limit, ...), its resource usage from wait4() and
+    # where the command's output is
+    for column, column_type in list(RUN_USAGE_COLUMNS.items()) + list(RUN_TEXT_COLUMNS.items()):
+        try:
+            with conn:
+                conn.execute(f'ALTER TABLE runs ADD COLUMN {column} {column_type}')
+        except sqlite3.OperationalError:
+            pass
+
+    # Full-text index of run output (see logsearch.py), if this SQLite has FTS5
+    global SEARCH_AVAILABLE
+    try:
+        with conn:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS run_text USING fts5(body, tokenize='unicode61', prefix='2 3 4')")
+        SEARCH_AVAILABLE = True
+    except sqlite3.OperationalError:
+        SEARCH_AVAILABLE = False
+    _initialized = DB_FILE
 
+def _row_to_task(row):
+    row = list(row)
+    if row[4] is None:
+        row[4] = ''
+    return dict(zip(TASK_COLUMNS, row))
+
+@retry_on_busy
 def load_tasks():
-    tasks = []
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for row in c.execute('SELECT name, command, schedule, status, last_run FROM tasks ORDER BY "order" ASC, name ASC'):
-        row = list(row)
-        if row[4] is None:
-            row[4] = ''
-        task = dict(zip(FIELDNAMES, row))
-        tasks.append(task)
-    conn.close()
+    conn = get_connection()
+    rows = conn.execute(f'{TASK_SELECT} ORDER BY "order" ASC, name ASC')
+    return [_row_to_task(row) for row in rows]
+
+# Keyed lookups on the primary key, for callers that need one or a few tasks
+@retry_on_busy
+def get_task(name):
+    conn = get_connection()
+    row = conn.execute(f'{TASK_SELECT} WHERE name=?', (name,)).fetchone()
+    return _row_to_task(row) if row else None
+
+# Return {name: task} for the names that exist, in as few queries as SQLite's parameter limit allows
+LOOKUP_BATCH_SIZE = 500
+
+@retry_on_busy
+def get_tasks(names):
+    names = list(dict.fromkeys(names))
+    tasks = {}
+    conn = get_connection()
+    for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+        batch = names[start:start + LOOKUP_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        for row in conn.execute(f'{TASK_SELECT} WHERE name IN ({placeholders})', batch):
+            tasks[row[0]] = _row_to_task(row)
     return tasks
 
+@retry_on_busy
+def task_exists(name):
+    conn = get_connection()
+    return conn.execute('SELECT 1 FROM tasks WHERE name=?', (name,)).fetchone() is not None
+
+@retry_on_busy
 def add_task(task):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    conn = get_connection()
     try:
-        c.execute('INSERT INTO tasks (name, command, schedule, status, last_run) VALUES (?, ?, ?, ?, ?)',
-                  (task['name'], task['command'], task['schedule'], task['status'], task.get('last_run', '')))
-        conn.commit()
+        with conn:
+            conn.execute(f'INSERT INTO tasks ({", ".join(TASK_COLUMNS)}) VALUES ({", ".join("?" * len(TASK_COLUMNS))})',
+                         (task['name'], task['command'], task['schedule'], task['status'], task.get('last_run', ''))
+                         + tuple(task.get(field) for field in OPTION_FIELDS + RUN_STATUS_FIELDS))
     except sqlite3.IntegrityError:
-        conn.close()
         raise ValueError(f"Task with name '{task['name']}' already exists.")
-    conn.close()
 
+# Command mode and limits are only changed when new_task has them, so callers that only
+# know the basic fields leave them alone. last_run and the run status columns are never
+# written here: they belong to set_run_status(), so an edit made from a task read before a
+# run finished does not undo that run's bookkeeping (nor the other way round)
+@retry_on_busy
 def edit_task(name, new_task):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''
-        UPDATE tasks SET command=?, schedule=?, status=?, last_run=? WHERE name=?
-    ''', (new_task['command'], new_task['schedule'], new_task['status'], new_task.get('last_run', ''), name))
-    conn.commit()
-    conn.close()
+    options = [field for field in OPTION_FIELDS if field in new_task]
+    assignments = ''.join(f', {field}=?' for field in options)
+    conn = get_connection()
+    with conn:
+        conn.execute(f'''
+            UPDATE tasks SET command=?, schedule=?, status=?{assignments} WHERE name=?
+        ''', (new_task['command'], new_task['schedule'], new_task['status'])
+             + tuple(new_task[field] for field in options) + (name,))
 
+# Record how the latest runs ended: [(name, last_run, returncode, duration)], in one
+# transaction. Only those columns are written (see runstatus.py, which batches the calls).
+@retry_on_busy
+def set_run_status(updates):
+    conn = get_connection()
+    with conn:
+        conn.executemany('UPDATE tasks SET last_run=?, last_returncode=?, last_duration=? WHERE name=?',
+                         ((last_run, returncode, duration, name) for name, last_run, returncode, duration in updates))
+
+@retry_on_busy
 def delete_task(name):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('DELETE FROM tasks WHERE name=?', (name,))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM tasks WHERE name=?', (name,))
+        conn.execute('DELETE FROM dependencies WHERE task_name=? OR upstream=?', (name, name))
 
+@retry_on_busy
 def rename_task(old_name, new_name):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('UPDATE tasks SET name=? WHERE name=?', (new_name, old_name))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        conn.execute('UPDATE tasks SET name=? WHERE name=?', (new_name, old_name))
+        conn.execute('UPDATE runs SET task_name=? WHERE task_name=?', (new_name, old_name))
+        conn.execute('UPDATE dependencies SET task_name=? WHERE task_name=?', (new_name, old_name))
+        conn.execute('UPDATE dependencies SET upstream=? WHERE upstream=?', (new_name, old_name))
 
 def save_tasks(tasks):
     # Not needed with SQLite, but kept for compatibility
     pass
 
-def set_task_order(task_names):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for idx, name in enumerate(task_names):
-        c.execute('UPDATE tasks SET "order"=? WHERE name=?', (idx, name))
-    conn.commit()
-    conn.close() 
\ No newline at end of file
+# Put task_names at positions offset, offset + 1, ... of the task order (offset is where a
+# reordered dashboard page starts); every other task keeps its relative position
+@retry_on_busy
+def set_task_order(task_names, offset=0):
+    task_names = list(dict.fromkeys(task_names))
+    moved = set(task_names)
+    conn = get_connection()
+    with conn:
+        current = conn.execute('SELECT name, "order" FROM tasks ORDER BY "order" ASC, name ASC').fetchall()
+        others = [name for name, _ in current if name not in moved]
+        names = others[:offset] + task_names + others[offset:]
+        positions = dict(current)
+        # Only rewrite the rows whose position changed
+        conn.executemany('UPDATE tasks SET "order"=? WHERE name=?',
+                         ((idx, name) for idx, name in enumerate(names) if positions.get(name) != idx))
+
+# Current value of the tasks table version counter
+@retry_on_busy
+def tasks_version():
+    conn = get_connection()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'tasks_version'").fetchone()
+    return int(row[0]) if row else 0
+
+# Current value of the counter of changes to task names, schedules and statuses
+@retry_on_busy
+def schedules_version():
+    conn = get_connection()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schedules_version'").fetchone()
+    return int(row[0]) if row else 0
+
+TASK_SORT_FIELDS = {
+    'order': '"order" {dir}, name {dir}',
+    'name': 'name {dir}',
+    'schedule': 'schedule {dir}, name ASC',
+    'status': 'status {dir}, name ASC',
+    'last_run': 'last_run {dir}, name ASC',
+}
+
+def _like(text):
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# One page of the task list, filtered and sorted in SQL. Returns (tasks, total matching).
+# name and schedule match substrings, status matches exactly.
+@retry_on_busy
+def query_tasks(name=None, status=None, schedule=None, sort='order', descending=False, limit=50, offset=0):
+    conditions = []
+    params = []
+    if name:
+        conditions.append("name LIKE ? ESCAPE '\\'")
+        params.append(_like(name))
+    if status:
+        conditions.append('status = ?')
+        params.append(status)
+    if schedule:
+        conditions.append("schedule LIKE ? ESCAPE '\\'")
+        params.append(_like(schedule))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order_by = TASK_SORT_FIELDS.get(sort, TASK_SORT_FIELDS['order']).format(dir='DESC' if descending else 'ASC')
+    conn = get_connection()
+    total = conn.execute(f'SELECT COUNT(*) FROM tasks {where}', params).fetchone()[0]
+    rows = conn.execute(f'{TASK_SELECT} {where} '
+                        f'ORDER BY {order_by} LIMIT ? OFFSET ?', params + [limit, offset])
+    return [_row_to_task(row) for row in rows], total
+
+# --- Bulk mutations ---
+# Each call is a single transaction, whatever the number of tasks
+
+# Insert or update tasks by name; tasks may be any iterable (e.g. a streaming CSV reader).
+# Only the given columns (default FIELDNAMES) are written; name must be one of them.
+# Returns the number of rows written. Not retried on busy: a one-shot iterator cannot be replayed.
+def upsert_tasks(tasks, columns=FIELDNAMES):
+    conn = get_connection()
+    count = 0
+
+    def rows():
+        nonlocal count
+        for task in tasks:
+            count += 1
+            yield tuple(task.get(column, '' if column == 'last_run' else None) for column in columns)
+
+    updates = ', '.join(f'{column}=excluded.{column}' for column in columns if column != 'name')
+    with conn:
+        conn.executemany(f'''
+            INSERT INTO tasks ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})
+            ON CONFLICT(name) DO UPDATE SET {updates}
+        ''', rows())
+    return count
+
+@retry_on_busy
+def delete_tasks(names):
+    conn = get_connection()
+    with conn:
+        conn.executemany('DELETE FROM tasks WHERE name=?', ((name,) for name in names))
+        conn.executemany('DELETE FROM dependencies WHERE task_name=? OR upstream=?', ((name, name) for name in names))
+
+@retry_on_busy
+def set_tasks_status(names, status):
+    conn = get_connection()
+    with conn:
+        conn.executemany('UPDATE tasks SET status=? WHERE name=?', ((status, name) for name in names))
+
+# Flip enabled/disabled for each named task
+@retry_on_busy
+def toggle_tasks(names):
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            UPDATE tasks SET status = CASE status WHEN 'enabled' THEN 'disabled' ELSE 'enabled' END WHERE name=?
+        ''', ((name,) for name in names))
+
+# --- Task dependencies ---
+# Edges are (task_name, upstream, condition); see dag.py
+
+# [(upstream, condition)] of one task
+@retry_on_busy
+def get_dependencies(task_name):
+    conn = get_connection()
+    return conn.execute('SELECT upstream, condition FROM dependencies WHERE task_name=? ORDER BY upstream',
+                        (task_name,)).fetchall()
+
+# [(task_name, condition)] of the tasks that depend on upstream
+@retry_on_busy
+def get_downstream(upstream):
+    conn = get_connection()
+    return conn.execute('SELECT task_name, condition FROM dependencies WHERE upstream=? ORDER BY task_name',
+                        (upstream,)).fetchall()
+
+# Every edge, for cycle checks and CSV export
+@retry_on_busy
+def load_dependencies():
+    conn = get_connection()
+    return conn.execute('SELECT task_name, upstream, condition FROM dependencies ORDER BY task_name, upstream').fetchall()
+
+# Replace the upstream dependencies of each task in {task_name: [(upstream, condition)]}
+@retry_on_busy
+def set_dependencies(dependencies):
+    conn = get_connection()
+    with conn:
+        conn.executemany('DELETE FROM dependencies WHERE task_name=?', ((name,) for name in dependencies))
+        conn.executemany('INSERT INTO dependencies (task_name, upstream, condition) VALUES (?, ?, ?)',
+                         ((name, upstream, condition) for name, edges in dependencies.items()
+                          for upstream, condition in edges))
+
+# --- Run history ---
+RUN_FIELDS = ['id', 'task_name', 'trigger_type', 'started_at', 'finished_at', 'returncode', 'duration',
+              'output_path', 'output_offset', 'output_length'] + list(RUN_USAGE_COLUMNS) + list(RUN_TEXT_COLUMNS)
+
+@retry_on_busy
+def start_run(task_name, trigger_type, started_at, output_path, output_offset):
+    conn = get_connection()
+    with conn:
+        cur = conn.execute('INSERT INTO runs (task_name, trigger_type, started_at, output_path, output_offset) VALUES (?, ?, ?, ?, ?)',
+                           (task_name, trigger_type, started_at, output_path, output_offset))
+    return cur.lastrowid
+
+@retry_on_busy
+def finish_run(run_id, finished_at, returncode, duration, output_length, kill_reason=None, usage=None,
+               text_offset=None, text_length=None):
+    usage = usage or {}
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            UPDATE runs SET finished_at=?, returncode=?, duration=?, output_length=?,
+                            kill_reason=?, cpu_user=?, cpu_system=?, max_rss_kb=?,
+                            text_offset=?, text_length=? WHERE id=?
+        ''', (finished_at, returncode, duration, output_length, kill_reason,
+              usage.get('cpu_user'), usage.get('cpu_system'), usage.get('max_rss_kb'),
+              text_offset, text_length, run_id))
+
+# Newest runs of a task first, one page at a time
+@retry_on_busy
+def load_runs(task_name, limit=20, offset=0):
+    conn = get_connection()
+    rows = conn.execute(f'SELECT {", ".join(RUN_FIELDS)} FROM runs WHERE task_name=? ORDER BY started_at DESC, id DESC LIMIT ? OFFSET ?',
+                        (task_name, limit, offset))
+    return [dict(zip(RUN_FIELDS, row)) for row in rows]
+
+@retry_on_busy
+def count_runs(task_name):
+    conn = get_connection()
+    return conn.execute('SELECT COUNT(*) FROM runs WHERE task_name=?', (task_name,)).fetchone()[0]
+
+@retry_on_busy
+def set_run_output_path(old_path, new_path):
+    conn = get_connection()
+    with conn:
+        conn.execute('UPDATE runs SET output_path=? WHERE output_path=?', (new_path, old_path))
+
+@retry_on_busy
+def delete_runs_by_output_path(output_path):
+    conn = get_connection()
+    with conn:
+        if SEARCH_AVAILABLE:
+            conn.executemany('DELETE FROM run_text WHERE rowid BETWEEN ? AND ?',
+                             (_text_rowids(run_id) for run_id, in
+                              conn.execute('SELECT id FROM runs WHERE output_path=?', (output_path,)).fetchall()))
+        conn.execute('DELETE FROM runs WHERE output_path=?', (output_path,))
+
+@retry_on_busy
+def oldest_run_started(output_path):
+    conn = get_connection()
+    return conn.execute('SELECT MIN(started_at) FROM runs WHERE output_path=?', (output_path,)).fetchone()[0]
+
+@retry_on_busy
+def get_meta(key, default=None):
+    conn = get_connection()
+    row = conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+    return row[0] if row else default
+
+@retry_on_busy
+def set_meta(key, value):
+    conn = get_connection()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+# Insert already-finished runs (e.g. imported from old log files) and set a meta flag
+# in the same transaction, so an interrupted import can simply be run again
+@retry_on_busy
+def import_runs(runs, meta_key):
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO runs (task_name, trigger_type, started_at, finished_at, returncode, duration,
+                              output_path, output_offset, output_length)
+            VALUES (:task_name, :trigger_type, :started_at, :finished_at, :returncode, :duration,
+                    :output_path, :output_offset, :output_length)
+        ''', runs)
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (meta_key, '1'))
+
+# --- Full-text index of run output ---
+# One run_text row per chunk of a run's output; chunk n of run id has rowid
+# id * TEXT_ROWID_SPAN + n, so a run's rows are one rowid range that FTS5 looks up directly.
+# The table keeps prefix indexes of 2-4 characters, so word* queries don't expand every
+# matching term for each run's snippet.
+TEXT_ROWID_SPAN = 1024
+# Markers around matched terms in search snippets (see logsearch.py)
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+def search_available():
+    get_connection()
+    return SEARCH_AVAILABLE
+
+def _text_rowids(run_id):
+    return run_id * TEXT_ROWID_SPAN, (run_id + 1) * TEXT_ROWID_SPAN - 1
+
+# Replace the indexed output of a run with chunks (at most TEXT_ROWID_SPAN of them)
+@retry_on_busy
+def index_run_text(run_id, chunks):
+    first, last = _text_rowids(run_id)
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM run_text WHERE rowid BETWEEN ? AND ?', (first, last))
+        conn.executemany('INSERT INTO run_text (rowid, body) VALUES (?, ?)',
+                         ((first + n, chunk) for n, chunk in enumerate(chunks[:TEXT_ROWID_SPAN])))
+
+# Finished runs with id > after_id, oldest first, for backfilling the index a batch at a time
+@retry_on_busy
+def runs_after(after_id, limit):
+    conn = get_connection()
+    rows = conn.execute(f'SELECT {", ".join(RUN_FIELDS)} FROM runs WHERE id > ? AND finished_at IS NOT NULL '
+                        'ORDER BY id LIMIT ?', (after_id, limit))
+    return [dict(zip(RUN_FIELDS, row)) for row in rows]
+
+@retry_on_busy
+def get_run_record(run_id):
+    conn = get_connection()
+    row = conn.execute(f'SELECT {", ".join(RUN_FIELDS)} FROM runs WHERE id=?', (run_id,)).fetchone()
+    return dict(zip(RUN_FIELDS, row)) if row else None
+
+@retry_on_busy
+def run_text_indexed(run_id):
+    conn = get_connection()
+    first, last = _text_rowids(run_id)
+    return conn.execute('SELECT 1 FROM run_text WHERE rowid BETWEEN ? AND ? LIMIT 1', (first, last)).fetchone() is not None
+
+# Runs whose indexed output contains every one of the FTS5 terms wanted and none of those
+# unwanted, newest first, each with a snippet of its best matching chunk. Terms are matched
+# against the whole run, not chunk by chunk: a run matches when each wanted term is in any
+# of its chunks. started_at bounds are ISO strings (since inclusive, until exclusive);
+# returncode is an exit code, or 'failed' for any non-zero one.
+@retry_on_busy
+def search_run_text(wanted, unwanted=(), task_name=None, since=None, until=None, returncode=None, limit=50,
+                    offset=0, snippet_tokens=16):
+    conditions = []
+    params = []
+    for term in wanted:
+        conditions.append('id IN (SELECT rowid / ? FROM run_text WHERE run_text MATCH ?)')
+        params += [TEXT_ROWID_SPAN, term]
+    if unwanted:
+        conditions.append('id NOT IN (SELECT rowid / ? FROM run_text WHERE run_text MATCH ?)')
+        params += [TEXT_ROWID_SPAN, ' OR '.join(unwanted)]
+    if task_name:
+        conditions.append('task_name = ?')
+        params.append(task_name)
+    if since:
+        conditions.append('started_at >= ?')
+        params.append(since)
+    if until:
+        conditions.append('started_at < ?')
+        params.append(until)
+    if returncode == 'failed':
+        conditions.append('returncode != 0')
+    elif returncode is not None:
+        conditions.append('returncode = ?')
+        params.append(returncode)
+    conn = get_connection()
+    where = ' AND '.join(conditions)
+    total = conn.execute(f'SELECT COUNT(*) FROM runs WHERE {where}', params).fetchone()[0]
+    results = [dict(zip(RUN_FIELDS, row)) for row in conn.execute(
+        f'SELECT {", ".join(RUN_FIELDS)} FROM runs WHERE {where} ORDER BY started_at DESC, id DESC LIMIT ? OFFSET ?',
+        params + [limit, offset])]
+    # Snippets only for the runs on this page, each from its own rowid range
+    match = ' OR '.join(wanted)
+    for run in results:
+        first, last = _text_rowids(run['id'])
+        row = conn.execute('''
+            SELECT snippet(run_text, 0, ?, ?, '...', ?) FROM run_text
+            WHERE run_text MATCH ? AND rowid BETWEEN ? AND ? ORDER BY rank LIMIT 1
+        ''', (MATCH_START, MATCH_END, snippet_tokens, match, first, last)).fetchone()
+        run['snippet'] = row[0] if row else ''
+    return results, total
+
+# --- Scheduler job fingerprints ---
+# What each task's job in the scheduler's job store was built from, so the scheduler
+# can tell which jobs are already up to date without unpickling them
+
+@retry_on_busy
+def load_job_fingerprints():
+    conn = get_connection()
+    return dict(conn.execute('SELECT task_name, fingerprint FROM job_fingerprints'))
+
+@retry_on_busy
+def set_job_fingerprints(fingerprints):
+    conn = get_connection()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO job_fingerprints (task_name, fingerprint) VALUES (?, ?)',
+                         fingerprints.items())
+
+@retry_on_busy
+def delete_job_fingerprints(task_names):
+    conn = get_connection()
+    with conn:
+        if task_names is None:
+            conn.execute('DELETE FROM job_fingerprints')
+        else:
+            conn.executemany('DELETE FROM job_fingerprints WHERE task_name=?', [(name,) for name in task_names])
+
+# --- Cluster leases ---
+# A fire (job_id, fire_time) belongs to the node holding an unexpired lease on it.
+# Times are epoch seconds; fire_time is an ISO timestamp in UTC.
+
+# Claim a fire for node. Succeeds if nobody has claimed it yet, or if the previous holder's
+# lease ran out before it finished (a takeover). Returns True if node now holds the lease.
+@retry_on_busy
+def claim_lease(job_id, fire_time, node, expires_at, now):
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO leases (job_id, fire_time, node, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(job_id, fire_time) DO UPDATE
+                SET node=excluded.node, expires_at=excluded.expires_at, attempts=attempts + 1
+                WHERE finished = 0 AND expires_at < ?
+        ''', (job_id, fire_time, node, expires_at, now))
+        return cursor.rowcount == 1
+
+# Extend node's leases on the given (job_id, fire_time) keys
+@retry_on_busy
+def renew_leases(node, keys, expires_at):
+    conn = get_connection()
+    with conn:
+        conn.executemany('UPDATE leases SET expires_at=? WHERE job_id=? AND fire_time=? AND node=?',
+                         ((expires_at, job_id, fire_time, node) for job_id, fire_time in keys))
+
+@retry_on_busy
+def finish_leases(node, keys):
+    conn = get_connection()
+    with conn:
+        conn.executemany('UPDATE leases SET finished=1 WHERE job_id=? AND fire_time=? AND node=?',
+                         ((job_id, fire_time, node) for job_id, fire_time in keys))
+
+# Unfinished leases whose holder stopped renewing them, oldest first
+@retry_on_busy
+def expired_leases(now, limit=100):
+    conn = get_connection()
+    return conn.execute('''
+        SELECT job_id, fire_time, node FROM leases WHERE finished = 0 AND expires_at < ?
+        ORDER BY expires_at LIMIT ?
+    ''', (now, limit)).fetchall()
+
+# Forget leases that finished or expired before the given time
+@retry_on_busy
+def prune_leases(before):
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM leases WHERE expires_at < ?', (before,))
@@ -0,0 +1,327 @@
+import os
+import sys
+import signal
+import select
+import logging
+import asyncio
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# rlimits are Unix-only
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import logstore
+import limits
+import launcher
+
+# One asyncio event loop, in its own thread, that supervises every task command.
+# A running command costs a pipe and a few callbacks on the loop instead of a blocked
+# thread, so thousands of them can run at once. Code in other threads hands work to the
+# loop with submit() (coroutines) or call_soon() (plain functions, which must not block).
+# KILL_AFTER: at shutdown, seconds between SIGTERM and SIGKILL for commands that outlive the
+#   grace period (see shutdown)
+KILL_AFTER = 5
+# Line stream_command() writes before a command's output, if it has any
+OUTPUT_HEADER = b"Output:\n"
+# WAIT_THREADS: most threads blocked in wait4() on systems with neither pidfds nor kqueue
+WAIT_THREADS = 1024
+
+_loop = None
+_thread = None
+_tasks = set()
+_commands = {}    # pid -> function that signals the command's process group, while it runs
+_wait_pool = None # ThreadPoolExecutor for wait4(), kept apart from the loop's default executor
+_start_lock = threading.Lock()
+_launcher = None  # launcher.Launcher, while commands are started through it
+
+def _raise_fd_limit():
+    # Every running command holds a pipe and a log file open
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError):
+        pass
+
+def _ensure_started():
+    global _loop, _thread
+    if _loop is not None:
+        return _loop
+    with _start_lock:
+        if _loop is None:
+            _raise_fd_limit()
+            loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=loop.run_forever, name='botbrigade-supervisor', daemon=True)
+            _thread.start()
+            _loop = loop
+            if launcher.ENABLED:
+                start_launcher()
+    return _loop
+
+def _track(coro):
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+# Run a coroutine on the loop; returns a concurrent.futures.Future
+def submit(coro):
+    loop = _ensure_started()
+
+    async def tracked():
+        return await _track(coro)
+
+    return asyncio.run_coroutine_threadsafe(tracked(), loop)
+
+# Call a plain function on the loop thread
+def call_soon(func, *args):
+    _ensure_started().call_soon_threadsafe(func, *args)
+
+def running():
+    return len(_tasks)
+
+# Start commands through a launcher process from now on (see launcher.py)
+def start_launcher():
+    loop = _ensure_started()
+
+    def start():
+        global _launcher
+        if _launcher is not None and _launcher.alive:
+            return
+        _launcher = launcher.Launcher()
+        _launcher.start(loop)
+
+    if not launcher.SUPPORTED:
+        return
+    asyncio.run_coroutine_threadsafe(_call(start), loop).result()
+
+# Go back to starting commands from this process
+def stop_launcher():
+    global _launcher
+    if _loop is None or _launcher is None:
+        return
+    asyncio.run_coroutine_threadsafe(_call(_launcher.close), _loop).result()
+    _launcher = None
+
+async def _call(func):
+    func()
+
+# Stop the loop; with wait=True, let every submitted coroutine finish first.
+# With a grace period (seconds), commands still running after it are sent SIGTERM, then
+# SIGKILL KILL_AFTER seconds later, and coroutines left after that are cancelled.
+def shutdown(wait=True, grace=None):
+    global _loop, _thread
+    loop, thread = _loop, _thread
+    if loop is None:
+        return
+    if wait:
+        # Finishing runs may still submit queued ones, so keep going until nothing is left.
+        # Returns False if timeout seconds pass first.
+        async def drain(timeout=None):
+            deadline = None if timeout is None else loop.time() + timeout
+            while _tasks:
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                await asyncio.wait(list(_tasks), timeout=remaining)
+            return True
+
+        async def stop():
+            if await drain(grace):
+                return
+            if _commands:
+                logging.warning(f"{len(_commands)} commands still running after the {grace:g}s shutdown "
+                                f"grace period; terminating them")
+                _signal_commands(signal.SIGTERM)
+                if await drain(KILL_AFTER):
+                    return
+                _signal_commands(signal.SIGKILL)
+                if await drain(KILL_AFTER):
+                    return
+            for task in list(_tasks):
+                task.cancel()
+            await asyncio.gather(*list(_tasks), return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    stop_launcher()
+    with _start_lock:
+        _loop = _thread = None
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+# Send sig to every running command (on the loop thread)
+def _signal_commands(sig):
+    for stop in list(_commands.values()):
+        stop(sig)
+
+# A file descriptor that becomes readable when child pid exits, and a function that closes it,
+# or None: a pidfd on Linux 5.3+, a kqueue watching NOTE_EXIT on macOS and the BSDs
+def _exit_watch(pid):
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(pid)
+            return pidfd, lambda: os.close(pidfd)
+        except OSError:
+            pass
+    if hasattr(select, 'kqueue'):
+        kq = select.kqueue()
+        try:
+            kq.control([select.kevent(pid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                                      select.KQ_NOTE_EXIT)], 0)
+            return kq.fileno(), kq.close
+        except OSError:
+            # e.g. ESRCH: it has exited already, so wait4() won't block
+            kq.close()
+    return None
+
+# Wait for a child to exit without blocking the loop, then reap it with wait4() to get its
+# resource usage. Elsewhere a thread of _wait_pool waits for it; not the loop's default
+# executor, which the scheduler's job dispatch, storage calls and finish listeners share.
+async def _wait4(pid):
+    global _wait_pool
+    loop = asyncio.get_running_loop()
+    watch = _exit_watch(pid)
+    if watch is None:
+        if _wait_pool is None:
+            _wait_pool = ThreadPoolExecutor(WAIT_THREADS, thread_name_prefix='botbrigade-wait4')
+        _, status, rusage = await loop.run_in_executor(_wait_pool, os.wait4, pid, 0)
+        return status, rusage
+    fd, close = watch
+    exited = loop.create_future()
+    loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(fd)
+        close()
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
+
+def _kib(maxrss):
+    # ru_maxrss is in KiB on Linux but bytes on macOS
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+# The peak RSS of a child starts out at the RSS of the process that forked it (Linux keeps it
+# across exec, for posix_spawn too), so a figure no higher than that process's own peak
+# (floor) may be the spawner's and not the command's; max_rss_kb is None then.
+def _usage(utime, stime, maxrss, floor):
+    max_rss = _kib(maxrss)
+    return {'cpu_user': utime, 'cpu_system': stime, 'max_rss_kb': max_rss if max_rss > _kib(floor) else None}
+
+# Start a command in its own session with stdout and stderr on one pipe.
+# Returns (pid, read end of the pipe, coroutine function waiting for (wait status, usage)).
+async def _spawn_direct(args, shell, task, cgroup):
+    # Without a preexec_fn, subprocess starts the command with vfork/posix_spawn
+    proc = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True, preexec_fn=limits.make_preexec(task or {}, cgroup))
+
+    async def wait():
+        status, rusage = await _wait4(proc.pid)
+        # Reaped here, so tell Popen it needn't wait
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        floor = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+        return status, _usage(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss, floor)
+
+    return proc.pid, proc.stdout, wait
+
+async def _spawn_launched(args, shell, task, cgroup):
+    read_fd, write_fd = os.pipe()
+    try:
+        pid, exited = await _launcher.spawn(args, shell, write_fd, task, cgroup)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+    async def wait():
+        status, rusage = await exited
+        return status, _usage(*rusage)
+
+    return pid, open(read_fd, 'rb', buffering=0), wait
+
+# Run a command and copy its combined stdout/stderr into the log as it arrives,
+# one chunk at a time, so memory stays bounded and the log can be followed live.
+# args is a shell command line, or with shell=False an argv list run without a shell.
+# The command is killed (with its whole process group) after timeout seconds.
+# task's limits are applied in the child before exec (see limits.make_preexec), and it
+# joins cgroup if given. The command is started by the launcher process while one runs.
+# Returns a dict: returncode, error (message or None), timed_out, stopped (terminated by
+# shutdown), and usage (CPU seconds and peak RSS of the command and the children it waited
+# for, or None if it never started; the peak RSS is None when it can't be told apart from
+# botBrigade's own, see _usage).
+async def stream_command(args, log, timeout, shell=True, task=None, cgroup=None):
+    loop = asyncio.get_running_loop()
+    spawn = _spawn_launched if _launcher is not None and _launcher.alive else _spawn_direct
+    try:
+        pid, stdout, wait = await spawn(args, shell, task, cgroup)
+    except Exception as e:
+        return {'returncode': -1, 'error': str(e), 'timed_out': False, 'stopped': False, 'usage': None}
+    timed_out = stopped = False
+
+    def kill():
+        nonlocal timed_out
+        timed_out = True
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def stop(sig):
+        nonlocal stopped
+        stopped = True
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+
+    timer = loop.call_later(timeout, kill)
+    _commands[pid] = stop
+    transport = None
+    try:
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdout)
+        wrote_header = False
+        last = b"\n"
+        while True:
+            chunk = await reader.read(logstore.CHUNK_SIZE)
+            if not chunk:
+                break
+            if not wrote_header:
+                log.write(OUTPUT_HEADER)
+                wrote_header = True
+            log.write(chunk)
+            log.flush()
+            last = chunk[-1:]
+        if last != b"\n":
+            log.write(b"\n")
+        status, usage = await wait()
+    except asyncio.CancelledError:
+        kill()
+        raise
+    except OSError as e:
+        # e.g. the launcher went away before the command finished
+        kill()
+        return {'returncode': -1, 'error': str(e), 'timed_out': timed_out, 'stopped': stopped, 'usage': None}
+    finally:
+        timer.cancel()
+        _commands.pop(pid, None)
+        if transport is not None:
+            transport.close()
+        else:
+            stdout.close()
+    result = {'returncode': os.waitstatus_to_exitcode(status), 'error': None, 'timed_out': timed_out,
+              'stopped': stopped, 'usage': usage}
+    if timed_out:
+        result['returncode'] = -1
+        result['error'] = f"Command timed out after {timeout} seconds"
+    elif stopped:
+        result['error'] = 'Command terminated: botBrigade shut down while it ran'
+    return result
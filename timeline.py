@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from apscheduler.triggers.interval import IntervalTrigger
+from triggers import SpreadTrigger
+from ratelimit import RateLimiter
+
+# Upcoming fire times of every scheduled task, computed from the tasks' triggers instead of
+# by unpickling jobs from the job store.
+# Each task's entry holds its trigger, anchored on the job's stored next_run_time (so interval
+# jobs keep the phase they were created with), and its next TIMELINE_SIZE fire times, which
+# are topped up as they pass. The scheduler invalidates a task's entry whenever it adds,
+# replaces or removes that task's job, and only invalidated entries are rebuilt.
+# TIMELINE_SIZE: how many upcoming fire times are kept per task
+# TIMELINE_MAX_AGE: seconds after which every entry is rebuilt anyway (0: never). In cluster
+#   mode other nodes change the shared job store without telling this one, so it defaults to
+#   SHARED_MAX_AGE; so does a web UI whose job store belongs to a worker process (see scheduler.py)
+# RANGE_LIMIT: the most fire times a range query returns (it still counts all of them)
+TIMELINE_SIZE = int(os.environ.get('BOTBRIGADE_TIMELINE_SIZE', '5'))
+SHARED_MAX_AGE = 60
+TIMELINE_MAX_AGE = float(os.environ.get('BOTBRIGADE_TIMELINE_MAX_AGE',
+                                        SHARED_MAX_AGE if os.environ.get('BOTBRIGADE_CLUSTER', '0') == '1' else 0))
+RANGE_LIMIT = 5000
+
+# A copy of trigger whose fire times line up with first_fire_time, the job's stored next run
+def anchor(trigger, first_fire_time):
+    if isinstance(trigger, SpreadTrigger):
+        return SpreadTrigger(anchor(trigger.trigger, first_fire_time - timedelta(seconds=trigger.offset)),
+                             trigger.offset)
+    if isinstance(trigger, IntervalTrigger):
+        state = trigger.__getstate__()
+        state['start_date'] = first_fire_time.astimezone(trigger.timezone)
+        trigger = IntervalTrigger.__new__(IntervalTrigger)
+        trigger.__setstate__(state)
+    return trigger
+
+# Fire times of trigger from start (inclusive) up to end (exclusive), at most limit of them
+def fire_times(trigger, start, end=None, limit=None):
+    times = []
+    fire_time = trigger.get_next_fire_time(None, start)
+    while fire_time is not None and (end is None or fire_time < end) and (limit is None or len(times) < limit):
+        if fire_time >= start:
+            times.append(fire_time)
+        next_time = trigger.get_next_fire_time(fire_time, fire_time)
+        if next_time is not None and next_time <= fire_time:
+            break  # guard against triggers that don't move forward
+        fire_time = next_time
+    return times
+
+class Timeline:
+    # loader(names) returns {task name: (trigger, first fire time)} for the named tasks that
+    # have a scheduled job, or for every such task when names is None
+    def __init__(self, loader, size=TIMELINE_SIZE, max_age=TIMELINE_MAX_AGE):
+        self._loader = loader
+        self._size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = None  # task name -> {'trigger', 'times'}; None until first built
+        self._dirty = set()
+        self._built_at = 0.0
+
+    # Forget the entries of task_names (all of them if None); they are rebuilt on next use
+    def invalidate(self, task_names=None):
+        with self._lock:
+            if task_names is None or self._entries is None:
+                self._entries = None
+                self._dirty.clear()
+            else:
+                self._dirty.update(task_names)
+
+    def _refresh(self, now):
+        if self._entries is not None and self.max_age and now.timestamp() - self._built_at > self.max_age:
+            self._entries = None
+        if self._entries is None:
+            self._entries = {}
+            self._dirty.clear()
+            loaded = self._loader(None)
+            self._built_at = now.timestamp()
+        elif self._dirty:
+            names = list(self._dirty)
+            self._dirty.clear()
+            for name in names:
+                self._entries.pop(name, None)
+            loaded = self._loader(names)
+        else:
+            loaded = {}
+        for name, (trigger, first_fire_time) in loaded.items():
+            trigger = anchor(trigger, first_fire_time)
+            self._entries[name] = {'trigger': trigger, 'times': fire_times(trigger, now, limit=self._size)}
+        # Drop fire times that have passed and top each entry back up
+        for entry in self._entries.values():
+            times = entry['times']
+            if times and times[0] < now:
+                times[:] = [t for t in times if t >= now]
+                if not times:
+                    times[:] = fire_times(entry['trigger'], now, limit=self._size)
+                    continue
+                while len(times) < self._size:
+                    next_time = entry['trigger'].get_next_fire_time(times[-1], times[-1])
+                    if next_time is None or next_time <= times[-1]:
+                        break
+                    times.append(next_time)
+
+    # [{'task', 'trigger', 'next_fire_times'}] for every scheduled task, soonest first
+    def upcoming(self, now=None):
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            self._refresh(now)
+            rows = [{'task': name, 'trigger': str(entry['trigger']), 'next_fire_times': list(entry['times'])}
+                    for name, entry in self._entries.items() if entry['times']]
+        rows.sort(key=lambda row: (row['next_fire_times'][0], row['task']))
+        return rows
+
+    # Everything that fires in [start, end): {'fires': [(fire time, task name)] in time order,
+    # at most limit of them, 'total': how many there are in all, 'per_task': {name: count},
+    # 'peak_fires': the most fires in any one second, and with a bucket (timedelta), 'buckets':
+    # [(bucket start, fires, starts)] covering the whole range.
+    # Starts are when the runs would start under a start rate limit of rate per second after
+    # a burst (see runner.START_RATE), with 'peak_starts' and 'max_delay' (seconds) to match;
+    # without a rate they are the fire times.
+    def between(self, start, end, limit=RANGE_LIMIT, bucket=None, rate=0, burst=1):
+        with self._lock:
+            self._refresh(datetime.now(timezone.utc))
+            triggers = [(name, entry['trigger']) for name, entry in self._entries.items()]
+        fires = []
+        per_task = {}
+        for name, trigger in triggers:
+            times = fire_times(trigger, start, end)
+            if times:
+                per_task[name] = len(times)
+                fires.extend((fire_time, name) for fire_time in times)
+        fires.sort()
+        fire_seconds = [fire_time.timestamp() for fire_time, _ in fires]
+        start_seconds = RateLimiter(rate, burst).schedule(fire_seconds)
+        result = {'fires': fires[:limit], 'total': len(fires), 'per_task': per_task,
+                  'peak_fires': _peak_per_second(fire_seconds), 'peak_starts': _peak_per_second(start_seconds),
+                  'max_delay': max((s - f for f, s in zip(fire_seconds, start_seconds)), default=0)}
+        if bucket:
+            count = max(-(-(end - start) // bucket), 1)
+            width = bucket.total_seconds()
+            origin = start.timestamp()
+            fire_counts = [0] * count
+            start_counts = [0] * count
+            for seconds, counts in ((fire_seconds, fire_counts), (start_seconds, start_counts)):
+                for t in seconds:
+                    # Starts pushed past the end of the range are counted in its last bucket
+                    counts[min(int((t - origin) // width), count - 1)] += 1
+            result['buckets'] = [(start + i * bucket, fire_counts[i], start_counts[i]) for i in range(count)]
+        return result
+
+def _peak_per_second(seconds):
+    return max(Counter(int(t) for t in seconds).values(), default=0)
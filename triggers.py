@@ -0,0 +1,108 @@
+from datetime import datetime, time, timedelta
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.util import astimezone, localize
+from tzlocal import get_localzone
+
+# Fires every `interval` minutes from `start` up to and including `end` on Monday to Friday.
+# start and end are minutes since midnight. This is the single-job equivalent of one
+# CronTrigger(day_of_week='mon-fri', hour=..., minute=...) per slot in the window;
+# the next fire time is computed arithmetically instead of by scanning slots.
+# A window whose end is before its start (22:00-02:00) crosses midnight: it opens on each
+# weekday and runs on into the next morning, so Friday's window ends early on Saturday.
+class WeekdayWindowTrigger(BaseTrigger):
+    __slots__ = 'start', 'end', 'interval', 'timezone'
+
+    def __init__(self, start, end, interval, timezone=None):
+        self.start = start
+        self.end = end
+        self.interval = interval
+        self.timezone = astimezone(timezone) if timezone else get_localzone()
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time:
+            start_date = min(now, previous_fire_time + timedelta(microseconds=1))
+            if start_date == previous_fire_time:
+                start_date += timedelta(microseconds=1)
+        else:
+            start_date = now
+        local = start_date.astimezone(self.timezone)
+        # Minutes since midnight, rounded up to the next whole minute
+        minute = local.hour * 60 + local.minute + (1 if local.second or local.microsecond else 0)
+        # Minutes since the midnight the window opens after; past 1440 when it crosses midnight
+        end = self.end if self.end >= self.start else self.end + 24 * 60
+        # The window opened yesterday may still be open; at most a weekend lies between now
+        # and the next one
+        for days in range(-1, 4):
+            day = local.date() + timedelta(days=days)
+            since_midnight = minute - days * 24 * 60
+            if day.weekday() < 5 and since_midnight <= end:
+                if since_midnight <= self.start:
+                    slot = self.start
+                else:
+                    slot = self.start + -(-(since_midnight - self.start) // self.interval) * self.interval
+                if slot <= end:
+                    return localize(datetime.combine(day, time()) + timedelta(minutes=slot), self.timezone)
+        return None
+
+    def __getstate__(self):
+        return {
+            'version': 1,
+            'start': self.start,
+            'end': self.end,
+            'interval': self.interval,
+            'timezone': self.timezone,
+        }
+
+    def __setstate__(self, state):
+        if state.get('version', 1) > 1:
+            raise ValueError(
+                f"Got serialized data for version {state['version']} of {self.__class__.__name__}, "
+                f"but only version 1 can be handled")
+        self.start = state['start']
+        self.end = state['end']
+        self.interval = state['interval']
+        self.timezone = state['timezone']
+
+    def __str__(self):
+        return (f"weekdays[{self.start // 60:02d}:{self.start % 60:02d}-{self.end // 60:02d}:{self.end % 60:02d} "
+                f"every {self.interval}m]")
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__} (start={self.start}, end={self.end}, interval={self.interval}, "
+                f"timezone='{self.timezone}')>")
+
+# Fires `offset` seconds after every fire time of `trigger`. Used to spread tasks that would
+# otherwise fire in the same second over a window (see scheduler.spread_offset); the offset
+# is derived from the task name, so every restart and every cluster node agrees on it.
+class SpreadTrigger(BaseTrigger):
+    __slots__ = 'trigger', 'offset'
+
+    def __init__(self, trigger, offset):
+        self.trigger = trigger
+        self.offset = offset
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        shift = timedelta(seconds=self.offset)
+        fire_time = self.trigger.get_next_fire_time(previous_fire_time and previous_fire_time - shift, now - shift)
+        return fire_time + shift if fire_time is not None else None
+
+    def __getstate__(self):
+        return {
+            'version': 1,
+            'trigger': self.trigger,
+            'offset': self.offset,
+        }
+
+    def __setstate__(self, state):
+        if state.get('version', 1) > 1:
+            raise ValueError(
+                f"Got serialized data for version {state['version']} of {self.__class__.__name__}, "
+                f"but only version 1 can be handled")
+        self.trigger = state['trigger']
+        self.offset = state['offset']
+
+    def __str__(self):
+        return f"{self.trigger} +{self.offset:g}s"
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (trigger={self.trigger!r}, offset={self.offset})>"
@@ -0,0 +1,63 @@
+import os
+import signal
+import logging
+import threading
+import storage
+import logstore
+import logsearch
+import runner
+import scheduler
+
+# Headless botBrigade: the scheduler and run engine without the web UI (Flask is never
+# imported). Several workers can share one tasks database in cluster mode (see cluster.py).
+#
+#   python worker.py
+#
+# start() and stop() are also what app.py runs around the web server. Run on its own, the
+# worker also serves a web UI in another process (`flask --app app run`), which only changes
+# the tasks table: every RECONCILE_INTERVAL seconds it checks storage.schedules_version() and
+# brings the job store in line when task names, schedules or statuses have changed.
+LOG_FILE = os.environ.get('BOTBRIGADE_LOG_FILE', 'scheduler.log')
+RECONCILE_INTERVAL = float(os.environ.get('BOTBRIGADE_RECONCILE_INTERVAL', '5'))
+
+# Scheduler events go to LOG_FILE
+def configure_logging():
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s'
+    )
+
+def start():
+    configure_logging()
+    storage.init_db()
+    logstore.import_legacy_logs()
+    logsearch.start_backfill()
+    scheduler.start()
+
+def stop():
+    scheduler.shutdown(wait=False)
+    runner.shutdown()
+
+def main():
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    version = storage.schedules_version()
+    start()
+    logging.info(f"Worker started (pid {os.getpid()})")
+    while not stopping.wait(RECONCILE_INTERVAL):
+        try:
+            current = storage.schedules_version()
+            if current != version:
+                counts = scheduler.reconcile()
+                version = current
+                logging.info(f"Tasks changed; scheduler reconciled: {counts['added']} jobs added or updated, "
+                             f"{counts['removed']} removed")
+        except Exception:
+            logging.exception("Could not reconcile the scheduler with the tasks table; retrying")
+    logging.info("Worker stopping")
+    stop()
+
+if __name__ == '__main__':
+    main()